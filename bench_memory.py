@@ -0,0 +1,113 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Created: 2026-10-18
+
+@author: pymancer
+
+upload memory benchmark against the local cloud stand-in (mock_cloud.py)
+- builds sparse files of each given size in a temporary folder, a few random bytes make them unique
+- uploads them by each engine from a separate process to a fresh stand-in (files above 2 GB are split by volumes)
+- reports peak resident memory of the uploading process and its growth during the upload,
+  which should stay flat however large the files are
+- Unix only (resource module), 'aiohttp' module is required
+
+example run (from shell):
+python bench_memory.py --sizes 512,4096 --files 2 --engines sync,async
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import multiprocessing
+import upload
+import bench_upload
+
+HEAD_SIZE = 64 # random bytes at the start of each sparse file
+
+
+def make_files(path, files_num, size):
+    """ creates files_num sparse files of size megabytes """
+    for index in range(files_num):
+        with open(os.path.join(path, 'file_{}.bin'.format(index)), 'wb') as f:
+            f.write(os.urandom(HEAD_SIZE))
+            f.truncate(size * 1024 * 1024)
+
+
+def get_rss():
+    """ returns current resident memory of the process, bytes, 0 if unknown """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return 0
+
+
+def get_peak_rss():
+    """ returns peak resident memory of the process, bytes """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def measure(queue, path, url, engine, args):
+    """ uploads the files by the engine, puts (elapsed, rss before the upload, peak rss) to the queue """
+    state_dir = tempfile.mkdtemp(prefix='bench_memory_state_')
+    try:
+        bench_upload.set_up(path, state_dir, url, args)
+        upload.HASH_FIRST = False
+        before = get_rss()
+        start = time.perf_counter()
+        upload.main(engine=engine)
+        queue.put((time.perf_counter() - start, before, get_peak_rss()))
+    finally:
+        shutil.rmtree(state_dir, ignore_errors=True)
+
+
+def run(path, engine, args):
+    """ returns measure results of the upload by a separate process to a fresh stand-in """
+    process, url = bench_upload.start_cloud(args)
+    try:
+        context = multiprocessing.get_context('spawn')
+        queue = context.Queue()
+        uploader = context.Process(target=measure, args=(queue, path, url, engine, args))
+        uploader.start()
+        result = queue.get()
+        uploader.join()
+    finally:
+        process.terminate()
+        process.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='upload memory benchmark')
+    parser.add_argument('--sizes', default='512,4096', help='file sizes to compare, megabytes')
+    parser.add_argument('--files', type=int, default=2, help='number of files of each size')
+    parser.add_argument('--engines', default=','.join(upload.ENGINES), help='upload engines: sync, async')
+    parser.add_argument('--workers', type=int, default=upload.UPLOAD_WORKERS, help='sync engine upload workers')
+    parser.add_argument('--async-limit', type=int, default=upload.ASYNC_LIMIT, help='async engine requests limit')
+    parser.add_argument('--bandwidth', type=int, default=0, help='stand-in posted kilobytes per second, 0 - unlimited')
+    args = parser.parse_args()
+    # stand-in and uploader settings shared with the throughput benchmark
+    args.latency = args.error_rate = 0
+    args.nodes = 1
+    args.archive = args.bundle = False
+
+    for size in [int(size) for size in args.sizes.split(',')]:
+        path = tempfile.mkdtemp(prefix='bench_memory_')
+        try:
+            make_files(path, args.files, size)
+            for engine in args.engines.split(','):
+                elapsed, before, peak = run(path, engine, args)
+                print('{:>6} MB x {} {:>6}: {:.2f} s, {:.1f} MB/s, peak memory {:.1f} MB, growth {:.1f} MB'.format(
+                    size, args.files, engine, elapsed, size * args.files / elapsed, peak / 1024 / 1024,
+                    (peak - before) / 1024 / 1024))
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Created: 2026-10-18
+
+@author: pymancer
+
+upload tree scanning benchmark
+- compares os.walk based scanning (os.walk, then os.walk and getsize per folder, os.walk and listdir
+  on cleanup) with the streaming os.scandir walker
+- builds a synthetic tree of empty files in a temporary folder unless existing one is given
+- reports time and peak python memory (tracemalloc) of each scan, the file system cache is warmed up first
+- then times empty folders removal of the synthetic tree (its leaf folders are empty), existing trees are kept intact
+
+example run (from shell):
+python bench_scan.py --files 1000000 --per-folder 1000
+python bench_scan.py --path /mnt/nfs/upload
+"""
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+import upload
+
+
+def make_tree(path, files=1000000, per_folder=1000, fanout=10):
+    """ creates files empty files, per_folder files in each folder, fanout subfolders per folder """
+    folders = [path]
+    created = 0
+    index = 0
+    while created < files:
+        folder = folders[index]
+        index += 1
+        for i in range(min(per_folder, files - created)):
+            open(os.path.join(folder, 'file_{}.txt'.format(i)), 'w').close()
+        created += min(per_folder, files - created)
+        for i in range(fanout):
+            subfolder = os.path.join(folder, 'folder_{}'.format(i))
+            os.mkdir(subfolder)
+            folders.append(subfolder)
+
+
+def walk_scan(path):
+    """ os.walk based scanning, returns the number of files and their total size """
+    files_num = size = 0
+    for folder, __, __ in list(os.walk(path)):
+        for filename in next(os.walk(folder))[2]:
+            size += os.path.getsize(os.path.join(folder, filename))
+            files_num += 1
+    # empty folders lookup on cleanup
+    for folder, __, __ in list(os.walk(path, topdown=False)):
+        os.listdir(folder)
+    return files_num, size
+
+
+def scandir_scan(path):
+    """ streaming os.scandir based scanning, returns the number of files and their total size """
+    files_num = size = 0
+    for batch in upload.scan_batches(path):
+        for folder, entries in batch:
+            for entry in entries:
+                size += entry.stat().st_size
+                files_num += 1
+    return files_num, size
+
+
+def measure(scan, path):
+    """ returns scan result, time and peak memory, measured by separate runs as tracing slows the scan down """
+    start = time.perf_counter()
+    result = scan(path)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    scan(path)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description='upload tree scanning benchmark')
+    parser.add_argument('--path', default=None, help='existing tree to scan, a synthetic one is built otherwise')
+    parser.add_argument('--files', type=int, default=1000000, help='number of files of the synthetic tree')
+    parser.add_argument('--per-folder', type=int, default=1000, help='number of files per synthetic tree folder')
+    args = parser.parse_args()
+
+    path = args.path
+    if not path:
+        path = tempfile.mkdtemp(prefix='bench_scan_')
+        print('Building {} files tree in {}'.format(args.files, path))
+        make_tree(path, files=args.files, per_folder=args.per_folder)
+    try:
+        # warming up file system cache
+        scandir_scan(path)
+        for name, scan in (('os.walk', walk_scan), ('os.scandir', scandir_scan)):
+            (files_num, size), elapsed, peak = measure(scan, path)
+            print('{:>10}: {} files, {} bytes, {:.2f} s, peak memory {:.1f} MB'.format(
+                name, files_num, size, elapsed, peak / 1024 / 1024))
+        if not args.path:
+            # the removal runs once, it is not traced as tracing slows it down
+            start = time.perf_counter()
+            upload.remove_empty_folders(path)
+            print('{:>10}: empty folders removed in {:.2f} s'.format('cleanup', time.perf_counter() - start))
+    finally:
+        if not args.path:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
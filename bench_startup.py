@@ -0,0 +1,95 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Created: 2026-10-18
+
+@author: pymancer
+
+cold start benchmark of the runs with nothing to upload, i.e. scheduled every minute
+- sets up a configuration in a temporary folder with an empty upload folder,
+  or with the given number of files already recorded in the manifest as uploaded
+- runs the uploader from shell there a number of times, each run is a fresh interpreter
+- reports the run times against the bare interpreter start and the network modules loaded by the run,
+  which should be none, no cloud requests are made either
+
+example run (from shell):
+python bench_startup.py --runs 20 --files 1000
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+import subprocess
+import upload
+
+UPLOADER = os.path.abspath(upload.__file__)
+NETWORK_MODULES = ('ssl', 'asyncio', 'requests', 'aiohttp')
+# runs the uploader as 'python -m upload' does (compiled module is cached),
+# then lists the network modules it has actually loaded (not just lazily imported)
+RUNNER = '''
+import sys, types, runpy
+sys.argv = [{uploader!r}]
+sys.path.insert(0, {uploader_dir!r})
+runpy.run_module('upload', run_name='__main__', alter_sys=True)
+print('loaded:', ','.join(name for name in {modules!r}
+                          if name in sys.modules and type(sys.modules[name]) is types.ModuleType))
+'''
+
+
+def set_up(path, files_num):
+    """ writes the configuration and the upload folder with files_num files recorded as uploaded """
+    upload_dir = os.path.join(path, 'upload')
+    os.makedirs(upload_dir)
+    with open(os.path.join(path, '.config'), 'w') as f:
+        f.write('[Credentials]\nEmail : bench@mail.ru\nPassword : bench\n\n'
+                '[Locations]\nUploadPath : ./upload\nMetricsFile : ./metrics.json\n\n'
+                '[Behaviour]\nRemoveUploaded : no\nMoveUploaded : no\nSkipUnchanged : yes\n')
+    # manifest keys are relative to the upload folder
+    with upload.UploadManifest(db_file=os.path.join(path, '.manifest'), base=upload_dir) as manifest:
+        for index in range(files_num):
+            file = os.path.join(upload_dir, 'file_{}.txt'.format(index))
+            open(file, 'w').close()
+            manifest.add(file)
+
+
+def measure(command, cwd, runs):
+    """ returns (run times, last run output) of the command """
+    times = []
+    for __ in range(runs):
+        start = time.perf_counter()
+        output = subprocess.run(command, cwd=cwd, check=True, stdout=subprocess.PIPE,
+                                universal_newlines=True).stdout
+        times.append(time.perf_counter() - start)
+    return times, output
+
+
+def report(name, times):
+    print('{:>12}: min {:.3f} s, median {:.3f} s'.format(name, min(times), statistics.median(times)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='cold start benchmark of the runs with nothing to upload')
+    parser.add_argument('--runs', type=int, default=10, help='number of runs')
+    parser.add_argument('--files', type=int, default=0, help='number of files already uploaded and unchanged')
+    args = parser.parse_args()
+
+    path = tempfile.mkdtemp(prefix='bench_startup_')
+    try:
+        set_up(path, args.files)
+        interpreter, __ = measure([sys.executable, '-c', 'pass'], path, args.runs)
+        uploader, output = measure([sys.executable, '-c', RUNNER.format(uploader=UPLOADER, uploader_dir=os.path.dirname(UPLOADER),
+                                                                       modules=NETWORK_MODULES)],
+                                   path, args.runs)
+        report('interpreter', interpreter)
+        report('uploader', uploader)
+        for line in output.splitlines():
+            print('{:>12}  {}'.format('', line))
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Created: 2026-10-18
+
+@author: pymancer
+
+end-to-end upload throughput benchmark against the local cloud stand-in (mock_cloud.py)
+- builds synthetic trees in a temporary folder: many small files, a few huge files and a mix of both,
+  unless existing one is given
+- uploads each tree by each engine to a fresh stand-in served by a separate process,
+  with injected latency, bandwidth limit and errors if asked
+- reports files/s of uploaded files, MB/s of posted data and time spent in each upload phase (from the uploader's metrics),
+  phase time is summed over simultaneous calls, so it could exceed the elapsed time
+- uploaded files are kept in place, the uploader's state files are written to the temporary folder
+- 'aiohttp' module is required
+
+example run (from shell):
+python bench_upload.py --scenarios small,mixed --engines sync,async --latency 0.02
+python bench_upload.py --path /mnt/data/upload --engines async --bandwidth 10240
+"""
+import os
+import time
+import json
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+from urllib.request import urlopen
+import upload
+import mock_cloud
+
+SCENARIOS = ('small', 'huge', 'mixed')
+FOLDER_FILES = 100 # number of files per synthetic tree folder
+BLOCK_SIZE = 1024 * 1024 # random block repeated by huge files
+
+
+def write_file(file, size):
+    with open(file, 'wb') as f:
+        block = os.urandom(min(size, BLOCK_SIZE))
+        while size > 0:
+            f.write(block[:size])
+            size -= len(block)
+
+
+def make_tree(path, sizes):
+    """ creates files of the given sizes, FOLDER_FILES files per folder """
+    for index, size in enumerate(sizes):
+        folder = os.path.join(path, 'folder_{}'.format(index // FOLDER_FILES))
+        os.makedirs(folder, exist_ok=True)
+        write_file(os.path.join(folder, 'file_{}.bin'.format(index)), size)
+
+
+def get_sizes(scenario, args):
+    """ returns file sizes (bytes) of the scenario tree """
+    small = [args.small_size * 1024] * args.small_files
+    huge = [args.huge_size * 1024 * 1024] * args.huge_files
+    if scenario == 'small':
+        return small
+    if scenario == 'huge':
+        return huge
+    # half of the small files, some medium ones and the half of the huge ones
+    medium = [1024 * 1024] * (args.small_files // 20)
+    return small[:len(small) // 2] + medium + huge[:max(1, len(huge) // 2)]
+
+
+def start_cloud(args):
+    """ serves the stand-in by a separate process, returns (process, url) """
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=mock_cloud.serve, args=(queue, ), daemon=True,
+                              kwargs={'latency': args.latency, 'bandwidth': args.bandwidth,
+                                      'error_rate': args.error_rate, 'keep_contents': False,
+                                      'space': 1024 * 1024, 'nodes': args.nodes})
+    process.start()
+    return process, queue.get(timeout=30)
+
+
+def set_up(path, state_dir, url, args):
+    """ points the uploader to the tree, the stand-in and the temporary state files """
+    settings = {'IS_CONFIG_PRESENT': True, 'LOGIN': 'bench@mail.ru', 'PASSWORD': 'bench',
+                'CONFIG_FILE': os.path.join(state_dir, '.config'), 'LOG_FILE': os.path.join(state_dir, 'upload.log'),
+                'MANIFEST_FILE': os.path.join(state_dir, '.manifest'),
+                'JOURNAL_FILE': os.path.join(state_dir, '.journal'),
+                'SESSION_FILE': os.path.join(state_dir, '.session'),
+                'FOLDERS_FILE': os.path.join(state_dir, '.folders'),
+                'METRICS_FILE': os.path.join(state_dir, 'metrics.json'), 'PROMETHEUS_FILE': '',
+                'UPLOAD_PATH': path, 'CLOUD_PATH': '/bench', 'ARCHIVE_FILES': args.archive,
+                'MOVE_UPLOADED': False, 'REMOVE_UPLOADED': False, 'SKIP_UNCHANGED': False, 'SKIP_EXISTING': False,
+                'SPLIT_LARGE': True, 'BUNDLE_FILES': args.bundle, 'UPLOAD_WORKERS': args.workers, 'ASYNC_LIMIT': args.async_limit,
+                'AUTH_URL': url + '/auth', 'CLOUD_URL': url + '/api/v2/'}
+    for name, value in settings.items():
+        setattr(upload, name, value)
+
+
+def run(path, engine, args):
+    """ uploads the tree to a fresh stand-in, returns (elapsed, stand-in stats, run metrics) """
+    process, url = start_cloud(args)
+    state_dir = tempfile.mkdtemp(prefix='bench_upload_state_')
+    try:
+        set_up(path, state_dir, url, args)
+        start = time.perf_counter()
+        upload.main(engine=engine)
+        elapsed = time.perf_counter() - start
+        with urlopen(url + '/stats') as r:
+            stats = json.loads(r.read().decode())
+    finally:
+        process.terminate()
+        process.join()
+        shutil.rmtree(state_dir, ignore_errors=True)
+    return elapsed, stats, upload.METRICS.to_dict()
+
+
+def report(name, engine, elapsed, stats, metrics):
+    megabytes = stats['posted_bytes'] / 1024 / 1024
+    files_num = metrics['values'].get('uploaded_files', 0)
+    print('{:>8} {:>6}: {} files ({} cloud objects), {:.1f} MB in {:.2f} s, {:.1f} files/s, {:.2f} MB/s, '
+          '{} requests, {} errors'.format(name, engine, files_num, stats['added_files'], megabytes, elapsed,
+                                          files_num / elapsed, megabytes / elapsed, stats['requests'],
+                                          stats['errors']))
+    phases = ', '.join('{} {:.2f} s/{}'.format(phase, phase_stats['seconds'], phase_stats['calls'])
+                       for phase, phase_stats in metrics['phases'].items())
+    print('{:>17} {}'.format('phases:', phases))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='end-to-end upload throughput benchmark')
+    parser.add_argument('--path', default=None, help='existing tree to upload instead of the synthetic ones')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='synthetic trees: small, huge, mixed')
+    parser.add_argument('--engines', default=','.join(upload.ENGINES), help='upload engines: sync, async')
+    parser.add_argument('--small-files', type=int, default=2000, help='number of small files')
+    parser.add_argument('--small-size', type=int, default=4, help='small file size, kilobytes')
+    parser.add_argument('--huge-files', type=int, default=2, help='number of huge files')
+    parser.add_argument('--huge-size', type=int, default=256, help='huge file size, megabytes')
+    parser.add_argument('--workers', type=int, default=upload.UPLOAD_WORKERS, help='sync engine upload workers')
+    parser.add_argument('--async-limit', type=int, default=upload.ASYNC_LIMIT, help='async engine requests limit')
+    parser.add_argument('--archive', action='store_true',
+                        help='archive files before upload, archives replace the files of the tree')
+    parser.add_argument('--bundle', action='store_true', help='bundle small files of each folder')
+    parser.add_argument('--latency', type=float, default=0, help='stand-in response latency, seconds')
+    parser.add_argument('--bandwidth', type=int, default=0, help='stand-in posted kilobytes per second, 0 - unlimited')
+    parser.add_argument('--error-rate', type=float, default=0, help='share of stand-in responses replaced by errors')
+    parser.add_argument('--nodes', type=int, default=1, help='number of stand-in upload nodes')
+    args = parser.parse_args()
+
+    engines = args.engines.split(',')
+    if args.path:
+        for engine in engines:
+            report('tree', engine, *run(args.path, engine, args))
+        return
+    for scenario in args.scenarios.split(','):
+        path = tempfile.mkdtemp(prefix='bench_upload_')
+        try:
+            sizes = get_sizes(scenario, args)
+            print('Building {} tree: {} files, {:.1f} MB'.format(scenario, len(sizes), sum(sizes) / 1024 / 1024))
+            make_tree(path, sizes)
+            for index, engine in enumerate(engines):
+                # archived files are replaced, the next engine gets the original tree
+                if args.archive and index:
+                    shutil.rmtree(path)
+                    make_tree(path, sizes)
+                report(scenario, engine, *run(path, engine, args))
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,8 +7,11 @@ Created: 2016-08-13
 
 changing testing behaviour
 - allowing tests to use shell parameters
+- sharing the main loop environment between test modules
 """
+import os
 import pytest
+import shutil
 from uuid import uuid1
 
 
@@ -36,4 +39,117 @@ def rundirty(request):
 
 
 def get_unique_string():
-    return uuid1().urn[9:]
\ No newline at end of file
+    return uuid1().urn[9:]
+
+
+@pytest.fixture(scope='function')
+def upload_tearup(request, monkeypatch):
+    """ preparing testing environment - pretty obvious, isn't it?
+    - creating directory tree with files to upload,
+    - setting up config
+    - faking cloud functions responses
+    - setting up logging
+    tree structure:
+    ./upload_dir/l0_1.txt
+    ./upload_dir/l0_2.txt
+    ./upload_dir/level1_1/l1_1_1.txt
+    ./upload_dir/level1_1/level2_1/l2_1_1.txt
+    ./upload_dir/level1_1/level2_2/level3_1/l3_1_1.txt
+    ./upload_dir/level1_2/l1_2_1.txt
+    ./upload_dir/level1_2/l1_2_2.txt
+    """
+    # creating tree
+    upload_dir = os.path.join('.', 'test_upload_' + get_unique_string())
+    os.makedirs(upload_dir)
+    open(os.path.join(upload_dir, 'l0_1.txt'), 'w').close()
+    open(os.path.join(upload_dir, 'l0_2.txt'), 'w').close()
+    dir = os.path.join(upload_dir, 'level1_1')
+    os.makedirs(dir)
+    open(os.path.join(dir, 'l1_1_1.txt'), 'w').close()
+    dir = os.path.join(dir, 'level2_1')
+    os.makedirs(dir)
+    open(os.path.join(dir, 'l2_1_1.txt'), 'w').close()
+    dir = os.path.join(dir, 'level2_2/level3_1')
+    os.makedirs(dir)
+    open(os.path.join(dir, 'l3_1_1.txt'), 'w').close()
+    dir = os.path.join(upload_dir, 'level1_2')
+    os.makedirs(dir)
+    open(os.path.join(dir, 'l1_2_1.txt'), 'w').close()
+    open(os.path.join(dir, 'l1_2_2.txt'), 'w').close()
+    # setting up config (writing a file? why? it will not be applied anyway)
+    config_file = os.path.join('.', 'test_config_' + get_unique_string())
+    uploaded_dir = os.path.join('.', 'test_uploaded_' + get_unique_string())
+    with open(config_file, 'w') as f:
+        f.write("""[Credentials]
+Email : some_email@mail.ru
+Password : some_pass
+
+[Locations]
+UploadedPath : {}
+CloudPath : /backups
+UploadPath : {}
+
+[Behaviour]
+MoveUploaded : yes
+RemoveUploaded : yes
+ArchiveFiles : no
+RemoveFolders: yes""".format(uploaded_dir, upload_dir))
+    monkeypatch.setattr('upload.IS_CONFIG_PRESENT', True)
+    monkeypatch.setattr('upload.CONFIG_FILE', config_file)
+    monkeypatch.setattr('upload.UPLOAD_PATH', upload_dir)
+    monkeypatch.setattr('upload.UPLOADED_PATH', uploaded_dir)
+    # setup uploader behaviour here to test desired combination (default: True, True, False, True)
+    monkeypatch.setattr('upload.ARCHIVE_FILES', True)
+    monkeypatch.setattr('upload.REMOVE_UPLOADED', True)
+    monkeypatch.setattr('upload.MOVE_UPLOADED', False)
+    monkeypatch.setattr('upload.REMOVE_FOLDERS', True)
+    monkeypatch.setattr('upload.HASH_FIRST', False)
+    # files of the tree are empty, archiving is not estimated
+    monkeypatch.setattr('upload.COMPRESS_SAMPLE', 0)
+    # faking cloud functions responses
+    def cloud_auth(session, login=None, password=None):
+        return True
+    monkeypatch.setattr('upload.cloud_auth', cloud_auth)
+    def get_csrf(session):
+        return 'fake_csrf'
+    monkeypatch.setattr('upload.get_csrf', get_csrf)
+    def get_upload_nodes(session, csrf=''):
+        return ['fake_upload_domain']
+    monkeypatch.setattr('upload.get_upload_nodes', get_upload_nodes)
+    def get_cloud_space(session, csrf='', login=None):
+        return 1*1024*1024*1024
+    monkeypatch.setattr('upload.get_cloud_space', get_cloud_space)
+    def post_file(session, domain='', file='', login=None, nodes=None):
+        return ('1234567890123456789012345678901234567890', 100)
+    monkeypatch.setattr('upload.post_file', post_file)
+    def add_file(session, file='', hash='', size=0, csrf='', log_errors=True):
+        return True
+    monkeypatch.setattr('upload.add_file', add_file)
+    def create_folder(session, folder='', csrf=''):
+        return True
+    monkeypatch.setattr('upload.create_folder', create_folder)
+    # setting up logging
+    log_file = os.path.join('.', 'test_log_' + get_unique_string())
+    monkeypatch.setattr('upload.LOG_FILE', log_file)
+    manifest_file = os.path.join('.', 'test_manifest_' + get_unique_string())
+    monkeypatch.setattr('upload.MANIFEST_FILE', manifest_file)
+    journal_file = os.path.join('.', 'test_journal_' + get_unique_string())
+    monkeypatch.setattr('upload.JOURNAL_FILE', journal_file)
+    session_file = os.path.join('.', 'test_session_' + get_unique_string())
+    monkeypatch.setattr('upload.SESSION_FILE', session_file)
+    folders_file = os.path.join('.', 'test_folders_' + get_unique_string())
+    monkeypatch.setattr('upload.FOLDERS_FILE', folders_file)
+    metrics_file = os.path.join('.', 'test_metrics_' + get_unique_string())
+    monkeypatch.setattr('upload.METRICS_FILE', metrics_file)
+    monkeypatch.setattr('upload.BACKOFF_BASE', 0)
+    def upload_teardown():
+        shutil.rmtree(upload_dir)
+        os.unlink(config_file)
+        shutil.rmtree(uploaded_dir, ignore_errors=True)
+        os.unlink(log_file)
+        if os.path.exists(manifest_file):
+            os.unlink(manifest_file)
+        for file in (journal_file, session_file, folders_file, metrics_file):
+            if os.path.exists(file):
+                os.unlink(file)
+    request.addfinalizer(upload_teardown)
\ No newline at end of file
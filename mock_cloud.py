@@ -0,0 +1,290 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Created: 2026-10-18
+
+@author: pymancer
+
+local cloud stand-in for testing and benchmarking without a cloud account
+- serves the endpoints used by the uploader: auth, tokens/csrf, dispatcher, user/space, upload domain post,
+  file/add, folder/add, file/remove and folder listing
+- injects response latency, limits posted bandwidth and answers with random retryable errors if asked
+- GET /stats returns requests and posted data counters
+- 'aiohttp' module is required
+
+example run (from shell):
+python mock_cloud.py --port 8080 --latency 0.05 --bandwidth 10240 --error-rate 0.01
+"""
+import time
+import random
+import asyncio
+import hashlib
+import argparse
+import threading
+from aiohttp import web
+
+CSRF = 'c' * 32
+ERROR_CODES = (429, 500, 502, 503, 504) # injected errors, retryable by the uploader
+CHUNK_SIZE = 64 * 1024 # posted data read size
+
+
+def get_cloud_hash(data):
+    if len(data) < 21:
+        return data.ljust(20, b'\0').hex().upper()
+    return hashlib.sha1(b'mrCloud' + data + str(len(data)).encode()).hexdigest().upper()
+
+
+class CloudHash():
+    """ cloud hash of the data fed by chunks """
+    def __init__(self):
+        self.sha1 = hashlib.sha1(b'mrCloud')
+        self.head = b''
+        self.size = 0
+
+    def update(self, chunk):
+        if self.size < 21:
+            self.head += chunk[:21]
+        self.sha1.update(chunk)
+        self.size += len(chunk)
+
+    def hexdigest(self):
+        if self.size < 21:
+            return get_cloud_hash(self.head)
+        self.sha1.update(str(self.size).encode())
+        return self.sha1.hexdigest().upper()
+
+
+class MockCloud():
+    """ minimal cloud stand-in, records posted files and cloud objects
+    param: latency - seconds added to each response
+    param: bandwidth - posted kilobytes per second shared by all uploads, 0 - unlimited
+    param: error_rate - share of the requests answered by random ERROR_CODES status instead
+    param: keep_contents - if False only hashes of posted files are kept, to post huge files
+    param: space - total cloud space, megabytes, account_space overrides it by account email
+    param: nodes - number of upload nodes returned by the dispatcher, /upload/ and /upload/<1..nodes-1>/
+    """
+    def __init__(self, latency=0, bandwidth=0, error_rate=0, keep_contents=True, space=1024, nodes=1):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.keep_contents = keep_contents
+        self.total = space
+        self.nodes = nodes
+        # upload nodes ('0' - /upload/) answering 503 to posts, and the numbers of posted files by node
+        self.failing_nodes = set()
+        self.node_posts = {}
+        self.posted = []
+        self.contents = {}
+        self.hashes = set()
+        self.added = {}
+        self.folders = set()
+        # statuses of the next responses to the upload requests
+        self.failures = []
+        # changing the session value logs out all the clients
+        self.session = 'logged_in'
+        self.logins = 0
+        # emails of the logged in accounts and the numbers of posted files by account
+        self.emails = []
+        self.account_posts = {}
+        self.account_space = {}
+        self.listed = []
+        self.stats = {'requests': 0, 'errors': 0, 'posted_files': 0, 'posted_bytes': 0, 'added_files': 0,
+                      'added_bytes': 0}
+        # time the shared upload link is busy until
+        self.busy_until = 0.0
+        self.loop = asyncio.new_event_loop()
+        self.runner = None
+        self.url = None
+
+    def app(self):
+        app = web.Application(middlewares=[self.inject])
+        app.router.add_post('/auth', self.auth)
+        app.router.add_get('/api/v2/tokens/csrf', self.csrf)
+        app.router.add_get('/api/v2/dispatcher', self.dispatcher)
+        app.router.add_get('/api/v2/user/space', self.space)
+        app.router.add_post('/upload/', self.upload)
+        app.router.add_post('/upload/{node}/', self.upload)
+        app.router.add_post('/api/v2/file/add', self.file_add)
+        app.router.add_post('/api/v2/folder/add', self.folder_add)
+        app.router.add_post('/api/v2/file/remove', self.file_remove)
+        app.router.add_get('/api/v2/folder', self.folder)
+        app.router.add_get('/stats', self.get_stats)
+        return app
+
+    @web.middleware
+    async def inject(self, request, handler):
+        """ delays responses and replaces some of them with errors """
+        if request.path == '/stats':
+            return await handler(request)
+        self.stats['requests'] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.error_rate and random.random() < self.error_rate:
+            self.stats['errors'] += 1
+            return web.Response(status=random.choice(ERROR_CODES))
+        return await handler(request)
+
+    async def throttle(self, size):
+        """ waits until size bytes could pass the shared upload link """
+        if self.bandwidth <= 0:
+            return
+        now = time.monotonic()
+        self.busy_until = max(now, self.busy_until) + size / (self.bandwidth * 1024)
+        await asyncio.sleep(self.busy_until - now)
+
+    async def auth(self, request):
+        self.logins += 1
+        self.emails.append((await request.post()).get('Login'))
+        response = web.Response(text='{"storages": {}}')
+        response.set_cookie('sdcs', self.session)
+        return response
+
+    def authorized(self, request):
+        return request.cookies.get('sdcs') == self.session
+
+    async def csrf(self, request):
+        if not self.authorized(request):
+            return web.json_response({'body': {}}, status=403)
+        return web.json_response({'body': {'token': CSRF}})
+
+    async def dispatcher(self, request):
+        nodes = [{'url': self.url + '/upload/'}]
+        nodes += [{'url': '{}/upload/{}/'.format(self.url, node)} for node in range(1, self.nodes)]
+        return web.json_response({'body': {'upload': nodes}})
+
+    async def space(self, request):
+        used = 24 + self.stats['added_bytes'] // 1024 // 1024
+        total = self.account_space.get(request.query.get('email'), self.total)
+        return web.json_response({'body': {'total': total, 'used': used}})
+
+    async def upload(self, request):
+        node = request.match_info.get('node', '0')
+        if self.failures:
+            return web.Response(status=self.failures.pop(0))
+        if node in self.failing_nodes:
+            return web.Response(status=503)
+        reader = await request.multipart()
+        part = await reader.next()
+        hash = CloudHash()
+        data = bytearray()
+        while True:
+            chunk = await part.read_chunk(CHUNK_SIZE)
+            if not chunk:
+                break
+            await self.throttle(len(chunk))
+            hash.update(chunk)
+            if self.keep_contents:
+                data += chunk
+        self.posted.append(part.filename)
+        self.node_posts[node] = self.node_posts.get(node, 0) + 1
+        email = request.query.get('x-email')
+        self.account_posts[email] = self.account_posts.get(email, 0) + 1
+        if self.keep_contents:
+            self.contents[part.filename] = bytes(data)
+        digest = hash.hexdigest()
+        self.hashes.add(digest)
+        self.stats['posted_files'] += 1
+        self.stats['posted_bytes'] += hash.size
+        return web.Response(text='{};{}\r\n'.format(digest, hash.size))
+
+    async def file_add(self, request):
+        data = await request.post()
+        if data['token'] != CSRF or not self.authorized(request):
+            return web.json_response({'body': {}}, status=403)
+        if data['hash'] not in self.hashes:
+            return web.json_response({'body': {'home': {'error': 'unknown'}}}, status=400)
+        if data['home'] in self.added:
+            return web.json_response({'body': {'home': {'error': 'exists'}}}, status=400)
+        self.added[data['home']] = (data['hash'], int(data['size']))
+        self.stats['added_files'] += 1
+        self.stats['added_bytes'] += int(data['size'])
+        return web.json_response({'body': data['home']})
+
+    async def folder_add(self, request):
+        data = await request.post()
+        if not self.authorized(request):
+            return web.json_response({'body': {}}, status=403)
+        self.folders.add(data['home'])
+        return web.json_response({'body': data['home']})
+
+    async def file_remove(self, request):
+        data = await request.post()
+        if data['token'] != CSRF or not self.authorized(request):
+            return web.json_response({'body': {}}, status=403)
+        home = data['home']
+        if home not in self.added and home not in self.folders:
+            return web.json_response({'body': {'home': {'error': 'not_exists'}}}, status=404)
+        inside = lambda obj: obj == home or obj.startswith(home.rstrip('/') + '/')
+        for file in [file for file in self.added if inside(file)]:
+            self.stats['added_bytes'] -= self.added.pop(file)[1]
+        self.folders = {folder for folder in self.folders if not inside(folder)}
+        return web.json_response({'body': home})
+
+    async def folder(self, request):
+        if not self.authorized(request):
+            return web.json_response({'body': {}}, status=403)
+        home, offset, limit = request.query['home'], int(request.query['offset']), int(request.query['limit'])
+        self.listed.append((home, offset))
+        if home not in self.folders:
+            return web.json_response({'body': {'home': {'error': 'not_exists'}}}, status=404)
+        entries = [{'kind': 'folder', 'name': folder.rsplit('/', 1)[1], 'home': folder}
+                   for folder in sorted(self.folders) if folder.rsplit('/', 1)[0] == home]
+        entries += [{'kind': 'file', 'name': file.rsplit('/', 1)[1], 'home': file, 'hash': hash, 'size': size}
+                    for file, (hash, size) in sorted(self.added.items()) if file.rsplit('/', 1)[0] == home]
+        count = {'folders': sum(entry['kind'] == 'folder' for entry in entries),
+                 'files': sum(entry['kind'] == 'file' for entry in entries)}
+        return web.json_response({'body': {'count': count, 'list': entries[offset:offset + limit]}})
+
+    async def get_stats(self, request):
+        return web.json_response(self.stats)
+
+    def start(self, host='127.0.0.1', port=0):
+        """ serves in a background thread, sets url """
+        async def setup():
+            self.runner = web.AppRunner(self.app())
+            await self.runner.setup()
+            site = web.TCPSite(self.runner, host, port)
+            await site.start()
+            self.url = 'http://{}:{}'.format(host, self.runner.addresses[0][1])
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        asyncio.run_coroutine_threadsafe(setup(), self.loop).result()
+
+    def stop(self):
+        async def cleanup():
+            await self.runner.cleanup()
+            # dropping handlers of the client keep-alive connections
+            tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        asyncio.run_coroutine_threadsafe(cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+def serve(queue=None, host='127.0.0.1', port=0, **options):
+    """ serves until the process is terminated, puts the server url to the queue if any """
+    cloud = MockCloud(**options)
+    cloud.start(host=host, port=port)
+    if queue is None:
+        print('Serving on {}, upload.AUTH_URL: {}/auth, upload.CLOUD_URL: {}/api/v2/'.format(cloud.url, cloud.url,
+                                                                                           cloud.url))
+    else:
+        queue.put(cloud.url)
+    threading.Event().wait()
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='local cloud stand-in')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=8080, help='port to listen on')
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to each response')
+    parser.add_argument('--bandwidth', type=int, default=0, help='posted kilobytes per second, 0 - unlimited')
+    parser.add_argument('--error-rate', type=float, default=0, help='share of requests answered by errors')
+    return parser.parse_args(args)
+
+
+if __name__ == '__main__':
+    try:
+        serve(**vars(parse_args()), keep_contents=False)
+    except KeyboardInterrupt:
+        pass
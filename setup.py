@@ -21,7 +21,7 @@ from upload import __version__
 
 options = {
     'build_exe': {
-        'packages': ['requests', 'requests_toolbelt'],
+        'packages': ['requests'],
         'include_files' : [(requests.certs.where(), 'cacert.pem')]
     }
 }
@@ -0,0 +1,464 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Created: 2026-10-18
+
+@author: pymancer
+
+testing asyncio upload engine
+- no cloud connection required, a local aiohttp server (mock_cloud.py) stands in for the cloud
+- skipped if aiohttp is not installed
+
+example run (from shell):
+py.test test_async_engine.py
+"""
+import io
+import os
+import json
+import asyncio
+import zipfile
+import pytest
+
+aiohttp = pytest.importorskip('aiohttp')
+import upload
+from mock_cloud import CSRF, MockCloud, get_cloud_hash
+
+CLOUD_FUNCS = {name: getattr(upload, name) for name in ('cloud_auth', 'get_csrf', 'get_upload_nodes', 'get_cloud_space',
+                                                        'post_file', 'add_file', 'create_folder')}
+
+
+@pytest.fixture(scope='function')
+def stand_in(request, monkeypatch):
+    server = MockCloud()
+    server.start()
+    request.addfinalizer(server.stop)
+    monkeypatch.setattr('upload.AUTH_URL', server.url + '/auth')
+    monkeypatch.setattr('upload.CLOUD_URL', server.url + '/api/v2/')
+    return server
+
+
+@pytest.fixture(scope='function')
+def real_cloud_funcs(upload_tearup, stand_in, monkeypatch):
+    """ restores the cloud functions faked by upload_tearup, so uploads reach the stand-in cloud """
+    for name, func in CLOUD_FUNCS.items():
+        monkeypatch.setattr(upload, name, func)
+
+
+def test_async_handshake(stand_in):
+    import upload
+
+    async def handshake():
+        async with upload.get_async_session() as s:
+            csrf = await upload.async_get_cloud_csrf(s, login='some_email@mail.ru', password='some_pass')
+            domain = await upload.async_get_upload_domain(s, csrf=csrf)
+            space = await upload.async_get_cloud_space(s, csrf=csrf, login='some_email@mail.ru')
+        return csrf, domain, space
+    csrf, domain, space = asyncio.run(handshake())
+    assert csrf == CSRF
+    assert domain == stand_in.url + '/upload/'
+    assert space == 1000 * 1024 * 1024
+
+
+def test_async_post_and_add_file(stand_in, tmpdir):
+    import upload
+    file = tmpdir.join('async file.txt')
+    file.write('mail.ru-uploader test file contents')
+
+    async def post_and_add():
+        async with upload.get_async_session() as s:
+            hash, size = await upload.async_post_file(s, domain=stand_in.url + '/upload/', file=str(file))
+            added = await upload.async_add_file(s, file='/async file.txt', hash=hash, size=size, csrf=CSRF)
+        return hash, size, added
+    hash, size, added = asyncio.run(post_and_add())
+    assert size == len('mail.ru-uploader test file contents')
+    assert added
+    assert stand_in.added['/async file.txt'] == (hash, size)
+
+
+def test_async_main_loop(upload_tearup, stand_in, capsys):
+    import upload
+    upload.main(engine='async')
+    out, err = capsys.readouterr()
+    assert '7 file(s) uploaded.' in out
+    assert len(stand_in.added) == 7
+    assert '/backups/level1_1/level2_1/level2_2/level3_1' in stand_in.folders
+
+
+def test_async_main_loop_hash_first(upload_tearup, stand_in, capsys, monkeypatch):
+    import upload
+    monkeypatch.setattr('upload.HASH_FIRST', True)
+    monkeypatch.setattr('upload.ARCHIVE_FILES', False)
+    # all test files are empty and the cloud already knows empty contents
+    stand_in.hashes.add(get_cloud_hash(b''))
+    upload.main(engine='async')
+    out, err = capsys.readouterr()
+    assert '7 file(s) uploaded. Errors: 0.' in out
+    assert not stand_in.posted
+
+
+def test_async_post_archive(stand_in, tmpdir):
+    import upload
+    contents = b'mail.ru-uploader test file contents' * 10000
+    file = tmpdir.join('streamed.txt')
+    file.write_binary(contents)
+
+    async def post():
+        async with upload.get_async_session() as s:
+            return await upload.async_post_archive(s, domain=stand_in.url + '/upload/', file=str(file))
+    hash, size = asyncio.run(post())
+    archive = stand_in.contents['streamed.txt.zip']
+    assert (hash, size) == (get_cloud_hash(archive), len(archive))
+    with zipfile.ZipFile(io.BytesIO(archive)) as zf:
+        assert zf.read('streamed.txt') == contents
+
+
+def test_post_archive(stand_in, tmpdir):
+    """ chunked requests body should be accepted as well """
+    import upload
+    contents = b'mail.ru-uploader test file contents' * 10000
+    file = tmpdir.join('streamed.txt')
+    file.write_binary(contents)
+    with upload.get_session() as s:
+        hash, size = upload.post_archive(s, domain=stand_in.url + '/upload/', file=str(file))
+    archive = stand_in.contents['streamed.txt.zip']
+    assert (hash, size) == (get_cloud_hash(archive), len(archive))
+    assert not os.path.exists(str(file) + '.zip')
+
+
+def test_async_main_loop_stream_archives(upload_tearup, stand_in, capsys, monkeypatch):
+    import upload
+    monkeypatch.setattr('upload.STREAM_ARCHIVES', True)
+    upload.main(engine='async')
+    out, err = capsys.readouterr()
+    assert '7 file(s) uploaded. Errors: 0.' in out
+    assert '/backups/level1_2/l1_2_1.txt.zip' in stand_in.added
+
+
+def test_async_main_loop_split_large(upload_tearup, stand_in, capsys, monkeypatch):
+    import upload
+    monkeypatch.setattr('upload.SPLIT_LARGE', True)
+    monkeypatch.setattr('upload.MAX_FILE_SIZE', 2*1024*1024)
+    monkeypatch.setattr('upload.VOLUME_SIZE', 1)
+    contents = os.urandom(2*1024*1024 + 1000)
+    with open(os.path.join(upload.UPLOAD_PATH, 'large.bin'), 'wb') as f:
+        f.write(contents)
+    upload.main(engine='async')
+    out, err = capsys.readouterr()
+    assert '8 file(s) uploaded. Errors: 0.' in out
+    manifest = json.loads(stand_in.contents['large.bin.parts.json'].decode())
+    assert b''.join(stand_in.contents[volume['name']] for volume in manifest['volumes']) == contents
+    assert all(stand_in.added['/backups/' + volume['name']][0] == volume['hash'] for volume in manifest['volumes'])
+
+
+def test_post_file_retries(stand_in, tmpdir, monkeypatch):
+    """ posting should survive temporary upload errors of both engines """
+    import upload
+    monkeypatch.setattr('upload.BACKOFF_BASE', 0)
+    file = tmpdir.join('retried.txt')
+    file.write('mail.ru-uploader test file contents')
+    stand_in.failures = [503, 502]
+    with upload.get_session() as s:
+        hash, size = upload.post_file(s, domain=stand_in.url + '/upload/', file=str(file))
+    assert (hash, size) == (get_cloud_hash(b'mail.ru-uploader test file contents'), 35)
+    assert not stand_in.failures
+
+    async def post():
+        async with upload.get_async_session() as s:
+            return await upload.async_post_file(s, domain=stand_in.url + '/upload/', file=str(file))
+    stand_in.failures = [500]
+    assert asyncio.run(post()) == (hash, size)
+    stand_in.failures = [503] * (upload.RETRIES + 1)
+    assert asyncio.run(post()) == (None, None)
+
+
+def test_throttled_post_file(stand_in, tmpdir, monkeypatch):
+    """ throttled posts of both engines should deliver whole contents through the shared controller """
+    import upload
+    monkeypatch.setattr('upload.BACKOFF_BASE', 0)
+    monkeypatch.setattr('upload.LIMITER', upload.TokenBucket(rate=10 ** 6))
+    monkeypatch.setattr('upload.CONTROLLER', upload.ConcurrencyController(maximum=4))
+    contents = b'mail.ru-uploader test file contents' * 1000
+    file = tmpdir.join('throttled.txt')
+    file.write_binary(contents)
+    stand_in.failures = [503]
+    with upload.get_session() as s:
+        hash, size = upload.post_file(s, domain=stand_in.url + '/upload/', file=str(file))
+    assert (hash, size) == (get_cloud_hash(contents), len(contents))
+    assert upload.CONTROLLER.limit == 2
+
+    async def post():
+        async with upload.get_async_session() as s:
+            return await upload.async_post_file(s, domain=stand_in.url + '/upload/', file=str(file))
+    assert asyncio.run(post()) == (hash, size)
+    assert upload.CONTROLLER.in_flight == 0
+
+
+def test_post_file_body(stand_in, tmpdir):
+    """ files larger than the post buffer should be delivered intact by both engines, leaving no open files """
+    import upload
+    contents = os.urandom(upload.POST_BUFFER_SIZE * 3 + 1000)
+    file = tmpdir.join('buffered.bin')
+    file.write_binary(contents)
+    fds = len(os.listdir('/proc/self/fd')) if os.path.isdir('/proc/self/fd') else None
+    with upload.get_session() as s:
+        assert upload.post_file(s, domain=stand_in.url + '/upload/', file=str(file)) == (get_cloud_hash(contents),
+                                                                                         len(contents))
+        assert upload.post_volume(s, domain=stand_in.url + '/upload/', file=str(file), name='buffered.bin.002',
+                                  offset=1000, size=upload.POST_BUFFER_SIZE * 2)[1] == upload.POST_BUFFER_SIZE * 2
+    assert stand_in.contents['buffered.bin'] == contents
+    assert stand_in.contents['buffered.bin.002'] == contents[1000:1000 + upload.POST_BUFFER_SIZE * 2]
+    stand_in.contents.clear()
+
+    async def post():
+        async with upload.get_async_session() as s:
+            return await upload.async_post_file(s, domain=stand_in.url + '/upload/', file=str(file))
+    assert asyncio.run(post())[1] == len(contents)
+    assert stand_in.contents['buffered.bin'] == contents
+    if fds is not None:
+        assert len(os.listdir('/proc/self/fd')) == fds
+
+
+def test_add_file_refreshes_csrf(stand_in, tmpdir, monkeypatch):
+    """ expired csrf token should be replaced and the request repeated """
+    import upload
+    file = tmpdir.join('csrf.txt')
+    file.write('mail.ru-uploader test file contents')
+    with upload.get_session() as s:
+        assert upload.get_cloud_csrf(s) == CSRF
+        hash, size = upload.post_file(s, domain=stand_in.url + '/upload/', file=str(file))
+        assert upload.add_file(s, file='/csrf.txt', hash=hash, size=size, csrf='expired')
+    assert '/csrf.txt' in stand_in.added
+
+
+def test_async_refresh_csrf_once(stand_in, monkeypatch):
+    """ expired csrf token rejected by several tasks simultaneously should be refreshed once """
+    import upload
+    monkeypatch.setattr('upload.CSRF_TOKENS', {})
+
+    async def refresh():
+        async with upload.get_async_session() as s:
+            return await asyncio.gather(*(upload.async_refresh_csrf(s, csrf='expired') for __ in range(5)))
+    requests = stand_in.stats['requests']
+    assert asyncio.run(refresh()) == [CSRF] * 5
+    # the new session is not logged in: csrf rejected, auth, csrf
+    assert stand_in.logins == 1
+    assert stand_in.stats['requests'] == requests + 3
+
+
+@pytest.mark.parametrize('engine', ['sync', 'async'])
+def test_session_cache(upload_tearup, stand_in, real_cloud_funcs, capsys, monkeypatch, engine):
+    """ the next runs should reuse the session and log in again only if it is rejected """
+    import upload
+    upload.main(engine=engine)
+    out, err = capsys.readouterr()
+    assert '7 file(s) uploaded. Errors: 0.' in out
+    assert stand_in.logins == 1
+    assert os.path.isfile(upload.SESSION_FILE)
+    for name in ('cached.txt', 'relogged.txt'):
+        open(os.path.join(upload.UPLOAD_PATH, name), 'w').close()
+        upload.main(engine=engine)
+        out, err = capsys.readouterr()
+        assert '1 file(s) uploaded. Errors: 0.' in out
+        assert '/backups/' + name + '.zip' in stand_in.added
+        # the server forgets the session after the second run
+        stand_in.session = 'logged_in_again'
+    assert stand_in.logins == 2
+
+
+def test_async_watch(upload_tearup, stand_in, real_cloud_funcs, capsys, monkeypatch):
+    """ each upload of the watch mode should run its own event loop, reusing the session of the previous one """
+    import upload
+    monkeypatch.setattr('upload.WATCH_DEBOUNCE', 0)
+    monkeypatch.setattr('upload.WATCH_RESCAN', 0)
+    monkeypatch.setattr('upload.SESSION_LIFETIME', 0)
+    monkeypatch.setattr('upload.ADAPTIVE_CONCURRENCY', True)
+    # requests of both uploads wait for each other
+    monkeypatch.setattr('upload.get_controller', lambda maximum: upload.ConcurrencyController(maximum=1))
+    new_files = [os.path.join(upload.UPLOAD_PATH, 'new_{}.txt'.format(index)) for index in range(3)]
+
+    class Watcher():
+        overflowed = False
+        reads = 0
+
+        def read(self, timeout=None):
+            self.reads += 1
+            if self.reads > 1:
+                raise KeyboardInterrupt
+            for file in new_files:
+                open(file, 'w').close()
+            return new_files
+
+        def close(self):
+            pass
+
+    def get_watcher(path):
+        # files landing during the initial upload are watched too
+        assert not stand_in.posted
+        return Watcher()
+    monkeypatch.setattr('upload.get_watcher', get_watcher)
+    upload.main(engine='async', watch=True)
+    out, err = capsys.readouterr()
+    assert '10 file(s) uploaded. Errors: 0.' in out
+    assert stand_in.logins == 1
+
+
+@pytest.mark.parametrize('engine', ['sync', 'async'])
+def test_skip_existing(upload_tearup, stand_in, real_cloud_funcs, capsys, monkeypatch, engine):
+    """ files present in the cloud should be skipped before archiving and posting """
+    import upload
+    monkeypatch.setattr('upload.SKIP_EXISTING', True)
+    monkeypatch.setattr('upload.LISTING_LIMIT', 2)
+    stand_in.folders.update(('/backups', '/backups/level1_1', '/backups/level1_2'))
+    for file in ('/backups/l0_1.txt.zip', '/backups/other.txt', '/backups/level1_2/l1_2_2.txt.zip'):
+        stand_in.added[file] = ('0' * 40, 0)
+    upload.main(engine=engine)
+    out, err = capsys.readouterr()
+    assert '5 file(s) uploaded. Errors: 0.' in out
+    assert sorted(stand_in.posted) == ['l0_2.txt.zip', 'l1_1_1.txt.zip', 'l1_2_1.txt.zip', 'l2_1_1.txt.zip',
+                                       'l3_1_1.txt.zip']
+    # skipped files are neither archived nor removed
+    assert os.path.isfile(os.path.join(upload.UPLOAD_PATH, 'l0_1.txt'))
+    # root folder listing: 1 folder and 2 files by 2 entries per page
+    assert ('/backups', 2) in stand_in.listed
+
+
+def test_mock_cloud_injection(stand_in, tmpdir, monkeypatch):
+    """ injected latency, bandwidth limit and errors should reach the uploader """
+    import time
+    import upload
+    monkeypatch.setattr('upload.BACKOFF_BASE', 0)
+    file = tmpdir.join('injected.bin')
+    file.write_binary(b'x' * 100 * 1024)
+    with upload.get_session() as s:
+        stand_in.latency, stand_in.bandwidth = 0.2, 1000
+        start = time.monotonic()
+        hash, size = upload.post_file(s, domain=stand_in.url + '/upload/', file=str(file))
+        # latency plus about 0.1 s to pass 100 KB at 1000 KB/s
+        assert time.monotonic() - start >= 0.25
+        assert size == 100 * 1024
+        stand_in.latency, stand_in.bandwidth, stand_in.error_rate = 0, 0, 1
+        assert upload.post_file(s, domain=stand_in.url + '/upload/', file=str(file)) == (None, None)
+        assert stand_in.stats['errors'] == upload.RETRIES + 1
+        stand_in.error_rate = 0
+        assert upload.add_file(s, file='/injected.bin', hash=hash, size=size, csrf=CSRF)
+        assert upload.remove_object(s, obj='/injected.bin', csrf=CSRF)
+    assert not stand_in.added
+    assert stand_in.stats['posted_bytes'] == size
+
+
+@pytest.mark.parametrize('engine', ['sync', 'async'])
+def test_metrics_export(upload_tearup, stand_in, real_cloud_funcs, capsys, monkeypatch, tmpdir, engine):
+    """ each run should export phases, requests and compression metrics as JSON and Prometheus text """
+    import upload
+    with open(os.path.join(upload.UPLOAD_PATH, 'compressible.txt'), 'w') as f:
+        f.write('mail.ru-uploader ' * 1000)
+    prometheus_file = str(tmpdir.join('upload.prom'))
+    monkeypatch.setattr('upload.PROMETHEUS_FILE', prometheus_file)
+    upload.main(engine=engine)
+    out, err = capsys.readouterr()
+    assert '8 file(s) uploaded. Errors: 0.' in out
+    with open(upload.METRICS_FILE) as f:
+        metrics = json.load(f)
+    assert metrics['values'] == {'uploaded_files': 8, 'errors': 0, 'warnings': 0}
+    assert {'handshake', 'space', 'scan', 'folders', 'archive', 'post', 'add', 'dispose'} <= set(metrics['phases'])
+    assert metrics['phases']['post']['calls'] == 8
+    assert metrics['phases']['post']['bytes'] == sum(len(data) for data in stand_in.contents.values())
+    assert metrics['requests']['upload']['statuses'] == {'200': 8}
+    assert metrics['requests']['upload']['latency']['count'] == 8
+    compression = metrics['compression']
+    assert compression['files'] == 8
+    assert compression['ratio']['buckets']['0.1'] == 1
+    with open(prometheus_file) as f:
+        text = f.read()
+    assert 'mailru_uploader_phase_calls_total{phase="post"} 8\n' in text
+    assert 'mailru_uploader_requests_total{call="file/add",status="200"} 8\n' in text
+    assert 'mailru_uploader_request_duration_seconds_bucket{call="upload",le="+Inf"} 8\n' in text
+    assert 'mailru_uploader_compressed_files_total 8\n' in text
+
+
+@pytest.mark.parametrize('engine', ['sync', 'async'])
+def test_bundles(upload_tearup, stand_in, real_cloud_funcs, capsys, monkeypatch, engine):
+    """ bundles should hold the small files and their index, larger files should be uploaded as is """
+    import upload
+    monkeypatch.setattr('upload.BUNDLE_FILES', True)
+    monkeypatch.setattr('upload.BUNDLE_THRESHOLD', 8)
+    monkeypatch.setattr('upload.BUNDLE_SIZE', 1)
+    monkeypatch.setattr('upload.ARCHIVE_FILES', False)
+    folder = os.path.join(upload.UPLOAD_PATH, 'logs')
+    os.makedirs(folder)
+    contents = {}
+    for index in range(300):
+        contents['log_{}.txt'.format(index)] = 'log record {}\n'.format(index).encode() * 300
+        with open(os.path.join(folder, 'log_{}.txt'.format(index)), 'wb') as f:
+            f.write(contents['log_{}.txt'.format(index)])
+    with open(os.path.join(folder, 'large.bin'), 'wb') as f:
+        f.write(b'x' * 16 * 1024)
+    upload.main(engine=engine)
+    out, err = capsys.readouterr()
+    assert '308 file(s) uploaded. Errors: 0.' in out
+    assert '/backups/logs/large.bin' in stand_in.added
+    bundles = [name for name in stand_in.contents if name.startswith('bundle-') and name.endswith('.zip')]
+    members = {}
+    for name in bundles:
+        data = stand_in.contents[name]
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            index = json.loads(zf.read(upload.BUNDLE_INDEX).decode())['members']
+            assert [member['name'] for member in index] == [name for name in zf.namelist()
+                                                           if name != upload.BUNDLE_INDEX]
+            for member in index:
+                assert data[member['offset']:member['offset'] + 4] == b'PK\x03\x04'
+                members[member['name']] = zf.read(member['name'])
+    # the log files do not fit one megabyte bundle
+    assert len([name for name in bundles if name in [os.path.basename(file) for file in stand_in.added
+                                                     if file.startswith('/backups/logs/')]]) == 2
+    assert {name: members[name] for name in contents} == contents
+    assert not os.path.exists(folder)
+
+
+@pytest.mark.parametrize('engine', ['sync', 'async'])
+def test_upload_nodes(upload_tearup, stand_in, real_cloud_funcs, capsys, monkeypatch, engine):
+    """ posts should be spread over the upload nodes, routing around the failing one """
+    import upload
+    stand_in.nodes = 3
+    stand_in.failing_nodes.add('1')
+    upload.main(engine=engine)
+    out, err = capsys.readouterr()
+    assert '7 file(s) uploaded. Errors: 0.' in out
+    assert sorted(stand_in.node_posts) == ['0', '2']
+    with open(upload.SESSION_FILE) as f:
+        assert len(json.load(f)['nodes']) == 3
+
+
+@pytest.mark.parametrize('engine', ['sync', 'async'])
+def test_extra_accounts(upload_tearup, stand_in, real_cloud_funcs, capsys, monkeypatch, engine):
+    """ files should be spread over all the accounts, each logged in by its own session """
+    import sqlite3
+    import upload
+    monkeypatch.setattr('upload.REMOVE_UPLOADED', False)
+    monkeypatch.setattr('upload.ARCHIVE_FILES', False)
+    monkeypatch.setattr('upload.EXTRA_ACCOUNTS', [('other_email@mail.ru', 'other_pass'), ('bad_email', '')])
+    # the freest account takes the first file scanned, the only one of the root folder,
+    # the empty files go to the other account while that one is still being posted
+    stand_in.account_space['other_email@mail.ru'] = 2048
+    stand_in.bandwidth = 100
+    for name in ('l0_1.txt', 'l0_2.txt'):
+        os.unlink(os.path.join(upload.UPLOAD_PATH, name))
+    with open(os.path.join(upload.UPLOAD_PATH, 'large.bin'), 'wb') as f:
+        f.write(os.urandom(100 * 1024))
+    extra_session_file = upload.get_session_file('other_email@mail.ru')
+    try:
+        upload.main(engine=engine)
+        out, err = capsys.readouterr()
+        assert '6 file(s) uploaded. Errors: 0. Warnings: 1.' in out
+        assert sorted(stand_in.emails) == sorted(['other_email@mail.ru', upload.LOGIN])
+        assert stand_in.account_posts['other_email@mail.ru'] == 1
+        assert os.path.isfile(extra_session_file)
+        with sqlite3.connect(upload.MANIFEST_FILE) as db:
+            accounts = dict(db.execute('SELECT path, account FROM files'))
+        assert accounts == {'large.bin': 'other_email@mail.ru', 'level1_1/l1_1_1.txt': upload.LOGIN,
+                            'level1_1/level2_1/l2_1_1.txt': upload.LOGIN,
+                            'level1_1/level2_1/level2_2/level3_1/l3_1_1.txt': upload.LOGIN,
+                            'level1_2/l1_2_1.txt': upload.LOGIN, 'level1_2/l1_2_2.txt': upload.LOGIN}
+    finally:
+        if os.path.exists(extra_session_file):
+            os.unlink(extra_session_file)
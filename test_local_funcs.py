@@ -0,0 +1,524 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Created: 2026-10-18
+
+@author: pymancer
+
+testing local (not cloud related) functions
+- no cloud connection required
+
+example run (from shell):
+py.test test_local_funcs.py
+"""
+import io
+import os
+import json
+import zlib
+import hashlib
+import zipfile
+import pytest
+import upload
+
+
+def test_get_cloud_hash_small_file(tmpdir):
+    file = tmpdir.join('small.txt')
+    file.write_binary(b'tiny')
+    assert upload.get_cloud_hash(str(file)) == ('74696E79' + '0' * 32, 4)
+
+
+def test_get_cloud_hash(tmpdir):
+    contents = b'mail.ru-uploader test file contents' * 1000
+    file = tmpdir.join('large.txt')
+    file.write_binary(contents)
+    expected = hashlib.sha1(b'mrCloud' + contents + str(len(contents)).encode()).hexdigest().upper()
+    # chunk size should not affect the hash
+    assert upload.get_cloud_hash(str(file), chunk_size=1000) == (expected, len(contents))
+    assert upload.get_cloud_hash(str(file), chunk_size=7) == (expected, len(contents))
+
+
+def test_upload_manifest(tmpdir):
+    upload_dir = tmpdir.mkdir('upload')
+    file = upload_dir.mkdir('level1').join('file.txt')
+    file.write('contents')
+    with upload.UploadManifest(db_file=str(tmpdir.join('.manifest')), base=str(upload_dir)) as manifest:
+        assert manifest.get_key(str(file)) == 'level1/file.txt'
+        assert not manifest.is_unchanged(str(file))
+        manifest.add(str(file), 'A' * 40, account='some_email@mail.ru')
+        assert manifest.is_unchanged(str(file))
+    # persisted between runs
+    with upload.UploadManifest(db_file=str(tmpdir.join('.manifest')), base=str(upload_dir)) as manifest:
+        assert manifest.is_unchanged(str(file))
+        assert manifest.db.execute('SELECT account FROM files').fetchall() == [('some_email@mail.ru',)]
+        file.write('changed contents')
+        assert not manifest.is_unchanged(str(file))
+
+
+def test_archive_stream(tmpdir):
+    contents = b'mail.ru-uploader test file contents' * 10000
+    file = tmpdir.join('streamed.txt')
+    file.write_binary(contents)
+    stream = upload.ArchiveStream(str(file), chunk_size=4096)
+    chunks = list(stream)
+    assert all(chunks)
+    body = b''.join(chunks)
+    header, archive = body.split(b'\r\n\r\n', 1)
+    archive, footer = archive.rsplit(b'\r\n--', 1)
+    assert b'filename="streamed.txt.zip"' in header
+    assert footer == stream.boundary.encode() + b'--\r\n'
+    assert stream.size == len(archive) < len(contents)
+    with zipfile.ZipFile(io.BytesIO(archive)) as zf:
+        assert zf.namelist() == ['streamed.txt']
+        assert zf.read('streamed.txt') == contents
+
+
+def test_compressor(tmpdir, monkeypatch):
+    monkeypatch.setattr('upload.ARCHIVE_FILES', True)
+    # tiny files are not worth archiving by estimation
+    monkeypatch.setattr('upload.COMPRESS_SAMPLE', 0)
+    files = []
+    for i in range(5):
+        file = tmpdir.join('file_{}.txt'.format(i))
+        file.write('contents {}'.format(i))
+        files.append(str(file))
+    zipped = tmpdir.join('preserved.zip')
+    zipped.write('not really an archive')
+    files.append(str(zipped))
+    with upload.Compressor(workers=2, queue_size=2) as compressor:
+        archives = list(compressor.map(files))
+    assert archives == [file + '.zip' for file in files[:-1]] + [str(zipped)]
+    with zipfile.ZipFile(archives[3]) as zf:
+        assert zf.read('file_3.txt') == b'contents 3'
+    assert not any(os.path.exists(file) for file in files[:-1])
+
+
+def test_space_ledger():
+    ledger = upload.SpaceLedger(space=100, resync_every=2)
+    assert ledger.reserve('a', 60)
+    assert not ledger.reserve('b', 60)
+    ledger.settle('a', uploaded=False)
+    assert ledger.reserve('b', 60)
+    assert ledger.reserve('c', 30)
+    assert ledger.is_stale()
+    ledger.settle('b')
+    # the cloud does not count the file in flight yet
+    ledger.sync(1000 - 60)
+    assert ledger.space == 1000 - 60 - 30
+    assert not ledger.is_stale()
+
+
+def test_placement():
+    first = upload.CloudAccount(login='first@mail.ru')
+    second = upload.CloudAccount(login='second@mail.ru')
+    first.ledger = upload.SpaceLedger(space=100)
+    second.ledger = upload.SpaceLedger(space=50)
+    placement = upload.Placement([first, second])
+    assert placement.space == 150
+    # the freest account first, then the least loaded one
+    assert placement.reserve('a', 40)
+    assert placement.get_account('a') is first
+    assert placement.reserve('b', 10)
+    assert placement.get_account('b') is second
+    # the file fits the first account only
+    assert placement.reserve('c', 55)
+    assert placement.get_account('c') is first
+    assert not placement.reserve('d', 45)
+    placement.settle('a', uploaded=False)
+    placement.settle('b')
+    assert (first.ledger.space, second.ledger.space) == (45, 40)
+    # the freer first account has more bytes in flight
+    assert placement.reserve('d', 30)
+    assert placement.get_account('d') is second
+
+
+def test_pack_files(tmpdir):
+    files = []
+    for name, size, mtime in (('old_small', 1, 100), ('new_large', 30, 300), ('mid', 10, 200)):
+        file = tmpdir.join(name)
+        file.write('x' * size)
+        os.utime(str(file), (mtime, mtime))
+        files.append(str(file))
+    stats = {file: os.stat(file) for file in files}
+    names = lambda files: [os.path.basename(file) for file in files]
+    assert names(upload.pack_files(stats, space=20, policy='newest')) == ['new_large', 'mid', 'old_small']
+    assert names(upload.pack_files(stats, space=20, policy='smallest')) == ['old_small', 'mid', 'new_large']
+    # everything fits, walk order is kept
+    assert upload.pack_files(stats, space=1000, policy='smallest') == files
+
+
+def test_scan_tree(tmpdir):
+    tmpdir.join('root.txt').write('')
+    tmpdir.mkdir('b').mkdir('c').join('c.txt').write('contents')
+    tmpdir.mkdir('a').join('a.txt').write('')
+    tree = [(folder, sorted(entry.name for entry in files)) for folder, files in upload.scan_tree(str(tmpdir))]
+    # breadth first, parents before children
+    assert tree[0] == (str(tmpdir), ['root.txt'])
+    assert sorted(tree[1:3]) == [(str(tmpdir.join('a')), ['a.txt']), (str(tmpdir.join('b')), [])]
+    assert tree[3] == (str(tmpdir.join('b', 'c')), ['c.txt'])
+    batches = list(upload.scan_batches(str(tmpdir), max_folders=2, max_files=10))
+    assert [[folder for folder, __ in batch] for batch in batches] == [[folder for folder, __ in tree[:2]],
+                                                                        [folder for folder, __ in tree[2:]]]
+    # root file closes the batch
+    assert len(next(upload.scan_batches(str(tmpdir), max_folders=10, max_files=1))) == 1
+
+
+def test_remove_empty_folders(tmpdir):
+    tmpdir.mkdir('empty').mkdir('nested_empty')
+    tmpdir.mkdir('kept').join('file.txt').write('')
+    assert not upload.remove_empty_folders(str(tmpdir))
+    assert sorted(os.listdir(str(tmpdir))) == ['kept']
+
+
+def test_remove_empty_folders_deep(tmpdir):
+    """ trees deeper than the recursion limit should be cleaned up too """
+    import sys
+    import inspect
+    deep = str(tmpdir)
+    for folder in ['deep'] + ['d'] * 200:
+        deep = os.path.join(deep, folder)
+        os.mkdir(deep)
+    open(os.path.join(os.path.dirname(deep), 'file.txt'), 'w').close()
+    # the limit is lowered below the tree depth, pytest itself removes temporary trees recursively
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(len(inspect.stack(0)) + 100)
+    try:
+        assert not upload.remove_empty_folders(str(tmpdir))
+        assert not os.path.exists(deep)
+        assert os.path.isdir(os.path.dirname(deep))
+        os.remove(os.path.join(os.path.dirname(deep), 'file.txt'))
+        assert upload.remove_empty_folders(str(tmpdir))
+    finally:
+        sys.setrecursionlimit(limit)
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_prune_folders(tmpdir):
+    nested = tmpdir.mkdir('level1').mkdir('level2').mkdir('level3')
+    tmpdir.join('level1').join('file.txt').write('')
+    upload.prune_folders(str(nested), path=str(tmpdir))
+    assert os.listdir(str(tmpdir.join('level1'))) == ['file.txt']
+    tmpdir.join('level1').join('file.txt').remove()
+    upload.prune_folders(str(tmpdir.join('level1')), path=str(tmpdir))
+    # the upload folder itself is kept
+    assert tmpdir.check(dir=True) and not os.listdir(str(tmpdir))
+
+
+def test_get_scheduled():
+    import datetime
+    windows = upload.parse_schedule('09:00-18:00=512, 22:30-06:00=0')
+    assert windows == [(540, 1080, 512), (1350, 360, 0)]
+    at = lambda hour, minute=0: datetime.datetime(2026, 1, 1, hour, minute)
+    assert upload.get_scheduled(windows, 100, now=at(9)) == 512
+    assert upload.get_scheduled(windows, 100, now=at(18)) == 100
+    # window spanning midnight
+    assert upload.get_scheduled(windows, 100, now=at(23)) == 0
+    assert upload.get_scheduled(windows, 100, now=at(5, 59)) == 0
+    assert upload.get_scheduled([], 100) == 100
+
+
+def test_token_bucket():
+    bucket = upload.TokenBucket(rate=1000)
+    # one second burst
+    assert bucket.reserve(1000) == 0
+    assert bucket.reserve(500) == pytest.approx(0.5, abs=0.05)
+    assert bucket.reserve(500) == pytest.approx(1, abs=0.05)
+    assert upload.TokenBucket(rate=0).reserve(10 ** 9) == 0
+
+
+def test_upload_body_limiter(tmpdir, monkeypatch):
+    file = tmpdir.join('body.bin')
+    file.write_binary(b'x' * 300)
+    delays = []
+    monkeypatch.setattr('upload.time.sleep', delays.append)
+    with upload.UploadBody(str(file), limiter=upload.TokenBucket(rate=100), buffer_size=100) as body:
+        for chunk in body:
+            pass
+    assert delays == pytest.approx([1, 2], abs=0.05)
+
+
+def test_concurrency_controller():
+    controller = upload.ConcurrencyController(maximum=8)
+    assert controller.limit == 8
+    controller.record(congested=True)
+    assert controller.limit == 4
+    # no more than once per average latency
+    controller.latency = 60
+    controller.record(congested=True)
+    assert controller.limit == 4
+    for __ in range(4):
+        controller.record(latency=1)
+    assert controller.limit == 5
+    # slow response is a congestion signal
+    controller.decreased = 0
+    controller.latency = 1
+    controller.record(latency=upload.LATENCY_FACTOR + 1)
+    assert controller.limit == 2
+    # never above the maximum nor below the minimum
+    for __ in range(100):
+        controller.record(latency=1)
+    assert controller.limit == 8
+    controller.decreased = 0
+    controller.latency = 0
+    for __ in range(10):
+        controller.record(congested=True)
+    assert controller.limit == 1
+    fixed = upload.ConcurrencyController(maximum=3, adaptive=False)
+    fixed.record(congested=True)
+    assert fixed.limit == 3
+
+
+def test_histogram():
+    histogram = upload.Histogram(buckets=(1, 5))
+    for value in (0.5, 2, 10):
+        histogram.observe(value)
+    assert histogram.to_dict() == {'buckets': {'1': 1, '5': 2}, 'sum': 12.5, 'count': 3}
+
+
+def test_timed(monkeypatch):
+    monkeypatch.setattr('upload.METRICS', upload.Metrics())
+
+    @upload.timed('post', measure=upload.get_result_size)
+    def post(size):
+        if size < 0:
+            raise ValueError(size)
+        return ('hash', size) if size else (None, None)
+    post(100)
+    post(0)
+    with pytest.raises(ValueError):
+        post(-1)
+    stats = upload.METRICS.to_dict()['phases']['post']
+    assert (stats['calls'], stats['bytes'], stats['errors']) == (3, 100, 2)
+    assert stats['latency']['count'] == 3
+    assert list(upload.timed_iter('scan', 'ab')) == ['a', 'b']
+    assert upload.METRICS.to_dict()['phases']['scan']['calls'] == 2
+
+
+@pytest.mark.parametrize('codec', ['deflate', 'bz2', 'lzma'])
+def test_archive_codecs(tmpdir, monkeypatch, codec):
+    monkeypatch.setattr('upload.COMPRESSION', codec)
+    monkeypatch.setattr('upload.COMPRESS_LEVEL', 1)
+    contents = b'mail.ru-uploader test file contents' * 1000
+    file = tmpdir.join('coded.txt')
+    file.write_binary(contents)
+    stream_archive = b''.join(upload.ArchiveStream(str(file)).iter_archive())
+    archive, hash = upload.make_zip(str(file))
+    # hashed while written
+    assert hash == upload.get_cloud_hash(archive)
+    for data in (stream_archive, open(archive, 'rb').read()):
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            assert zf.getinfo('coded.txt').compress_type == upload.COMPRESSION_CODECS[codec]
+            assert zf.read('coded.txt') == contents
+            if codec == 'deflate':
+                # the level is applied
+                deflate = zlib.compressobj(1, zlib.DEFLATED, -15)
+                assert zf.getinfo('coded.txt').compress_size == len(deflate.compress(contents) + deflate.flush())
+
+
+def test_reproducible_archives(tmpdir, monkeypatch):
+    monkeypatch.setattr('upload.REPRODUCIBLE_ARCHIVES', True)
+    contents = b'mail.ru-uploader test file contents' * 1000
+    archives = []
+    for name, mtime, mode in (('first', 1000000000, 0o600), ('second', 1600000000, 0o755)):
+        file = tmpdir.mkdir(name).join('same.txt')
+        file.write_binary(contents)
+        os.utime(str(file), (mtime, mtime))
+        os.chmod(str(file), mode)
+        stream_archive = b''.join(upload.ArchiveStream(str(file)).iter_archive())
+        archive, hash = upload.make_zip(str(file))
+        data = open(archive, 'rb').read()
+        # the streamed archive is the same too
+        assert data == stream_archive
+        archives.append((data, hash))
+    assert archives[0] == archives[1]
+    with zipfile.ZipFile(io.BytesIO(archives[0][0])) as zf:
+        info = zf.getinfo('same.txt')
+        assert info.date_time == upload.ARCHIVE_DATE_TIME
+        assert zf.read('same.txt') == contents
+
+
+def test_reproducible_bundles(tmpdir, monkeypatch):
+    monkeypatch.setattr('upload.REPRODUCIBLE_ARCHIVES', True)
+    monkeypatch.setattr('upload.ARCHIVE_FILES', True)
+    archives = []
+    for name, mtime in (('first', 1000000000), ('second', 1600000000)):
+        folder = tmpdir.mkdir(name)
+        files = []
+        for member in ('b.txt', 'a.txt', 'c.jpg'):
+            file = folder.join(member)
+            file.write_binary(member.encode() * 1000)
+            os.utime(str(file), (mtime, mtime))
+            files.append(str(file))
+        bundle = upload.Bundle(files, {file: os.stat(file) for file in files})
+        try:
+            archives.append(open(bundle.archive, 'rb').read())
+        finally:
+            bundle.close()
+    assert archives[0] == archives[1]
+    with zipfile.ZipFile(io.BytesIO(archives[0])) as zf:
+        index = json.loads(zf.read(upload.BUNDLE_INDEX).decode())['members']
+    assert [member['name'] for member in index] == ['a.txt', 'b.txt', 'c.jpg']
+    assert not any('mtime' in member for member in index)
+
+
+def test_is_archivable(tmpdir, monkeypatch):
+    monkeypatch.setattr('upload.ARCHIVE_FILES', True)
+    monkeypatch.setattr('upload.COMPRESS_SAMPLE', 1)
+    upload.get_archive_ratio.cache_clear()
+    text = tmpdir.join('text.txt')
+    text.write('mail.ru-uploader test file contents' * 1000)
+    noise = tmpdir.join('noise.bin')
+    noise.write_binary(os.urandom(10000))
+    tiny = tmpdir.join('tiny.txt')
+    tiny.write('tiny')
+    assert upload.get_archive_ratio(str(text), 35000) < 0.1
+    assert upload.is_archivable(str(text))
+    # random data and headers of tiny archives outweigh the savings
+    assert upload.get_archive_ratio(str(noise), 10000) > 1
+    assert not upload.is_archivable(str(noise))
+    assert not upload.is_archivable(str(tiny))
+    assert not upload.is_archivable(str(tmpdir.join('photo.jpg')), 100)
+    assert not upload.is_archivable(str(tmpdir.join('dump.sql.gz')), 100)
+    # the same size noise written over the text is estimated again
+    mtime = text.mtime()
+    text.write_binary(os.urandom(35000))
+    os.utime(str(text), (mtime + 10, mtime + 10))
+    assert not upload.is_archivable(str(text))
+    monkeypatch.setattr('upload.COMPRESS_SAMPLE', 0)
+    assert upload.is_archivable(str(noise))
+
+
+def test_get_file_batches(tmpdir):
+    files = [str(tmpdir.join('a', 'b', 'deep.txt')), str(tmpdir.join('root.txt')), str(tmpdir.join('a', 'a.txt')),
+             str(tmpdir.join('a', 'a2.txt'))]
+    batches = list(upload.get_file_batches(files, max_folders=2))
+    assert [[(folder, [entry.name for entry in entries]) for folder, entries in batch] for batch in batches] == [
+        [(str(tmpdir), ['root.txt']), (str(tmpdir.join('a')), ['a.txt', 'a2.txt'])],
+        [(str(tmpdir.join('a', 'b')), ['deep.txt'])]]
+
+
+def test_polling_watcher(tmpdir):
+    tmpdir.join('old.txt').write('')
+    watcher = upload.PollingWatcher(str(tmpdir), interval=0)
+    assert watcher.read() == []
+    tmpdir.mkdir('sub').join('new.txt').write('')
+    tmpdir.join('old.txt').write('changed')
+    assert sorted(watcher.read()) == [str(tmpdir.join('old.txt')), str(tmpdir.join('sub', 'new.txt'))]
+    assert watcher.read(timeout=0) == []
+
+
+@pytest.mark.skipif(not upload.sys.platform.startswith('linux'), reason='inotify is Linux only')
+def test_inotify_watcher(tmpdir):
+    watcher = upload.InotifyWatcher(str(tmpdir))
+    try:
+        assert watcher.read(timeout=0) == []
+        tmpdir.join('written.txt').write('contents')
+        outside = tmpdir.mkdir('outside')
+        outside.join('moved.txt').write('')
+        os.rename(str(outside.join('moved.txt')), str(tmpdir.join('moved.txt')))
+        # files of the new folders are reported as well as the ones written there later
+        sub = tmpdir.mkdir('sub')
+        sub.join('early.txt').write('')
+        files = []
+        while True:
+            read = watcher.read(timeout=0.5)
+            if not read:
+                break
+            files.extend(read)
+        sub.join('late.txt').write('')
+        files.extend(watcher.read(timeout=1))
+        expected = [str(tmpdir.join(name)) for name in ('written.txt', 'moved.txt')]
+        expected += [str(sub.join(name)) for name in ('early.txt', 'late.txt')]
+        assert set(files) >= set(expected)
+        assert not watcher.overflowed
+    finally:
+        watcher.close()
+
+
+def test_upload_body(tmpdir):
+    contents = b'0123456789' * 100
+    file = tmpdir.join('body.bin')
+    file.write_binary(contents)
+    with upload.UploadBody(str(file), name='part.001', offset=10, size=980, buffer_size=64) as body:
+        chunks = [bytes(chunk) for chunk in body]
+        assert max(len(chunk) for chunk in chunks[1:-1]) == 64
+        data = b''.join(chunks)
+        assert len(data) == len(body)
+        # iterating again rewinds the body
+        assert b''.join(bytes(chunk) for chunk in body) == data
+        head, rest = data.split(b'\r\n\r\n', 1)
+        assert b'filename="part.001"' in head
+        assert rest == contents[10:990] + body.tail
+        assert body.get_request()['headers']['Content-Type'] == body.content_type
+    assert body.fd.closed
+    # truncated files are not posted padded
+    with upload.UploadBody(str(file), size=2000) as body:
+        with pytest.raises(EOFError):
+            list(body)
+
+
+def test_upload_nodes():
+    nodes = upload.UploadNodes(['a', 'b'])
+    # unknown domain is posted to as is
+    assert nodes.pick('other') == 'other'
+    # posts in flight are spread
+    assert [nodes.pick('a'), nodes.pick('a')] == ['a', 'b']
+    nodes.record('a', seconds=1)
+    nodes.record('b', seconds=0.1)
+    assert nodes.pick('a') == 'b'
+    nodes.record('b', seconds=0.1)
+    for __ in range(upload.NODE_FAILURES):
+        assert nodes.pick('a') == 'b'
+        nodes.record('b', failed=True)
+    # failing node is skipped, the slow one is not degraded yet
+    assert nodes.pick('a') == 'a'
+    assert not nodes.is_stale()
+    for __ in range(upload.NODE_FAILURES):
+        nodes.record(nodes.pick('a'), failed=True)
+    assert nodes.is_stale()
+    nodes.update(['b', 'c'], reset=True)
+    assert not nodes.is_stale()
+    assert nodes.get_urls() == ['b', 'c']
+    assert nodes.pick('b') == 'c'
+    # failed attempt is retried on another node, even a slower one
+    nodes.record('c', seconds=10)
+    assert nodes.pick('b') == 'b'
+    nodes.record('b', failed=True)
+    assert nodes.pick('b', previous='b') == 'c'
+    # the only node left is retried
+    nodes.update(['b'])
+    assert nodes.pick('b', previous='b') == 'b'
+
+
+def test_node_post_accounts(monkeypatch):
+    monkeypatch.setattr('upload.NODE_FAILURES', 1)
+    first = upload.CloudAccount(login='first@mail.ru')
+    second = upload.CloudAccount(login='second@mail.ru')
+    for account in (first, second):
+        upload.set_upload_nodes(['a', 'b'], account.nodes)
+    with upload.NodePost('a', first.login, nodes=first.nodes) as post:
+        assert post()['url'].startswith('a?')
+    # the failed post degrades the node of its account only
+    assert first.nodes.pick('a') == 'b'
+    assert second.nodes.pick('a') == 'a'
+
+
+@pytest.mark.skipif(os.name != 'posix', reason='file modes are POSIX only')
+def test_session_cache_mode(tmpdir, monkeypatch):
+    session_file = tmpdir.join('.session')
+    session_file.write('{}')
+    session_file.chmod(0o644)
+    monkeypatch.setattr('upload.SESSION_FILE', str(session_file))
+    with upload.get_session() as s:
+        upload.write_session_cache(s, csrf='token', domain='domain')
+    assert session_file.stat().mode & 0o777 == 0o600
+
+
+def test_get_accounts(monkeypatch, caplog):
+    import logging
+    monkeypatch.setattr('upload.LOGGER', logging.getLogger('test_get_accounts'))
+    monkeypatch.setattr('upload.CACHE_FOLDERS', False)
+    # sections without email or password are skipped, as the main account's duplicates are
+    monkeypatch.setattr('upload.EXTRA_ACCOUNTS', [('', ''), ('no_password@mail.ru', ''), ('other_email@mail.ru', 'pass'),
+                                                  (upload.LOGIN, 'pass')])
+    assert [account.login for account in upload.get_accounts()] == [upload.LOGIN, 'other_email@mail.ru']
+    assert len([record for record in caplog.records if record.levelname == 'WARNING']) == 2
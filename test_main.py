@@ -14,108 +14,430 @@ example run (from shell):
 py.test test_main.py
 """
 import os
+import json
 import pytest
-import shutil
 import os.path
-from conftest import get_unique_string
-
-
-@pytest.fixture(scope='function')
-def upload_tearup(request, monkeypatch):
-    """ preparing testing environment - pretty obvious, isn't it?
-    - creating directory tree with files to upload,
-    - setting up config
-    - faking cloud functions responses
-    - setting up logging
-    tree structure:
-    ./upload_dir/l0_1.txt
-    ./upload_dir/l0_2.txt
-    ./upload_dir/level1_1/l1_1_1.txt
-    ./upload_dir/level1_1/level2_1/l2_1_1.txt
-    ./upload_dir/level1_1/level2_2/level3_1/l3_1_1.txt
-    ./upload_dir/level1_2/l1_2_1.txt
-    ./upload_dir/level1_2/l1_2_2.txt
-    """
-    # creating tree
-    upload_dir = os.path.join('.', 'test_upload_' + get_unique_string())
-    os.makedirs(upload_dir)
-    open(os.path.join(upload_dir, 'l0_1.txt'), 'w').close()
-    open(os.path.join(upload_dir, 'l0_2.txt'), 'w').close()
-    dir = os.path.join(upload_dir, 'level1_1')
-    os.makedirs(dir)
-    open(os.path.join(dir, 'l1_1_1.txt'), 'w').close()
-    dir = os.path.join(dir, 'level2_1')
-    os.makedirs(dir)
-    open(os.path.join(dir, 'l2_1_1.txt'), 'w').close()
-    dir = os.path.join(dir, 'level2_2/level3_1')
-    os.makedirs(dir)
-    open(os.path.join(dir, 'l3_1_1.txt'), 'w').close()
-    dir = os.path.join(upload_dir, 'level1_2')
-    os.makedirs(dir)
-    open(os.path.join(dir, 'l1_2_1.txt'), 'w').close()
-    open(os.path.join(dir, 'l1_2_2.txt'), 'w').close()
-    # setting up config (writing a file? why? it will not be applied anyway)
-    config_file = os.path.join('.', 'test_config_' + get_unique_string())
-    uploaded_dir = os.path.join('.', 'test_uploaded_' + get_unique_string())
-    with open(config_file, 'w') as f:
-        f.write("""[Credentials]
-Email : some_email@mail.ru
-Password : some_pass
-
-[Locations]
-UploadedPath : {}
-CloudPath : /backups
-UploadPath : {}
-
-[Behaviour]
-MoveUploaded : yes
-RemoveUploaded : yes
-ArchiveFiles : no
-RemoveFolders: yes""".format(uploaded_dir, upload_dir))
-    monkeypatch.setattr('upload.IS_CONFIG_PRESENT', True)
-    monkeypatch.setattr('upload.CONFIG_FILE', config_file)
-    monkeypatch.setattr('upload.UPLOAD_PATH', upload_dir)
-    monkeypatch.setattr('upload.UPLOADED_PATH', uploaded_dir)
-    # setup uploader behaviour here to test desired combination (default: True, True, False, True)
-    monkeypatch.setattr('upload.ARCHIVE_FILES', True)
-    monkeypatch.setattr('upload.REMOVE_UPLOADED', True)
-    monkeypatch.setattr('upload.MOVE_UPLOADED', False)
-    monkeypatch.setattr('upload.REMOVE_FOLDERS', True)
-    # faking cloud functions responses
-    def cloud_auth(session, login=None, password=None):
-        return True
-    monkeypatch.setattr('upload.cloud_auth', cloud_auth)
-    def get_csrf(session):
-        return 'fake_csrf'
-    monkeypatch.setattr('upload.get_csrf', get_csrf)
-    def get_upload_domain(session, csrf=''):
-        return 'fake_upload_domain'
-    monkeypatch.setattr('upload.get_upload_domain', get_upload_domain)
-    def get_cloud_space(session, csrf=''):
-        return 1*1024*1024*1024
-    monkeypatch.setattr('upload.get_cloud_space', get_cloud_space)
-    def post_file(session, domain='', file=''):
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_main_loop(upload_tearup, capsys, monkeypatch, workers):
+    import upload
+    monkeypatch.setattr('upload.UPLOAD_WORKERS', workers)
+    upload.main()
+    out, err = capsys.readouterr()
+    assert '7 file(s) uploaded.' in out
+
+
+def test_main_loop_incremental_disposal(upload_tearup, capsys, monkeypatch):
+    """ uploaded files should be removed while the next ones are uploaded """
+    import upload
+    monkeypatch.setattr('upload.UPLOAD_WORKERS', 1)
+    posted = []
+    left = []
+    def post_file(session, domain='', file='', login=None, nodes=None):
+        upload.DISPOSER.join()
+        left.append(len([file for file in posted if os.path.exists(file)]))
+        posted.append(file)
         return ('1234567890123456789012345678901234567890', 100)
     monkeypatch.setattr('upload.post_file', post_file)
-    def add_file(session, file='', hash='', size=0, csrf=''):
-        return True
+    upload.main()
+    out, err = capsys.readouterr()
+    assert '7 file(s) uploaded. Errors: 0.' in out
+    assert left == [0] * 7
+    assert not os.listdir(upload.UPLOAD_PATH)
+
+
+def test_main_loop_failed_posts(upload_tearup, capsys, monkeypatch):
+    """ failed posts should neither be counted as uploaded nor removed """
+    import upload
+    def post_file(session, domain='', file='', login=None, nodes=None):
+        if os.path.basename(file).startswith('l1_'):
+            upload.LOGGER.error('fake post error')
+            return (None, None)
+        return ('1234567890123456789012345678901234567890', 100)
+    monkeypatch.setattr('upload.post_file', post_file)
+    upload.main()
+    out, err = capsys.readouterr()
+    assert '4 file(s) uploaded. Errors: 3.' in out
+
+
+def test_main_loop_hash_first(upload_tearup, capsys, monkeypatch):
+    """ contents known to the cloud should not be posted """
+    import upload
+    monkeypatch.setattr('upload.HASH_FIRST', True)
+    monkeypatch.setattr('upload.ARCHIVE_FILES', False)
+    known_hash, known_size = upload.get_cloud_hash(__file__)
+    posted = []
+    def post_file(session, domain='', file='', login=None, nodes=None):
+        posted.append(file)
+        return (known_hash, known_size)
+    monkeypatch.setattr('upload.post_file', post_file)
+    def add_file(session, file='', hash='', size=0, csrf='', log_errors=True):
+        # only level1_2 files are known to the fake cloud before posting
+        return '/level1_2/' in file or hash == known_hash
+    monkeypatch.setattr('upload.add_file', add_file)
+    upload.main()
+    out, err = capsys.readouterr()
+    assert '7 file(s) uploaded. Errors: 0.' in out
+    assert len(posted) == 5
+
+
+def test_main_loop_hash_first_archives(upload_tearup, capsys, monkeypatch):
+    """ archives should not be read again to be hashed """
+    import upload
+    monkeypatch.setattr('upload.HASH_FIRST', True)
+    hashed = []
+    def get_cloud_hash(file, *args, **kwargs):
+        hashed.append(file)
+        return ('1234567890123456789012345678901234567890', 100)
+    monkeypatch.setattr('upload.get_cloud_hash', get_cloud_hash)
+    upload.main()
+    out, err = capsys.readouterr()
+    assert '7 file(s) uploaded. Errors: 0.' in out
+    assert hashed == []
+
+
+def test_main_loop_skip_unchanged(upload_tearup, capsys, monkeypatch):
+    """ kept files should be uploaded once until changed """
+    import upload
+    monkeypatch.setattr('upload.REMOVE_UPLOADED', False)
+    upload.main()
+    out, err = capsys.readouterr()
+    assert '7 file(s) uploaded.' in out
+    upload.main()
+    out, err = capsys.readouterr()
+    assert '0 file(s) uploaded.' in out
+    with open(os.path.join(upload.UPLOAD_PATH, 'l0_1.txt.zip'), 'a') as f:
+        f.write('changed')
+    upload.main()
+    out, err = capsys.readouterr()
+    assert '1 file(s) uploaded.' in out
+
+
+def test_main_loop_stream_archives(upload_tearup, capsys, monkeypatch):
+    """ streamed archives should not touch the disk, originals should be removed after upload """
+    import upload
+    monkeypatch.setattr('upload.STREAM_ARCHIVES', True)
+    def post_archive(session, domain='', file='', login=None, nodes=None):
+        assert not os.path.exists(file + '.zip')
+        return ('1234567890123456789012345678901234567890', sum(map(len, upload.ArchiveStream(file))))
+    monkeypatch.setattr('upload.post_archive', post_archive)
+    upload.main()
+    out, err = capsys.readouterr()
+    assert '7 file(s) uploaded. Errors: 0.' in out
+    assert not os.listdir(upload.UPLOAD_PATH)
+
+
+def test_main_loop_compressor(upload_tearup, capsys, monkeypatch):
+    """ files should be archived by processes before posting """
+    import upload
+    monkeypatch.setattr('upload.COMPRESS_WORKERS', 2)
+    monkeypatch.setattr('upload.COMPRESS_QUEUE', 3)
+    posted = []
+    def post_file(session, domain='', file='', login=None, nodes=None):
+        posted.append(file)
+        return ('1234567890123456789012345678901234567890', 100)
+    monkeypatch.setattr('upload.post_file', post_file)
+    upload.main()
+    out, err = capsys.readouterr()
+    assert '7 file(s) uploaded. Errors: 0.' in out
+    assert len(posted) == 7
+    assert all(file.endswith('.txt.zip') for file in posted)
+
+
+def test_main_loop_split_large(upload_tearup, capsys, monkeypatch):
+    """ large files should be uploaded by volumes with a manifest """
+    import json
+    import upload
+    monkeypatch.setattr('upload.SPLIT_LARGE', True)
+    monkeypatch.setattr('upload.MAX_FILE_SIZE', 2*1024*1024)
+    monkeypatch.setattr('upload.VOLUME_SIZE', 1)
+    large_file = os.path.join(upload.UPLOAD_PATH, 'level1_2', 'large.bin')
+    with open(large_file, 'wb') as f:
+        f.write(os.urandom(2*1024*1024 + 1000))
+    volumes = []
+    def post_volume(session, domain='', file='', name='', offset=0, size=0, login=None, nodes=None):
+        volumes.append((name, offset, size))
+        return ('1234567890123456789012345678901234567890', size)
+    monkeypatch.setattr('upload.post_volume', post_volume)
+    manifests = []
+    def post_file(session, domain='', file='', login=None, nodes=None):
+        if file.endswith('.parts.json'):
+            with open(file) as f:
+                manifests.append(json.load(f))
+        return ('1234567890123456789012345678901234567890', 100)
+    monkeypatch.setattr('upload.post_file', post_file)
+    upload.main()
+    out, err = capsys.readouterr()
+    assert '8 file(s) uploaded. Errors: 0.' in out
+    assert sorted(volumes) == [('large.bin.001', 0, 1024*1024), ('large.bin.002', 1024*1024, 1024*1024),
+                               ('large.bin.003', 2*1024*1024, 1000)]
+    assert manifests[0]['size'] == 2*1024*1024 + 1000
+    assert [volume['name'] for volume in manifests[0]['volumes']] == ['large.bin.001', 'large.bin.002', 'large.bin.003']
+    assert not os.path.exists(large_file)
+
+
+def test_main_loop_journal(upload_tearup, capsys, monkeypatch):
+    """ files posted but not added by the failed run should be added by the next one without posting """
+    import upload
+    monkeypatch.setattr('upload.ARCHIVE_FILES', False)
+    posted = []
+    def post_file(session, domain='', file='', login=None, nodes=None):
+        posted.append(os.path.basename(file))
+        return ('1234567890123456789012345678901234567890', 100)
+    monkeypatch.setattr('upload.post_file', post_file)
+    def add_file(session, file='', hash='', size=0, csrf='', log_errors=True):
+        return '/level1_2/' not in file
+    monkeypatch.setattr('upload.add_file', add_file)
+    upload.main()
+    out, err = capsys.readouterr()
+    assert '5 file(s) uploaded.' in out
+    assert os.path.isfile(upload.JOURNAL_FILE)
+    posted.clear()
+    monkeypatch.setattr('upload.add_file', lambda *args, **kwargs: True)
+    upload.main()
+    out, err = capsys.readouterr()
+    assert '2 file(s) uploaded. Errors: 0.' in out
+    assert not posted
+    assert not os.path.exists(upload.JOURNAL_FILE)
+
+
+def test_main_loop_journal_stale(upload_tearup, capsys, monkeypatch):
+    """ journaled files rejected by the cloud or posted to other accounts should be posted again """
+    import upload
+    monkeypatch.setattr('upload.ARCHIVE_FILES', False)
+    with upload.UploadJournal(journal_file=upload.JOURNAL_FILE) as journal:
+        journal.add_posted(os.path.join(upload.UPLOAD_PATH, 'l0_1.txt'), 'stale', 100, login=upload.LOGIN)
+        journal.add_posted(os.path.join(upload.UPLOAD_PATH, 'l0_2.txt'), '1234567890123456789012345678901234567890',
+                           100, login='other_email@mail.ru')
+    posted = []
+    def post_file(session, domain='', file='', login=None, nodes=None):
+        posted.append(os.path.basename(file))
+        return ('1234567890123456789012345678901234567890', 100)
+    monkeypatch.setattr('upload.post_file', post_file)
+    def add_file(session, file='', hash='', size=0, csrf='', log_errors=True):
+        return hash != 'stale'
     monkeypatch.setattr('upload.add_file', add_file)
+    upload.main()
+    out, err = capsys.readouterr()
+    assert '7 file(s) uploaded. Errors: 0.' in out
+    assert len(posted) == 7
+    # only the record of the other account is left
+    with open(upload.JOURNAL_FILE) as f:
+        assert [json.loads(line)['key'].split(':')[0] for line in f] == ['other_email@mail.ru']
+
+
+def test_main_loop_space_ledger(upload_tearup, capsys, monkeypatch):
+    """ free space should be requested once and decreased by each accepted file """
+    import upload
+    monkeypatch.setattr('upload.ARCHIVE_FILES', False)
+    monkeypatch.setattr('upload.SPACE_RESYNC', 0)
+    for name in ('l0_1.txt', 'l0_2.txt'):
+        with open(os.path.join(upload.UPLOAD_PATH, name), 'w') as f:
+            f.write('x' * 100)
+    requests = []
+    def get_cloud_space(session, csrf='', login=None):
+        requests.append(csrf)
+        return 150
+    monkeypatch.setattr('upload.get_cloud_space', get_cloud_space)
+    upload.main()
+    out, err = capsys.readouterr()
+    assert '6 file(s) uploaded.' in out
+    assert len(requests) == 1
+
+
+def test_main_loop_folder_cache(upload_tearup, capsys, monkeypatch):
+    """ folders should be created parents first and only once between runs """
+    import upload
+    monkeypatch.setattr('upload.REMOVE_UPLOADED', False)
+    created = []
     def create_folder(session, folder='', csrf=''):
+        # parent should exist
+        assert folder == upload.CLOUD_PATH or folder.rsplit('/', 1)[0] in created
+        created.append(folder)
         return True
     monkeypatch.setattr('upload.create_folder', create_folder)
-    # setting up logging
-    log_file = os.path.join('.', 'test_log_' + get_unique_string())
-    monkeypatch.setattr('upload.LOG_FILE', log_file)
-    def upload_teardown():
-        shutil.rmtree(upload_dir)
-        os.unlink(config_file)
-        shutil.rmtree(uploaded_dir, ignore_errors=True)
-        os.unlink(log_file)
-    request.addfinalizer(upload_teardown)
+    upload.main()
+    assert len(created) == 6
+    os.makedirs(os.path.join(upload.UPLOAD_PATH, 'level1_2', 'new_level2'))
+    open(os.path.join(upload.UPLOAD_PATH, 'level1_2', 'new_level2', 'new.txt'), 'w').close()
+    upload.main()
+    out, err = capsys.readouterr()
+    assert '1 file(s) uploaded.' in out
+    assert created[6:] == ['/backups/level1_2/new_level2']
 
 
-def test_main_loop(upload_tearup, capsys):
+def test_main_loop_nothing_to_upload(upload_tearup, capsys, monkeypatch):
+    """ runs with nothing to upload should neither log in nor import network modules """
     import upload
+    monkeypatch.setattr('upload.REMOVE_UPLOADED', False)
+    upload.main()
+    out, err = capsys.readouterr()
+    assert '7 file(s) uploaded.' in out
+    # nothing is requested by the runs with nothing to upload
+    def cloud_auth(session, login=None, password=None):
+        raise AssertionError('logged in with nothing to upload')
+    monkeypatch.setattr('upload.cloud_auth', cloud_auth)
+    def get_session(workers=None):
+        raise AssertionError('session opened with nothing to upload')
+    monkeypatch.setattr('upload.get_session', get_session)
     upload.main()
     out, err = capsys.readouterr()
+    assert '0 file(s) uploaded. Errors: 0.' in out
+
+
+def test_main_loop_skips_session_files(upload_tearup, capsys, monkeypatch, tmpdir):
+    """ session caches of all the accounts should not be uploaded from the module's folder """
+    import upload
+    monkeypatch.setattr('upload.FILES_TO_SKIP', set(upload.FILES_TO_SKIP))
+    monkeypatch.setattr('upload.EXTRA_ACCOUNTS', [('other_email@mail.ru', 'other_pass')])
+    try:
+        upload.main()
+    finally:
+        if os.path.exists(upload.get_session_file('other_email@mail.ru')):
+            os.unlink(upload.get_session_file('other_email@mail.ru'))
+    out, err = capsys.readouterr()
     assert '7 file(s) uploaded.' in out
+    for name in ('file.txt', upload.get_session_file(), upload.get_session_file('other_email@mail.ru')):
+        tmpdir.join(os.path.basename(name)).write('')
+    # the tree is removed relative to the current folder
+    with monkeypatch.context() as m:
+        m.chdir(str(tmpdir))
+        assert [os.path.basename(file) for file, stat in upload.get_dir_candidates('.')] == ['file.txt']
+
+
+def test_main_loop_throttled(upload_tearup, capsys, monkeypatch):
+    """ bandwidth limiter and adaptive concurrency should not break uploading """
+    import upload
+    monkeypatch.setattr('upload.LIMITER', None)
+    monkeypatch.setattr('upload.CONTROLLER', None)
+    monkeypatch.setattr('upload.BANDWIDTH_LIMIT', 1024)
+    monkeypatch.setattr('upload.ADAPTIVE_CONCURRENCY', True)
+    upload.main()
+    out, err = capsys.readouterr()
+    assert '7 file(s) uploaded.' in out
+    assert upload.LIMITER.default_rate == 1024 * 1024
+    assert upload.CONTROLLER.adaptive
+
+
+def test_main_loop_compression_policy(upload_tearup, capsys, monkeypatch):
+    """ only files worth compressing should be archived """
+    import upload
+    monkeypatch.setattr('upload.COMPRESS_SAMPLE', 64)
+    with open(os.path.join(upload.UPLOAD_PATH, 'text.txt'), 'w') as f:
+        f.write('mail.ru-uploader ' * 1000)
+    with open(os.path.join(upload.UPLOAD_PATH, 'noise.bin'), 'wb') as f:
+        f.write(os.urandom(10000))
+    added = []
+    def add_file(session, file='', hash='', size=0, csrf='', log_errors=True):
+        added.append(file)
+        return True
+    monkeypatch.setattr('upload.add_file', add_file)
+    upload.main()
+    out, err = capsys.readouterr()
+    assert '9 file(s) uploaded.' in out
+    assert '/backups/text.txt.zip' in added
+    assert '/backups/noise.bin' in added
+    # empty files are not worth archiving either
+    assert '/backups/l0_1.txt' in added
+
+
+def test_main_loop_bundles(upload_tearup, capsys, monkeypatch):
+    """ small files of a folder should be uploaded as one bundle, single small files as is """
+    import upload
+    monkeypatch.setattr('upload.BUNDLE_FILES', True)
+    added = []
+    def add_file(session, file='', hash='', size=0, csrf='', log_errors=True):
+        added.append(file)
+        return True
+    monkeypatch.setattr('upload.add_file', add_file)
+    upload.main()
+    out, err = capsys.readouterr()
+    assert '7 file(s) uploaded.' in out
+    bundles = [file for file in added if os.path.basename(file).startswith('bundle-')]
+    assert sorted(file.rsplit('/', 1)[0] for file in bundles) == ['/backups', '/backups/level1_2']
+    assert len(added) == 5
+    # bundled files are disposed as uploaded
+    assert not os.path.exists(os.path.join(upload.UPLOAD_PATH, 'l0_1.txt'))
+
+
+def test_main_loop_watch(upload_tearup, capsys, monkeypatch):
+    """ files landing after the initial upload should be uploaded by the same run """
+    import upload
+    monkeypatch.setattr('upload.WATCH_DEBOUNCE', 0)
+    monkeypatch.setattr('upload.WATCH_RESCAN', 0)
+    added = []
+    def add_file(session, file='', hash='', size=0, csrf='', log_errors=True):
+        added.append(file)
+        return True
+    monkeypatch.setattr('upload.add_file', add_file)
+    new_dir = os.path.join(upload.UPLOAD_PATH, 'level1_1', 'new')
+
+    class Watcher():
+        overflowed = False
+        reads = 0
+
+        def read(self, timeout=None):
+            self.reads += 1
+            if self.reads > 1:
+                raise KeyboardInterrupt
+            os.makedirs(new_dir)
+            open(os.path.join(new_dir, 'new.txt'), 'w').close()
+            return [os.path.join(new_dir, 'new.txt')]
+
+        def close(self):
+            pass
+    monkeypatch.setattr('upload.get_watcher', lambda path: Watcher())
+    upload.main(watch=True)
+    out, err = capsys.readouterr()
+    assert '8 file(s) uploaded.' in out
+    assert added[-1] == '/backups/level1_1/new/new.txt.zip'
+    assert not os.path.exists(os.path.join(new_dir, 'new.txt'))
+
+
+def test_main_loop_watch_rescan(upload_tearup, capsys, monkeypatch):
+    """ files found by the rescan should be uploaded once they are settled, not while being written """
+    import time
+    import upload
+    monkeypatch.setattr('upload.WATCH_DEBOUNCE', 1)
+    monkeypatch.setattr('upload.WATCH_RESCAN', 0)
+    added = []
+    def add_file(session, file='', hash='', size=0, csrf='', log_errors=True):
+        added.append(file)
+        return True
+    monkeypatch.setattr('upload.add_file', add_file)
+    growing = os.path.join(upload.UPLOAD_PATH, 'growing.txt')
+
+    class Watcher():
+        overflowed = False
+        reads = 0
+        f = None
+
+        def read(self, timeout=None):
+            self.reads += 1
+            if self.reads == 1:
+                # the file event is lost, the tree is rescanned
+                self.f = open(growing, 'w')
+                self.f.write('first part')
+                self.f.flush()
+                self.overflowed = True
+                return []
+            if self.reads == 2:
+                # still open across the rescan
+                assert '/backups/growing.txt.zip' not in added
+                self.f.write(', second part')
+                self.f.close()
+                return [growing]
+            if self.reads == 3:
+                time.sleep(timeout)
+                return []
+            raise KeyboardInterrupt
+
+        def close(self):
+            pass
+    monkeypatch.setattr('upload.get_watcher', lambda path: Watcher())
+    upload.main(watch=True)
+    out, err = capsys.readouterr()
+    assert '8 file(s) uploaded.' in out
+    assert added.count('/backups/growing.txt.zip') == 1
+    assert not os.path.exists(growing)
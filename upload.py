@@ -7,11 +7,16 @@ Created: 2016-08-09
 
 uploads specified directory contents to mail.ru cloud
 - same name files in the cloud will NOT be replaced (still zipped and posted though)
+- contents already present in the cloud are added by hash without posting
+- kept uploaded files are indexed locally and skipped by the next runs until changed
 - preserves upload directory structure
 - functions are not fully designed for import
 
-requirements (Python 3.5):
-pip install requests requests-toolbelt
+requirements (Python 3.7):
+pip install requests
+optional, for asyncio engine:
+pip install aiohttp
+requests and aiohttp are imported on first use, runs with nothing to upload do not load them
 
 example run from venv:
 python -m upload
@@ -21,19 +26,65 @@ import re
 import sys
 import json
 import time
+import math
+import bz2
 import zlib
+import ctypes
+import select
+import signal
+import struct
+import lzma
+import random
+import hashlib
+import inspect
 import logging
 import os.path
+import sqlite3
 import zipfile
-import requests
+import tempfile
 import datetime
+import threading
+import ctypes.util
+import argparse
 import configparser
-from shutil import move
+import importlib.util
+import multiprocessing
+from uuid import uuid4
+from shutil import move, rmtree
+from functools import partial, wraps, lru_cache
 from mimetypes import guess_type
-from requests_toolbelt import MultipartEncoder
-from requests.compat import urljoin, quote_plus
+from queue import Queue
+from collections import deque
+from itertools import chain
+from contextlib import ExitStack, AsyncExitStack
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urljoin, quote_plus
+from http.cookies import SimpleCookie
 from logging.handlers import RotatingFileHandler
 
+
+def lazy_import(name):
+    """ returns the module loaded on its first attribute access, None if it is not installed """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        return None
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+# network modules take most of the startup time, they are loaded once there is something to upload
+ssl = lazy_import('ssl')
+asyncio = lazy_import('asyncio')
+requests = lazy_import('requests')
+# optional, for asyncio engine
+aiohttp = lazy_import('aiohttp')
+yarl = lazy_import('yarl')
+
 __version__ = '0.0.8'
 
 IS_CONFIG_PRESENT = False # local configuration file presence indicator
@@ -55,12 +106,19 @@ IS_FROZEN = getattr(sys, 'frozen', False)
 LOGIN = config.get('Credentials', 'Email', fallback='your_email@mail.ru')
 # email password
 PASSWORD = config.get('Credentials', 'Password', fallback='your_email_password')
+# more accounts to spread files over by their free space and load, [Credentials.<any name>] sections like Credentials
+EXTRA_ACCOUNTS = [(config.get(section, 'Email', fallback=''), config.get(section, 'Password', fallback=''))
+                  for section in config.sections() if section.startswith('Credentials.')]
 # absolute cloud path (without 'home')
 CLOUD_PATH = config.get('Locations', 'CloudPath', fallback='/backups')
 # local folder path with files to upload, use '.' to set path relative to the module location
 UPLOAD_PATH = config.get('Locations', 'UploadPath', fallback='./upload')
 # local folder to move uploaded files, will be created if not exists
 UPLOADED_PATH = config.get('Locations', 'UploadedPath', fallback='./uploaded')
+# run metrics (phase timings, requests latency, compression) JSON file, rewritten by each run, empty - not exported
+METRICS_FILE = config.get('Locations', 'MetricsFile', fallback='./metrics.json')
+# Prometheus node exporter textfile collector file, i.e. /var/lib/node_exporter/upload.prom, empty - not exported
+PROMETHEUS_FILE = config.get('Locations', 'PrometheusFile', fallback='')
 # True, if False - no uploaded files zipping
 ARCHIVE_FILES = config.getboolean('Behaviour', 'ArchiveFiles', fallback=True)
 # True, if False - old files should be deleted manually before next session
@@ -69,10 +127,95 @@ REMOVE_UPLOADED = config.getboolean('Behaviour', 'RemoveUploaded', fallback=True
 MOVE_UPLOADED = config.getboolean('Behaviour', 'MoveUploaded', fallback=False)
 # True, will delete empty upload folders, will leave root folder, if False only files will be removed or moved if set
 REMOVE_FOLDERS = config.getboolean('Behaviour', 'RemoveFolders', fallback=True)
+# True, skip files not changed since the last upload, used only if uploaded files are neither moved nor removed
+SKIP_UNCHANGED = config.getboolean('Behaviour', 'SkipUnchanged', fallback=True)
+# False, if True files larger than the cloud allows are uploaded by volumes with a manifest, not archived
+SPLIT_LARGE = config.getboolean('Behaviour', 'SplitLarge', fallback=False)
+# none, files of a folder not fitting the cloud free space are chosen by: none - walk order, newest - modification
+# time, smallest - size (the most files fit)
+SPACE_POLICY = config.get('Behaviour', 'SpacePolicy', fallback='none')
+# True, cloud folders created by previous runs are recorded locally and not created again
+CACHE_FOLDERS = config.getboolean('Behaviour', 'CacheFolders', fallback=True)
+# False, if True cloud folders are listed before uploading and files already present in them are skipped
+SKIP_EXISTING = config.getboolean('Behaviour', 'SkipExisting', fallback=False)
+# False, if True small files of each folder are packed into bundle archives uploaded as single cloud objects
+BUNDLE_FILES = config.getboolean('Behaviour', 'BundleFiles', fallback=False)
+# False, if True archive entries get fixed timestamps and attributes and bundle members are sorted by name,
+# so the same contents always make the same archive (and cloud hash), original modification times are not kept
+REPRODUCIBLE_ARCHIVES = config.getboolean('Behaviour', 'ReproducibleArchives', fallback=False)
+# False, if True the uploader keeps running and uploads files as they land in the upload folder
+WATCH = config.getboolean('Behaviour', 'Watch', fallback=False)
+###--------------------------------------###
+
+###----- PERFORMANCE CONFIGURATION PARAMETERS-------###
+# 4, number of files posted and added simultaneously, 1 - sequential upload
+UPLOAD_WORKERS = config.getint('Performance', 'UploadWorkers', fallback=4)
+# 'sync', upload engine: 'sync' - requests with threads, 'async' - asyncio with aiohttp (should be installed)
+ENGINE = config.get('Performance', 'Engine', fallback='sync')
+# 100, maximum number of simultaneous requests of the asyncio engine
+ASYNC_LIMIT = config.getint('Performance', 'AsyncLimit', fallback=100)
+# True, try to add file by locally computed hash before posting its contents
+HASH_FIRST = config.getboolean('Performance', 'HashFirst', fallback=True)
+# False, if True files are archived on the fly while posting, no archives are written to disk
+STREAM_ARCHIVES = config.getboolean('Performance', 'StreamArchives', fallback=False)
+# number of CPUs if ARCHIVE_FILES is set else 0, number of processes archiving files ahead of upload,
+# 0 - files are archived one by one before upload
+COMPRESS_WORKERS = config.getint('Performance', 'CompressWorkers', fallback=(os.cpu_count() or 1) if ARCHIVE_FILES else 0)
+# 8, maximum number of files being archived by processes or waiting for upload
+COMPRESS_QUEUE = config.getint('Performance', 'CompressQueue', fallback=8)
+# deflate, archives compression codec: deflate, bz2 or lzma
+COMPRESSION = config.get('Performance', 'Compression', fallback='deflate')
+# -1, compression level: 0-9 for deflate, 1-9 for bz2, ignored by lzma, -1 - the codec's default
+COMPRESS_LEVEL = config.getint('Performance', 'CompressLevel', fallback=-1)
+# 64, kilobytes of each file compressed to estimate its compressibility before archiving, 0 - no estimation
+COMPRESS_SAMPLE = config.getint('Performance', 'CompressSample', fallback=64)
+# 0.9, files with estimated archive to file size ratio above this are uploaded as is
+COMPRESS_THRESHOLD = config.getfloat('Performance', 'CompressThreshold', fallback=0.9)
+# 1024, files smaller than this (kilobytes) are bundled if BUNDLE_FILES is set
+BUNDLE_THRESHOLD = config.getint('Performance', 'BundleThreshold', fallback=1024)
+# 256, maximum total size (megabytes) of files packed into one bundle
+BUNDLE_SIZE = config.getint('Performance', 'BundleSize', fallback=256)
+# 2, seconds a watched file should stay unchanged before upload
+WATCH_DEBOUNCE = config.getfloat('Performance', 'WatchDebounce', fallback=2)
+# 60, minutes between full rescans of the watched upload folder, 0 - no rescans
+WATCH_RESCAN = config.getfloat('Performance', 'WatchRescan', fallback=60)
+# 10, seconds between upload folder scans if file system events are not available (non Linux systems)
+WATCH_POLL = config.getfloat('Performance', 'WatchPoll', fallback=10)
+# 1024, volume size (megabytes) of split large files, should be less than 2048
+VOLUME_SIZE = config.getint('Performance', 'VolumeSize', fallback=1024)
+# 5, maximum number of retries of failed idempotent requests (file posting, cloud information requests)
+RETRIES = config.getint('Performance', 'Retries', fallback=5)
+# 2, maximum number of retries of failed non-idempotent requests (authorization, adding, creating)
+RETRIES_NON_IDEMPOTENT = config.getint('Performance', 'RetriesNonIdempotent', fallback=2)
+# 1, first retry maximum delay (seconds), doubled by each next retry
+BACKOFF_BASE = config.getfloat('Performance', 'BackoffBase', fallback=1)
+# 60, maximum delay (seconds) between retries
+BACKOFF_MAX = config.getfloat('Performance', 'BackoffMax', fallback=60)
+# 24, hours the cached cloud session is reused since the last run, 0 - logging in by each run
+SESSION_LIFETIME = config.getfloat('Performance', 'SessionLifetime', fallback=24)
+# 100, number of accepted files between cloud free space requests, 0 - free space is requested once
+SPACE_RESYNC = config.getint('Performance', 'SpaceResync', fallback=100)
+# 0, posted bytes per second limit (kilobytes) shared by all uploads, 0 - unlimited
+BANDWIDTH_LIMIT = config.getint('Performance', 'BandwidthLimit', fallback=0)
+# time of day bandwidth limits overriding BANDWIDTH_LIMIT, i.e.: 09:00-18:00=512, 18:00-09:00=0
+BANDWIDTH_SCHEDULE = config.get('Performance', 'BandwidthSchedule', fallback='')
+# False, if True the number of simultaneous requests is decreased by half on cloud errors and slow responses,
+# and increased by one after the number of successful requests
+ADAPTIVE_CONCURRENCY = config.getboolean('Performance', 'AdaptiveConcurrency', fallback=False)
+# time of day limits of simultaneous requests, i.e.: 09:00-18:00=2
+CONCURRENCY_SCHEDULE = config.get('Performance', 'ConcurrencySchedule', fallback='')
 ###--------------------------------------###
 
 LOG_FILE  = './upload.log' # log file path relative to the module location
+MANIFEST_FILE = './.manifest' # uploaded files index (sqlite database), will be created next to configuration file
+MANIFEST_COMMIT_EVERY = 100 # 100, number of recorded files between index commits
+JOURNAL_FILE = './.journal' # posted but not yet added files, lets the next run add them without posting
+SESSION_FILE = './.session' # cached cloud session cookies, CSRF token and upload domain
+FOLDERS_FILE = './.folders' # existing cloud folders index (sqlite database)
 CLOUD_URL = 'https://cloud.mail.ru/api/v2/'
+AUTH_URL = 'https://auth.mail.ru/cgi-bin/auth?lang=ru_RU&from=authpopup'
+ENGINES = ('sync', 'async')
+SPACE_POLICIES = ('none', 'newest', 'smallest')
 LOGIN_CHECK_STRING = '"storages"' # simple way to check successful cloud authorization
 VERIFY_SSL = True # True, use False only for debug and if you know what you're doing
 CLOUD_DOMAIN_ORD = 2 # 2 - practice, 1 - theory
@@ -80,26 +223,1260 @@ API_VER = 2 # 2 - constant so far
 TIME_AMEND = '0246' # '0246', exact meaning has not been quite sorted out yet
 CLOUD_CONFLICT = 'strict' # 'strict' - should remain constant at least until 'rename' implementation
 MAX_FILE_SIZE = 2*1024*1024*1024 # 2*1024*1024*1024 (bytes ~ 2 GB), API constraint
-FILES_TO_PRESERVE = ('application/zip', ) # do not archive already zipped files
+HASH_CHUNK_SIZE = 1024*1024 # 1024*1024 (bytes), file is read by chunks of this size while hashing
+STREAM_CHUNK_SIZE = 256*1024 # 256*1024 (bytes), file is read by chunks of this size while archiving on the fly
+POST_BUFFER_SIZE = 256*1024 # 256*1024 (bytes), posted file is read into a reused buffer of this size
+HASH_SALT = b'mrCloud' # cloud hash prefix
+HASH_MIN_SIZE = 21 # 21 (bytes), smaller files' hash is their contents
+LISTING_LIMIT = 500 # 500, number of cloud folder entries requested at once
+SCAN_BATCH = 100 # 100, maximum number of scanned folders waiting for upload
+SCAN_BATCH_FILES = 10000 # 10000, scanned folders batch is closed when it has this number of files
+RETRY_CODES = (429, 500, 502, 503, 504) # responses worth retrying
+AUTH_ERROR_CODES = (401, 403) # responses to rejected CSRF token
+LATENCY_FACTOR = 3 # 3, response slower than this times the average latency is a congestion signal
+LATENCY_SMOOTHING = 0.1 # 0.1, weight of the latest response in the average latency
+NODE_FAILURES = 3 # 3, upload node failing this number of posts in a row is skipped for a while
+NODE_COOLDOWN = 60 # 60 (seconds), time a failing upload node is skipped for
+NODE_ERROR_RATE = 0.5 # 0.5, upload node with higher average share of failed posts is degraded
+NODE_SMOOTHING = 0.2 # 0.2, weight of the latest post in the upload node averages
+HOST_POOLS = 16 # 16, number of hosts (cloud, auth and upload nodes) keeping their own connection pools
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300) # seconds, latency histograms
+RATIO_BUCKETS = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1) # archive to file size, compression histogram
+METRICS_PREFIX = 'mailru_uploader_' # Prometheus metrics names prefix
+# do not archive already compressed files
+FILES_TO_PRESERVE = ('application/zip', 'application/gzip', 'application/x-bzip2', 'application/x-xz',
+                     'application/x-7z-compressed', 'application/x-rar-compressed', 'application/vnd.rar',
+                     'image/jpeg', 'image/png', 'image/gif', 'image/webp', 'audio/mpeg', 'audio/mp4', 'audio/ogg',
+                     'video/mp4', 'video/mpeg', 'video/quicktime', 'video/webm', 'video/x-matroska', 'video/x-msvideo')
+COMPRESSION_CODECS = {'deflate': zipfile.ZIP_DEFLATED, 'bz2': zipfile.ZIP_BZIP2, 'lzma': zipfile.ZIP_LZMA}
+ZIP_OVERHEAD = 114 # 114 (bytes), headers and data descriptor of a single file zip archive, not counting the file name stored twice
+ARCHIVE_DATE_TIME = (1980, 1, 1, 0, 0, 0) # timestamp of the reproducible archives entries, the earliest zip allows
+ARCHIVE_FILE_MODE = 0o644 # unix permissions of the reproducible archives entries
+BUNDLE_INDEX = 'bundle-index.json' # bundle archive member listing the other members
+# inotify(7) constants
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+INOTIFY_EVENT = struct.Struct('iIII') # wd, mask, cookie, name length
 DEFAULT_FILETYPE = 'text/plain' # 'text/plain' is good option
 # do not upload this files (only for module's directory)
-FILES_TO_SKIP = set((os.path.basename(CONFIG_FILE), os.path.basename(LOG_FILE)))
+FILES_TO_SKIP = set((os.path.basename(CONFIG_FILE), os.path.basename(LOG_FILE), os.path.basename(METRICS_FILE),
+                     os.path.basename(MANIFEST_FILE), os.path.basename(MANIFEST_FILE) + '-journal',
+                     os.path.basename(JOURNAL_FILE), os.path.basename(SESSION_FILE),
+                     os.path.basename(FOLDERS_FILE), os.path.basename(FOLDERS_FILE) + '-journal'))
 CACERT_FILE = 'cacert.pem'
 EMAIL_REGEXP = re.compile(r'^.+\@.+\..+$')
 LOGGER = None
+LIMITER = None # TokenBucket of posted bytes, set up by main
+CONTROLLER = None # ConcurrencyController of simultaneous requests, set up by main
+METRICS = None # Metrics of the run, set up by main
+DISPOSER = None # Disposer of the uploaded files, set up by main if they are moved or removed
+ARCHIVE_HASHES = {} # archive -> (cloud hash, size) computed while archiving, taken by the archive upload
+CSRF_TOKENS = {} # stale CSRF token -> refreshed one
+CSRF_ACCOUNTS = {} # CSRF token -> (login, password) of the account it belongs to, if not the main one
+CSRF_LOCK = threading.Lock()
+ASYNC_CSRF_LOCKS = {} # event loop -> asyncio.Lock of its CSRF token refreshes
 
 
 class CallsCounter():
-    """ instantiate with a target callable to count calls """
+    """ instantiate with a target callable to count calls
+    thread safe, could be shared by upload workers
+    """
     def __init__(self, callable):
         self.calls = 0
         self.callable=callable
+        self.lock = threading.Lock()
 
     def __call__(self, *args, **kwargs):
-        self.calls += 1
+        with self.lock:
+            self.calls += 1
         return self.callable(*args, **kwargs)
 
 
+class Histogram():
+    """ cumulative histogram of observed values, Prometheus style """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    def to_dict(self):
+        return {'buckets': dict(zip(map(str, self.buckets), self.counts)), 'sum': self.sum, 'count': self.count}
+
+
+class Metrics():
+    """ run telemetry: time, calls, bytes and errors by upload phase and by cloud request,
+    latency histograms of both, archives compression ratios
+    thread safe, could be shared by upload workers, exported as JSON and Prometheus text
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.phases = {}
+        self.requests = {}
+        self.compression = {'files': 0, 'file_bytes': 0, 'archive_bytes': 0, 'ratio': Histogram(RATIO_BUCKETS)}
+        self.values = {}
+
+    def add_phase(self, phase, seconds, size=0, error=False):
+        with self.lock:
+            stats = self.phases.setdefault(phase, {'seconds': 0.0, 'calls': 0, 'bytes': 0, 'errors': 0,
+                                                   'latency': Histogram()})
+            stats['seconds'] += seconds
+            stats['calls'] += 1
+            stats['bytes'] += size
+            stats['errors'] += error
+            stats['latency'].observe(seconds)
+
+    def add_request(self, call, seconds, status):
+        """ param: status - HTTP status code, 'error' if no response was received """
+        with self.lock:
+            stats = self.requests.setdefault(call, {'seconds': 0.0, 'calls': 0, 'statuses': {},
+                                                    'latency': Histogram()})
+            stats['seconds'] += seconds
+            stats['calls'] += 1
+            stats['statuses'][str(status)] = stats['statuses'].get(str(status), 0) + 1
+            stats['latency'].observe(seconds)
+
+    def add_compression(self, file_size, archive_size):
+        with self.lock:
+            self.compression['files'] += 1
+            self.compression['file_bytes'] += file_size
+            self.compression['archive_bytes'] += archive_size
+            self.compression['ratio'].observe(archive_size / file_size if file_size else 1)
+
+    def set_value(self, name, value):
+        with self.lock:
+            self.values[name] = value
+
+    def to_dict(self):
+        to_plain = lambda stats: {key: value.to_dict() if isinstance(value, Histogram) else value
+                                  for key, value in stats.items()}
+        with self.lock:
+            return {'started': datetime.datetime.fromtimestamp(self.started).isoformat(),
+                    'duration': time.time() - self.started,
+                    'values': dict(self.values),
+                    'phases': {phase: to_plain(stats) for phase, stats in self.phases.items()},
+                    'requests': {call: to_plain(stats) for call, stats in self.requests.items()},
+                    'compression': to_plain(self.compression)}
+
+    def to_prometheus(self):
+        """ returns metrics in Prometheus text exposition format """
+        metrics = self.to_dict()
+        lines = []
+
+        def add(name, kind, samples):
+            lines.append('# TYPE {}{} {}'.format(METRICS_PREFIX, name, kind))
+            for suffix, labels, value in samples:
+                labels = ','.join('{}="{}"'.format(key, value) for key, value in labels)
+                lines.append('{}{}{}{} {}'.format(METRICS_PREFIX, name, suffix, '{' + labels + '}' if labels else '',
+                                                  value))
+
+        def histogram_samples(histogram, labels=()):
+            samples = [('_bucket', labels + (('le', bound), ), count) for bound, count in histogram['buckets'].items()]
+            return samples + [('_bucket', labels + (('le', '+Inf'), ), histogram['count']),
+                              ('_sum', labels, histogram['sum']), ('_count', labels, histogram['count'])]
+
+        add('run_timestamp_seconds', 'gauge', [('', (), self.started)])
+        add('run_duration_seconds', 'gauge', [('', (), metrics['duration'])])
+        for name, value in sorted(metrics['values'].items()):
+            add(name, 'gauge', [('', (), value)])
+        phases = sorted(metrics['phases'].items())
+        for field in ('seconds', 'calls', 'bytes', 'errors'):
+            add('phase_{}_total'.format(field), 'counter', [('', (('phase', phase), ), stats[field])
+                                                            for phase, stats in phases])
+        add('phase_duration_seconds', 'histogram', [sample for phase, stats in phases
+                                                    for sample in histogram_samples(stats['latency'],
+                                                                                    (('phase', phase), ))])
+        requests = sorted(metrics['requests'].items())
+        add('requests_total', 'counter', [('', (('call', call), ('status', status)), count)
+                                          for call, stats in requests
+                                          for status, count in sorted(stats['statuses'].items())])
+        add('request_duration_seconds', 'histogram', [sample for call, stats in requests
+                                                      for sample in histogram_samples(stats['latency'],
+                                                                                      (('call', call), ))])
+        compression = metrics['compression']
+        for field in ('files', 'file_bytes', 'archive_bytes'):
+            add('compressed_{}_total'.format(field), 'counter', [('', (), compression[field])])
+        add('compression_ratio', 'histogram', histogram_samples(compression['ratio']))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, file, text):
+        """ replaces the file at once, so collectors never read it half written """
+        temp_file = file + '.tmp'
+        with open(temp_file, 'w') as f:
+            f.write(text)
+        os.replace(temp_file, file)
+
+    def export(self, json_file=METRICS_FILE, prometheus_file=PROMETHEUS_FILE):
+        if json_file:
+            self.write(json_file, json.dumps(self.to_dict(), indent=2))
+        if prometheus_file:
+            self.write(prometheus_file, self.to_prometheus())
+
+
+def timed(phase, measure=None):
+    """ decorator recording calls of the function or coroutine function to the METRICS phase
+    param: measure - callable returning the number of processed bytes by the call result,
+                     None if the call failed
+    """
+    def record(start, result=None, failed=False):
+        size = 0
+        if measure and not failed:
+            size = measure(result)
+            failed = size is None
+        if METRICS:
+            METRICS.add_phase(phase, time.perf_counter() - start, size=size or 0, error=failed)
+
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    result = await func(*args, **kwargs)
+                except:
+                    record(start, failed=True)
+                    raise
+                record(start, result)
+                return result
+        else:
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    result = func(*args, **kwargs)
+                except:
+                    record(start, failed=True)
+                    raise
+                record(start, result)
+                return result
+        return wrapper
+    return decorator
+
+
+def timed_iter(phase, iterable):
+    """ yields items of the iterable recording time taken to produce each of them to the METRICS phase """
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        if METRICS:
+            METRICS.add_phase(phase, time.perf_counter() - start)
+        yield item
+
+
+def get_result_size(result):
+    """ measure of the hashing and posting functions, (hash, size) or (None, None) on failure """
+    return result[1] if result[0] else None
+
+
+def get_success(result):
+    """ measure of the cloud commands, not processing any bytes """
+    return 0 if result else None
+
+
+class UploadManifest():
+    """ on-disk index of uploaded files, keeps relative path, size, mtime and cloud hash
+    thread safe, could be shared by upload workers
+    """
+    def __init__(self, db_file=MANIFEST_FILE, base=UPLOAD_PATH):
+        self.base = base
+        self.lock = threading.Lock()
+        self.uncommitted = 0
+        self.db = sqlite3.connect(db_file, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS files '
+                        '(path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, hash TEXT, account TEXT)')
+        # manifests of the previous versions have no account column
+        if 'account' not in [row[1] for row in self.db.execute('PRAGMA table_info(files)')]:
+            self.db.execute('ALTER TABLE files ADD COLUMN account TEXT')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get_key(self, file):
+        """ file path relative to the upload folder with forward slashes """
+        return os.path.relpath(file, self.base).replace('\\', '/')
+
+    def is_unchanged(self, file, stat=None):
+        """ returns True if the file has been uploaded and not changed since """
+        stat = stat or os.stat(file)
+        with self.lock:
+            row = self.db.execute('SELECT size, mtime FROM files WHERE path = ?', (self.get_key(file),)).fetchone()
+        return row == (stat.st_size, stat.st_mtime_ns)
+
+    def add(self, file, hash=None, account=None):
+        """ records uploaded file and the login of the account it is uploaded to """
+        stat = os.stat(file)
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO files (path, size, mtime, hash, account) VALUES (?, ?, ?, ?, ?)',
+                            (self.get_key(file), stat.st_size, stat.st_mtime_ns, hash, account))
+            self.uncommitted += 1
+            if self.uncommitted >= MANIFEST_COMMIT_EVERY:
+                self.db.commit()
+                self.uncommitted = 0
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+
+class FolderCache():
+    """ on-disk index of the cloud folders known to exist, kept per cloud account
+    folders removed from the cloud by other means are not detected, remove the index then
+    """
+    def __init__(self, db_file=FOLDERS_FILE, login=LOGIN):
+        self.login = login
+        self.db = sqlite3.connect(db_file)
+        self.db.execute('CREATE TABLE IF NOT EXISTS folders (login TEXT, path TEXT, PRIMARY KEY (login, path))')
+        self.known = set(row[0] for row in self.db.execute('SELECT path FROM folders WHERE login = ?', (login,)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __contains__(self, folder):
+        return folder in self.known
+
+    def add(self, folders):
+        """ records existing cloud folders """
+        folders = set(folders) - self.known
+        self.db.executemany('INSERT OR REPLACE INTO folders (login, path) VALUES (?, ?)',
+                            ((self.login, folder) for folder in folders))
+        self.db.commit()
+        self.known.update(folders)
+
+    def close(self):
+        self.db.close()
+
+
+class UploadJournal():
+    """ write-ahead journal of posted files, lets the next run add files posted by a crashed one
+    without posting them again, records are valid while the file is not changed
+    and are kept by the account the file is posted to, as posted contents could be added by it only
+    thread safe, could be shared by upload workers
+    """
+    def __init__(self, journal_file=JOURNAL_FILE):
+        self.journal_file = journal_file
+        self.lock = threading.Lock()
+        self.posted = {}
+        if os.path.isfile(journal_file):
+            with open(journal_file) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # last line could be incomplete after a crash
+                        continue
+                    if record.get('added'):
+                        self.posted.pop(record['key'], None)
+                    else:
+                        self.posted[record['key']] = record
+        self.fd = open(journal_file, mode='a')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get_key(self, file, part='', login=LOGIN):
+        """ account and absolute file path, with cloud name of the part if the file is posted by parts """
+        key = login + ':' + os.path.abspath(file)
+        return key + ':' + part if part else key
+
+    def write(self, record):
+        self.fd.write(json.dumps(record) + '\n')
+        self.fd.flush()
+
+    def get_posted(self, file, part='', login=LOGIN):
+        """ returns (hash, size) of the posted and unchanged file, (None, None) otherwise """
+        stat = os.stat(file)
+        with self.lock:
+            record = self.posted.get(self.get_key(file, part, login))
+        if record and (record['file_size'], record['mtime']) == (stat.st_size, stat.st_mtime_ns):
+            return (record['hash'], record['size'])
+        return (None, None)
+
+    def add_posted(self, file, hash, size, part='', login=LOGIN):
+        stat = os.stat(file)
+        record = {'key': self.get_key(file, part, login), 'file_size': stat.st_size, 'mtime': stat.st_mtime_ns,
+                  'hash': hash, 'size': size}
+        with self.lock:
+            self.posted[record['key']] = record
+            self.write(record)
+
+    def forget(self, file, part='', login=LOGIN):
+        """ forgets the posted file, as it is added or its hash is rejected by the cloud """
+        key = self.get_key(file, part, login)
+        with self.lock:
+            if self.posted.pop(key, None):
+                self.write({'key': key, 'added': True})
+
+    def close(self):
+        """ removes the journal if there are no files left to add, compacts it otherwise """
+        with self.lock:
+            self.fd.close()
+            if self.posted:
+                with open(self.journal_file, mode='w') as f:
+                    for record in self.posted.values():
+                        f.write(json.dumps(record) + '\n')
+            else:
+                os.unlink(self.journal_file)
+
+
+class StreamBuffer():
+    """ unseekable write target for zipfile, written data is popped by the reader """
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+class CloudHashWriter():
+    """ unseekable write target for zipfile computing the cloud hash of the written data, as get_cloud_hash does,
+    the data is passed on to the file
+    """
+    def __init__(self, f):
+        self.f = f
+        self.sha1 = hashlib.sha1(HASH_SALT)
+        self.head = b''
+        self.size = 0
+
+    def write(self, data):
+        if self.size < HASH_MIN_SIZE:
+            self.head += bytes(data[:HASH_MIN_SIZE - self.size])
+        self.sha1.update(data)
+        self.size += len(data)
+        return self.f.write(data)
+
+    def flush(self):
+        self.f.flush()
+
+    def get_hash(self):
+        """ returns (hash, size) of the written data """
+        if self.size < HASH_MIN_SIZE:
+            return (self.head.ljust(HASH_MIN_SIZE - 1, b'\0').hex().upper(), self.size)
+        sha1 = self.sha1.copy()
+        sha1.update(str(self.size).encode())
+        return (sha1.hexdigest().upper(), self.size)
+
+
+class ArchiveStream():
+    """ iterable multipart/form-data body with the file zipped on the fly
+    keeps about one chunk of compressed data in memory, counts streamed archive bytes
+    archive is named after the file with 'zip' extension, same as zip_file does
+    """
+    def __init__(self, file, chunk_size=STREAM_CHUNK_SIZE):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.filename = os.path.basename(file) + '.zip'
+        self.boundary = uuid4().hex
+        self.content_type = 'multipart/form-data; boundary={}'.format(self.boundary)
+        self.size = 0
+
+    def __iter__(self):
+        self.size = 0
+        yield ('--{}\r\nContent-Disposition: form-data; name="file"; filename="{}"\r\n'
+               'Content-Type: application/zip\r\n\r\n').format(self.boundary, quote_plus(self.filename)).encode()
+        for chunk in self.iter_archive():
+            # empty chunk would terminate chunked transfer
+            if chunk:
+                self.size += len(chunk)
+                yield chunk
+        yield '\r\n--{}--\r\n'.format(self.boundary).encode()
+
+    def iter_archive(self):
+        buffer = StreamBuffer()
+        info = get_zip_info(self.file, os.path.basename(self.file), *get_codec())
+        with zipfile.ZipFile(buffer, mode='w') as zf:
+            with open(self.file, 'rb') as f, zf.open(info, mode='w') as entry:
+                for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                    entry.write(chunk)
+                    yield buffer.pop()
+            yield buffer.pop()
+        # central directory is written on close
+        yield buffer.pop()
+
+
+class Compressor():
+    """ archives files in a process pool ahead of the uploader
+    keeps no more than queue_size files being archived or waiting to be taken,
+    archives are returned in the order of the original files
+    """
+    def __init__(self, workers=COMPRESS_WORKERS, queue_size=COMPRESS_QUEUE):
+        self.queue_size = max(1, queue_size)
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown()
+
+    def map(self, files):
+        """ yields archives of the archivable files, other files as is """
+        queue = deque()
+        for file in files:
+            if is_archivable(file):
+                queue.append(self.executor.submit(compress_file, file))
+            else:
+                queue.append(file)
+            if len(queue) >= self.queue_size:
+                yield self.get(queue.popleft())
+        while queue:
+            yield self.get(queue.popleft())
+
+    @timed('archive')
+    def get(self, item):
+        """ returns the archive, waiting for it if necessary """
+        if isinstance(item, str):
+            return item
+        file, archive, hash, error, size = item.result()
+        if hash:
+            ARCHIVE_HASHES[archive] = hash
+        log_archiving(file, archive, error, size)
+        return archive
+
+
+class SpaceLedger():
+    """ local account of the cloud free space, requested once and decreased by the accepted files
+    space of the files failed to upload is returned, the account is replaced by the cloud's one
+    after every resync_every accepted files
+    thread safe, could be shared by upload workers
+    """
+    def __init__(self, space=0, resync_every=SPACE_RESYNC):
+        self.lock = threading.Lock()
+        self.space = space
+        self.resync_every = resync_every
+        self.reserved = {}
+        self.accepted = 0
+
+    def reserve(self, file, size):
+        """ returns True and takes the file size off the free space if the file fits """
+        with self.lock:
+            if size >= self.space:
+                return False
+            self.space -= size
+            self.reserved[file] = self.reserved.get(file, 0) + size
+            self.accepted += 1
+            return True
+
+    def settle(self, file, uploaded=True):
+        """ the file is no longer in flight, its space is returned if the file is not uploaded """
+        with self.lock:
+            size = self.reserved.pop(file, 0)
+            if not uploaded:
+                self.space += size
+
+    def settle_future(self, file, future):
+        """ settles the file by the finished upload future """
+        self.settle(file, uploaded=not future.cancelled() and not future.exception() and bool(future.result()))
+
+    def get_in_flight(self):
+        """ returns space reserved by the files in flight """
+        with self.lock:
+            return sum(self.reserved.values())
+
+    def is_stale(self):
+        return self.resync_every > 0 and self.accepted >= self.resync_every
+
+    def sync(self, space):
+        """ replaces the account with the cloud's free space, files in flight are not counted by the cloud yet """
+        with self.lock:
+            self.space = space - sum(self.reserved.values())
+            self.accepted = 0
+
+
+class CloudAccount():
+    """ cloud account files are uploaded to: credentials, cloud folders cache, upload nodes with their health,
+    session with its CSRF token and upload domain, and free space ledger, set up by the upload engine
+    session cookies are kept to reuse the session by the next upload of the same accounts (watch mode)
+    """
+    def __init__(self, login=LOGIN, password=PASSWORD, folders=None):
+        self.login = login
+        self.password = password
+        self.folders = folders
+        self.nodes = UploadNodes()
+        self.session = None
+        self.csrf = None
+        self.domain = None
+        self.ledger = None
+        self.cookies = None
+
+    def restore_session(self):
+        """ returns True and sets the cookies kept by the previous upload to the new session, False if there are none
+        the token could be refreshed by the previous upload
+        """
+        if self.cookies is None:
+            return False
+        load_cookies(self.session, self.cookies)
+        self.csrf = get_fresh_csrf(self.csrf)
+        return True
+
+    def keep_session(self):
+        """ keeps the session cookies for the next upload """
+        self.cookies = dump_cookies(self.session)
+
+    def close(self):
+        if self.folders:
+            self.folders.close()
+
+
+class Placement():
+    """ placement of the files to the accounts, used as a SpaceLedger of all the accounts together
+    each file goes to the least loaded account (bytes in flight) among the ones it fits, the freest one on ties
+    thread safe, could be shared by upload workers
+    """
+    def __init__(self, accounts):
+        self.lock = threading.Lock()
+        self.accounts = accounts
+        self.placed = {}
+
+    @property
+    def space(self):
+        return sum(max(0, account.ledger.space) for account in self.accounts)
+
+    def reserve(self, file, size):
+        """ returns True and reserves the file size in the account picked for the file if it fits any """
+        with self.lock:
+            accounts = sorted(self.accounts, key=lambda account: (account.ledger.get_in_flight(),
+                                                                  -account.ledger.space))
+            for account in accounts:
+                if account.ledger.reserve(file, size):
+                    self.placed[file] = account
+                    return True
+            return False
+
+    def get_account(self, file):
+        """ returns the account the file is placed to """
+        return self.placed[file]
+
+    def settle(self, file, uploaded=True):
+        """ the file is no longer in flight, its space is returned if the file is not uploaded """
+        with self.lock:
+            account = self.placed.pop(file, None)
+        if account:
+            account.ledger.settle(file, uploaded=uploaded)
+
+    def settle_future(self, file, future):
+        """ settles the file by the finished upload future """
+        self.settle(file, uploaded=not future.cancelled() and not future.exception() and bool(future.result()))
+
+
+class RemoteIndex():
+    """ in-memory listing of the cloud folders: file name -> (size, hash) per cloud folder """
+    def __init__(self):
+        self.folders = {}
+
+    def add(self, folder, items):
+        """ records files of the cloud folder listing page """
+        files = self.folders.setdefault(folder, {})
+        for item in items:
+            if item.get('kind') == 'file':
+                files[item['name']] = (item.get('size'), item.get('hash'))
+
+    def get(self, folder, name):
+        """ returns (size, hash) of the cloud file, None if it is not present """
+        return self.folders.get(folder, {}).get(name)
+
+
+class TokenBucket():
+    """ bytes per second limiter shared by all uploads, bursts up to one second of the rate
+    the rate is looked up in the time of day schedule by each request, 0 - unlimited
+    thread safe, blocking and asyncio waits are supported
+    """
+    def __init__(self, rate=0, schedule=None):
+        self.default_rate = rate
+        self.schedule = schedule or []
+        self.lock = threading.Lock()
+        self.tokens = self.get_rate()
+        self.updated = time.monotonic()
+
+    def get_rate(self):
+        return get_scheduled(self.schedule, self.default_rate)
+
+    def reserve(self, size):
+        """ takes size bytes, returns delay (seconds) before they could be sent """
+        rate = self.get_rate()
+        if rate <= 0:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(rate, self.tokens + (now - self.updated) * rate) - size
+            self.updated = now
+            return max(0, -self.tokens / rate)
+
+    def throttle(self, size):
+        delay = self.reserve(size)
+        if delay:
+            time.sleep(delay)
+
+    async def async_throttle(self, size):
+        delay = self.reserve(size)
+        if delay:
+            await asyncio.sleep(delay)
+
+    def iter(self, chunks):
+        """ yields chunks no faster than the rate """
+        for chunk in chunks:
+            self.throttle(len(chunk))
+            yield chunk
+
+    async def async_iter(self, chunks):
+        """ asyncio version of iter, chunks is an asynchronous iterator """
+        async for chunk in chunks:
+            await self.async_throttle(len(chunk))
+            yield chunk
+
+
+class ConcurrencyController():
+    """ limits the number of simultaneous requests
+    adaptive limit is increased by one after the limit's number of successful requests (additive increase)
+    and halved by a congestion signal (multiplicative decrease): RETRY_CODES responses, connection errors
+    or a response LATENCY_FACTOR times slower than the average, no more than once per average latency
+    the maximum is looked up in the time of day schedule
+    thread safe, blocking and asyncio waits are supported (one kind per instance),
+    asyncio waits are bound to the running event loop, each upload of the watch mode runs its own one
+    """
+    def __init__(self, maximum=UPLOAD_WORKERS, minimum=1, schedule=None, adaptive=True):
+        self.default_maximum = maximum
+        self.minimum = max(1, minimum)
+        self.schedule = schedule or []
+        self.adaptive = adaptive
+        self.limit = self.get_maximum()
+        self.in_flight = 0
+        self.successes = 0
+        self.latency = None
+        self.decreased = 0.0
+        self.condition = threading.Condition()
+        self.async_loop = None
+        self.async_condition = None
+
+    def get_maximum(self):
+        return max(self.minimum, int(get_scheduled(self.schedule, self.default_maximum)))
+
+    def record(self, latency=None, congested=False):
+        """ adjusts the limit by the request outcome
+        param: latency - seconds, only requests without large bodies are comparable
+        """
+        maximum = self.get_maximum()
+        if not self.adaptive:
+            self.limit = maximum
+            return
+        if latency is not None:
+            if self.latency is not None and latency > self.latency * LATENCY_FACTOR:
+                congested = True
+            self.latency = latency if self.latency is None else self.latency + (latency - self.latency) * LATENCY_SMOOTHING
+        now = time.monotonic()
+        if congested:
+            if now - self.decreased > (self.latency or 0):
+                self.limit = max(self.minimum, self.limit // 2)
+                self.decreased = now
+                self.successes = 0
+                if LOGGER:
+                    LOGGER.info('Cloud congestion, simultaneous requests limit decreased to {}'.format(self.limit))
+        else:
+            self.successes += 1
+            if self.successes >= self.limit:
+                self.limit += 1
+                self.successes = 0
+        self.limit = min(self.limit, maximum)
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, latency=None, congested=False):
+        with self.condition:
+            self.in_flight -= 1
+            self.record(latency, congested)
+            self.condition.notify_all()
+
+    def get_async_condition(self):
+        """ returns asyncio condition of the running event loop """
+        loop = asyncio.get_running_loop()
+        if self.async_loop is not loop:
+            self.async_loop = loop
+            self.async_condition = asyncio.Condition()
+        return self.async_condition
+
+    async def async_acquire(self):
+        async with self.get_async_condition():
+            await self.async_condition.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+
+    async def async_release(self, latency=None, congested=False):
+        async with self.get_async_condition():
+            self.in_flight -= 1
+            self.record(latency, congested)
+            self.async_condition.notify_all()
+
+
+class UploadNodes():
+    """ upload nodes returned by the dispatcher with their health, thread safe
+    each post goes to the node with the lowest expected cost: average seconds per posted megabyte (plus one),
+    multiplied by the number of its posts in flight and divided by its average share of successful posts,
+    nodes failing NODE_FAILURES posts in a row are skipped for NODE_COOLDOWN seconds,
+    is_stale is True once all the nodes are degraded, the dispatcher should be asked again then
+    """
+    def __init__(self, urls=None):
+        self.lock = threading.Lock()
+        self.nodes = {}
+        self.stale = False
+        self.update(urls or [])
+
+    def update(self, urls, reset=False):
+        """ replaces the nodes, known ones keep their health, or their average cost only if reset """
+        with self.lock:
+            nodes = {}
+            for url in urls:
+                node = self.nodes.get(url)
+                if node is None or reset:
+                    nodes[url] = {'cost': node['cost'] if node else 0, 'errors': 0, 'failures': 0, 'down_until': 0,
+                                  'in_flight': node['in_flight'] if node else 0}
+                else:
+                    nodes[url] = node
+            self.nodes = nodes
+            self.stale = False
+
+    def get_urls(self):
+        with self.lock:
+            return list(self.nodes)
+
+    def is_stale(self):
+        return self.stale
+
+    def is_degraded(self, node, now):
+        return node['down_until'] > now or node['errors'] > NODE_ERROR_RATE
+
+    def get_score(self, node):
+        # nodes not measured yet are tried first
+        return (node['cost'] or 0.001) * (1 + node['in_flight']) / max(0.01, 1 - node['errors'])
+
+    def pick(self, domain='', previous=None):
+        """ returns the best node to post to, the domain as is if it is not one of the nodes
+        param: previous - node of the failed attempt, retried on another node if there is one
+        """
+        with self.lock:
+            if domain not in self.nodes:
+                return domain
+            now = time.monotonic()
+            candidates = [url for url, node in self.nodes.items() if node['down_until'] <= now]
+            if not candidates:
+                self.stale = True
+                candidates = list(self.nodes)
+            if len(candidates) > 1 and previous in candidates:
+                candidates.remove(previous)
+            url = min(candidates, key=lambda url: self.get_score(self.nodes[url]))
+            self.nodes[url]['in_flight'] += 1
+            return url
+
+    def record(self, url, seconds=0, size=0, failed=False):
+        """ accounts the post to the node picked for it """
+        with self.lock:
+            node = self.nodes.get(url)
+            if node is None:
+                return
+            now = time.monotonic()
+            node['in_flight'] = max(0, node['in_flight'] - 1)
+            node['errors'] += NODE_SMOOTHING * (failed - node['errors'])
+            if failed:
+                node['failures'] += 1
+                if node['failures'] >= NODE_FAILURES:
+                    node['down_until'] = now + NODE_COOLDOWN
+                    if LOGGER:
+                        LOGGER.warning('Upload node {} skipped for {} s after {} failed posts'.format(
+                            url, NODE_COOLDOWN, node['failures']))
+            else:
+                node['failures'] = 0
+                cost = seconds / (1 + size / 1024 / 1024)
+                node['cost'] += cost if not node['cost'] else NODE_SMOOTHING * (cost - node['cost'])
+            if all(self.is_degraded(node, now) for node in self.nodes.values()):
+                self.stale = True
+
+
+class FileSlice():
+    """ readable part of a file, len is the number of bytes left to read """
+    def __init__(self, file, offset=0, size=0):
+        self.fd = open(file, 'rb')
+        self.offset = offset
+        self.size = size
+        self.rewind()
+
+    def rewind(self):
+        self.fd.seek(self.offset)
+        self.left = self.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def len(self):
+        return self.left
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.left:
+            size = self.left
+        data = self.fd.read(size)
+        self.left -= len(data)
+        return data
+
+    def close(self):
+        self.fd.close()
+
+
+class UploadBody():
+    """ multipart/form-data body posting a part of a file through a fixed buffer
+    the file is opened once and read into the buffer reused by each chunk, chunks are memoryviews of it,
+    so memory does not grow with the file size or the number of retries,
+    the file is closed by close (or on exit from the with block), iterating again rewinds the body
+    param: name - posted file name, filetype - its content type
+    param: offset, size - file part to post, whole file by default
+    param: limiter - TokenBucket throttling the reads
+    """
+    def __init__(self, file, name='', filetype='application/octet-stream', offset=0, size=None, limiter=None,
+                 buffer_size=POST_BUFFER_SIZE):
+        self.file = file
+        # unbuffered, the file is read into the body buffer directly
+        self.fd = open(file, 'rb', buffering=0)
+        self.offset = offset
+        self.size = os.fstat(self.fd.fileno()).st_size - offset if size is None else size
+        self.limiter = limiter
+        self.buffer = memoryview(bytearray(buffer_size))
+        boundary = uuid4().hex
+        self.content_type = 'multipart/form-data; boundary={}'.format(boundary)
+        self.head = ('--{}\r\nContent-Disposition: form-data; name="file"; filename="{}"\r\n'
+                     'Content-Type: {}\r\n\r\n').format(boundary, quote_plus(name or os.path.basename(file)),
+                                                        filetype).encode()
+        self.tail = '\r\n--{}--\r\n'.format(boundary).encode()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self.head) + self.size + len(self.tail)
+
+    def read_chunk(self, left):
+        """ reads up to left bytes into the buffer, returns their number """
+        size = self.fd.readinto(self.buffer[:min(left, len(self.buffer))])
+        if not size:
+            raise EOFError('file {} is shorter than expected'.format(self.file))
+        return size
+
+    def __iter__(self):
+        yield self.head
+        self.fd.seek(self.offset)
+        left = self.size
+        while left > 0:
+            size = self.read_chunk(left)
+            left -= size
+            if self.limiter:
+                self.limiter.throttle(size)
+            yield self.buffer[:size]
+        yield self.tail
+
+    async def async_iter(self):
+        """ asynchronous version of iter, the file is read in the default executor
+        chunks are copied out of the buffer, as the event loop transport could keep them until sent
+        """
+        loop = asyncio.get_running_loop()
+        yield self.head
+        self.fd.seek(self.offset)
+        left = self.size
+        while left > 0:
+            size = await loop.run_in_executor(None, self.read_chunk, left)
+            left -= size
+            if self.limiter:
+                await self.limiter.async_throttle(size)
+            yield bytes(self.buffer[:size])
+        yield self.tail
+
+    def get_request(self):
+        """ returns requests keyword arguments to post the body """
+        return {'data': self, 'headers': {'Content-Type': self.content_type}}
+
+    def get_async_request(self):
+        """ returns aiohttp keyword arguments to post the body """
+        return {'data': self.async_iter(),
+                'headers': {'Content-Type': self.content_type, 'Content-Length': str(len(self))}}
+
+    def close(self):
+        self.fd.close()
+
+
+class SplitUpload():
+    """ large file uploaded by volumes named after the file with a volume number extension
+    volume records are collected to be uploaded as a manifest object after the last volume,
+    the file could be reassembled by volumes concatenation in the manifest order
+    and verified by the volumes cloud hashes
+    """
+    def __init__(self, file, cloud_path='', volume_size=VOLUME_SIZE*1024*1024):
+        assert 0 < volume_size < MAX_FILE_SIZE, 'invalid volume size: {}'.format(volume_size)
+        self.file = file
+        self.cloud_path = cloud_path
+        self.size = os.path.getsize(file)
+        self.volumes = [(offset, min(volume_size, self.size - offset)) for offset in range(0, self.size, volume_size)]
+        self.records = [None] * len(self.volumes)
+        self.manifest_name = os.path.basename(file) + '.parts.json'
+
+    def get_volume_name(self, index):
+        return '{}.{:03d}'.format(os.path.basename(self.file), index + 1)
+
+    def set_record(self, index, hash):
+        offset, size = self.volumes[index]
+        self.records[index] = {'name': self.get_volume_name(index), 'offset': offset, 'size': size, 'hash': hash}
+
+    def is_complete(self):
+        return all(self.records)
+
+    def get_manifest(self):
+        return {'name': os.path.basename(self.file), 'size': self.size, 'volumes': self.records}
+
+
+class Bundle():
+    """ small files of a folder packed into a zip archive uploaded as one cloud object
+    BUNDLE_INDEX member lists the other members with their local header offsets, sizes,
+    CRCs and modification times (left out if REPRODUCIBLE_ARCHIVES is set),
+    files are compressed unless their types are compressed already
+    the archive is written to a temporary folder, close removes it
+    param: stats - dict of file stat results by file
+    """
+    def __init__(self, files, stats):
+        self.name = 'bundle-{}-{}.zip'.format(time.strftime('%Y%m%d-%H%M%S'), uuid4().hex[:8])
+        self.temp_dir = tempfile.mkdtemp()
+        self.archive = os.path.join(self.temp_dir, self.name)
+        self.members = []
+        index = []
+        codec, level = get_codec()
+        with zipfile.ZipFile(self.archive, mode='w', compression=codec, compresslevel=level) as zf:
+            for file in sorted(files) if REPRODUCIBLE_ARCHIVES else files:
+                compressed = not ARCHIVE_FILES or is_compressed(file)
+                try:
+                    write_zip_entry(zf, file, os.path.basename(file), zipfile.ZIP_STORED if compressed else None)
+                except OSError as e:
+                    if LOGGER:
+                        LOGGER.error('Failed to bundle {}, error: {}'.format(file, e))
+                    continue
+                info = zf.infolist()[-1]
+                member = {'name': info.filename, 'offset': info.header_offset, 'size': info.file_size,
+                          'compressed_size': info.compress_size, 'crc': info.CRC}
+                if not REPRODUCIBLE_ARCHIVES:
+                    member['mtime'] = stats[file].st_mtime
+                index.append(member)
+                self.members.append(file)
+            index_name = zipfile.ZipInfo(BUNDLE_INDEX, date_time=ARCHIVE_DATE_TIME) if REPRODUCIBLE_ARCHIVES else BUNDLE_INDEX
+            zf.writestr(index_name, json.dumps({'members': index}, indent=1))
+
+    def close(self):
+        rmtree(self.temp_dir, ignore_errors=True)
+
+
+class Disposer():
+    """ moves or removes uploaded files by a background thread as soon as they are added to the cloud,
+    so local disk use and rework after a crash are bounded by the files in flight
+    folders emptied by the disposal are pruned up to the upload folder if remove_folders is set
+    """
+    def __init__(self, remove_folders=REMOVE_FOLDERS):
+        self.remove_folders = remove_folders
+        self.queue = Queue()
+        self.thread = threading.Thread(target=self.run, name='disposer', daemon=True)
+        self.thread.start()
+
+    def put(self, file):
+        self.queue.put(file)
+
+    def put_future(self, future):
+        """ queues the files of the finished upload future, bundles return their members """
+        if future.cancelled() or future.exception():
+            return
+        result = future.result()
+        for file in result if isinstance(result, list) else [result]:
+            if file:
+                self.put(file)
+
+    def join(self):
+        """ waits for the queued files to be disposed """
+        self.queue.join()
+
+    def run(self):
+        while True:
+            file = self.queue.get()
+            try:
+                if file is None:
+                    return
+                dispose_file(file)
+                if self.remove_folders:
+                    prune_folders(os.path.dirname(file), path=UPLOAD_PATH)
+            except OSError as e:
+                if LOGGER:
+                    LOGGER.error('File {} disposal error: {}'.format(file, e))
+            finally:
+                self.queue.task_done()
+
+    def close(self):
+        """ disposes the queued files and stops the thread """
+        self.queue.put(None)
+        self.thread.join()
+
+
+class FileEntry():
+    """ os.DirEntry stand-in of a known file, as accepted by get_dir_files """
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+
+    def stat(self):
+        return os.stat(self.path)
+
+
+class InotifyWatcher():
+    """ upload tree watcher on Linux inotify, reports files closed after writing and moved in
+    new folders are watched as they appear, files already in them are reported
+    overflowed is set if events were lost, the tree should be rescanned then
+    raises OSError if inotify is not available
+    """
+    def __init__(self, path=UPLOAD_PATH):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.folders = {}
+        self.overflowed = False
+        try:
+            self.add_tree(path)
+        except:
+            self.close()
+            raise
+
+    def add_tree(self, path):
+        """ watches the folder with subfolders, returns files found in them """
+        files = []
+        for folder, entries in scan_tree(path):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(folder),
+                                             IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_ONLYDIR)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), 'inotify_add_watch failed on {}'.format(folder))
+            self.folders[wd] = folder
+            files.extend(entry.path for entry in entries)
+        return files
+
+    def read(self, timeout=None):
+        """ returns files changed since the last read, waits for them up to timeout seconds (None - forever) """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        files = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + INOTIFY_EVENT.size:offset + INOTIFY_EVENT.size + length].rstrip(b'\0'))
+            offset += INOTIFY_EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                self.overflowed = True
+            elif mask & IN_IGNORED:
+                self.folders.pop(wd, None)
+            elif wd in self.folders:
+                path = os.path.join(self.folders[wd], name)
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        try:
+                            files.extend(self.add_tree(path))
+                        except OSError as e:
+                            # the tree is rescanned to catch files of unwatched folders
+                            self.overflowed = True
+                            if LOGGER:
+                                LOGGER.warning('Cannot watch {}: {}'.format(path, e))
+                elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                    files.append(path)
+        return files
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher():
+    """ upload tree watcher scanning the tree every interval seconds, reports new and changed files
+    unlike InotifyWatcher it could not tell if a file is still being written, WATCH_DEBOUNCE should cover it
+    """
+    def __init__(self, path=UPLOAD_PATH, interval=WATCH_POLL):
+        self.path = path
+        self.interval = max(0.1, interval)
+        self.overflowed = False
+        self.snapshot = self.scan()
+        self.next_scan = time.monotonic() + self.interval
+
+    def scan(self):
+        snapshot = {}
+        for folder, entries in scan_tree(self.path):
+            for entry in entries:
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                snapshot[entry.path] = (stat.st_size, stat.st_mtime_ns)
+        return snapshot
+
+    def read(self, timeout=None):
+        delay = max(0, self.next_scan - time.monotonic())
+        if timeout is not None and timeout < delay:
+            time.sleep(timeout)
+            return []
+        time.sleep(delay)
+        snapshot = self.scan()
+        files = [file for file, state in snapshot.items() if self.snapshot.get(file) != state]
+        self.snapshot = snapshot
+        self.next_scan = time.monotonic() + self.interval
+        return files
+
+    def close(self):
+        pass
+
+
 def get_logger(name, log_file=LOG_FILE):
     logger = logging.getLogger(name)
     logger.setLevel(logging.INFO)
@@ -117,202 +1494,667 @@ def get_logger(name, log_file=LOG_FILE):
     return logger
 
 
+def get_session(workers=UPLOAD_WORKERS):
+    """ returns requests session with connection pool large enough for all upload workers
+    each host (i.e. upload node) keeps its own pool of up to workers connections
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=max(workers, HOST_POOLS), pool_maxsize=workers)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
 def get_email_domain(email=LOGIN):
     assert EMAIL_REGEXP.match(email), 'bad email provided: {}'.format(email)
     return email.split('@')[1]
 
 
-def cloud_auth(session, login=LOGIN, password=PASSWORD):
-    try:
-        r = session.post('https://auth.mail.ru/cgi-bin/auth?lang=ru_RU&from=authpopup',
-                         data = {'Login': login, 'Password': password, 'page': urljoin(CLOUD_URL, '?from=promo'),
-                                 'new_auth_form': 1, 'Domain': get_email_domain(login)}, verify = VERIFY_SSL)
-    except Exception as e:
-        if LOGGER:
-            LOGGER.error('Cloud auth HTTP request error: {}'.format(e))
-        return None
+def get_auth_data(login=LOGIN, password=PASSWORD):
+    """ returns cloud authorization form data """
+    return {'Login': login, 'Password': password, 'page': urljoin(CLOUD_URL, '?from=promo'),
+            'new_auth_form': 1, 'Domain': get_email_domain(login)}
 
-    if r.status_code == requests.codes.ok:
-        if LOGIN_CHECK_STRING in r.text:
+
+def check_auth_response(status_code, text):
+    """ returns True if authorization response is successful, logs failure otherwise """
+    if status_code == requests.codes.ok:
+        if LOGIN_CHECK_STRING in text:
             return True
         elif LOGGER:
             LOGGER.error('Cloud authorization request error. Check your credentials settings in {}. \
 Do not forget to accept cloud LA by entering it in browser. \
-HTTP code: {}, msg: {}'.format(CONFIG_FILE, r.status_code, r.text))
+HTTP code: {}, msg: {}'.format(CONFIG_FILE, status_code, text))
     elif LOGGER:
         LOGGER.error('Cloud authorization request error. Check your connection. \
-HTTP code: {}, msg: {}'.format(r.status_code, r.text))
+HTTP code: {}, msg: {}'.format(status_code, text))
     return None
 
 
-def get_csrf(session):
+def get_delays(retries=RETRIES):
+    """ yields delays (seconds) before each retry: exponential backoff with full jitter """
+    for attempt in range(retries):
+        yield random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def parse_schedule(schedule=''):
+    """ returns [(start, end, value)] of 'HH:MM-HH:MM=value, ...' time of day schedule
+    start and end are minutes since midnight, a window could span midnight
+    """
+    windows = []
+    for item in filter(None, (item.strip() for item in schedule.split(','))):
+        window, value = item.split('=')
+        start, end = (int(hours) * 60 + int(minutes)
+                      for hours, minutes in (time.strip().split(':') for time in window.split('-')))
+        windows.append((start, end, float(value)))
+    return windows
+
+
+def get_scheduled(windows, default=0, now=None):
+    """ returns the value of the first schedule window containing the time of day, default otherwise """
+    now = now or datetime.datetime.now()
+    minute = now.hour * 60 + now.minute
+    for start, end, value in windows:
+        if (start <= minute < end) if start <= end else (minute >= start or minute < end):
+            return value
+    return default
+
+
+def get_limiter():
+    """ returns TokenBucket if posted bandwidth is limited, None otherwise """
+    schedule = parse_schedule(BANDWIDTH_SCHEDULE)
+    if BANDWIDTH_LIMIT > 0 or schedule:
+        return TokenBucket(rate=BANDWIDTH_LIMIT * 1024, schedule=[(start, end, value * 1024)
+                                                                  for start, end, value in schedule])
+    return None
+
+
+def get_controller(maximum=UPLOAD_WORKERS):
+    """ returns ConcurrencyController if simultaneous requests are adaptive or scheduled, None otherwise """
+    schedule = parse_schedule(CONCURRENCY_SCHEDULE)
+    if ADAPTIVE_CONCURRENCY or schedule:
+        return ConcurrencyController(maximum=maximum, schedule=schedule, adaptive=ADAPTIVE_CONCURRENCY)
+    return None
+
+
+def get_call_name(url):
+    """ returns metrics name of the request: cloud API command, 'auth' or 'upload' """
+    if url.startswith(CLOUD_URL):
+        return url[len(CLOUD_URL):].split('?')[0]
+    if url == AUTH_URL:
+        return 'auth'
+    return 'upload'
+
+
+def record_request(url, start, status):
+    if METRICS:
+        METRICS.add_request(get_call_name(url), time.monotonic() - start, status)
+
+
+def send_request(session, method, url, retries=RETRIES, prepare=None, **kwargs):
+    """ sends HTTP request, retries connection errors and RETRY_CODES responses
+    returns the last response, raises the last connection error
+    param: retries - maximum number of retries, use RETRIES_NON_IDEMPOTENT for non-idempotent operations
+    param: prepare - callable returning request keyword arguments for each attempt, i.e. rewound data stream,
+    its 'url' replaces the url, i.e. to post to another upload node
+    """
+    delays = get_delays(retries)
+    while True:
+        if prepare:
+            kwargs.update(prepare())
+            url = kwargs.pop('url', url)
+        if CONTROLLER:
+            CONTROLLER.acquire()
+        start = time.monotonic()
+        try:
+            r = session.request(method, url, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            record_request(url, start, 'error')
+            if CONTROLLER:
+                CONTROLLER.release(congested=True)
+            delay = next(delays, None)
+            if delay is None:
+                raise
+            reason = e
+        except:
+            record_request(url, start, 'error')
+            if CONTROLLER:
+                CONTROLLER.release()
+            raise
+        else:
+            record_request(url, start, r.status_code)
+            if CONTROLLER:
+                # posted bodies make latency incomparable
+                CONTROLLER.release(latency=None if prepare else time.monotonic() - start,
+                                   congested=r.status_code in RETRY_CODES)
+            if r.status_code not in RETRY_CODES:
+                return r
+            delay = next(delays, None)
+            if delay is None:
+                return r
+            reason = 'HTTP code: {}'.format(r.status_code)
+        if LOGGER:
+            LOGGER.warning('{} request to {} failed ({}), retrying in {:.1f} s'.format(method, url, reason, delay))
+        time.sleep(delay)
+
+
+def get_fresh_csrf(csrf):
+    """ returns the latest token refreshed instead of the stale one """
+    while csrf in CSRF_TOKENS:
+        csrf = CSRF_TOKENS[csrf]
+    return csrf
+
+
+def set_csrf_account(csrf, login=LOGIN, password=PASSWORD):
+    """ registers the account of the CSRF token to log in again if its session expires """
+    if csrf and login != LOGIN:
+        CSRF_ACCOUNTS[csrf] = (login, password)
+
+
+def refresh_csrf(session, csrf=''):
+    """ requests new CSRF token instead of the stale one, returns None on failure
+    the token is refreshed only once if rejected by several workers simultaneously
+    logs in again if the session itself is expired (i.e. cached by the previous run)
+    """
+    with CSRF_LOCK:
+        fresh_csrf = get_fresh_csrf(csrf)
+        if fresh_csrf != csrf:
+            return fresh_csrf
+        login, password = CSRF_ACCOUNTS.get(csrf, (LOGIN, PASSWORD))
+        fresh_csrf = get_csrf(session, log_errors=False)
+        if not fresh_csrf and cloud_auth(session, login=login, password=password):
+            if LOGGER:
+                LOGGER.info('Cloud session of {} expired, logged in again'.format(login))
+            fresh_csrf = get_csrf(session)
+        # re-login could validate the same token again
+        if fresh_csrf and fresh_csrf != csrf:
+            CSRF_TOKENS[csrf] = fresh_csrf
+            set_csrf_account(fresh_csrf, login, password)
+            if LOGGER:
+                LOGGER.info('CSRF token refreshed')
+        return fresh_csrf
+
+
+def cloud_auth(session, login=LOGIN, password=PASSWORD):
+    try:
+        r = send_request(session, 'POST', AUTH_URL, retries=RETRIES_NON_IDEMPOTENT,
+                         data=get_auth_data(login, password), verify = VERIFY_SSL)
+    except Exception as e:
+        if LOGGER:
+            LOGGER.error('Cloud auth HTTP request error: {}'.format(e))
+        return None
+
+    return check_auth_response(r.status_code, r.text)
+
+
+def parse_csrf(r_json):
+    token = r_json['body']['token']
+    assert len(token) == 32, 'invalid CSRF token <{}> lentgh'.format(token)
+    return token
+
+
+def get_csrf(session, log_errors=True):
     try:
-        r = session.get(urljoin(CLOUD_URL, 'tokens/csrf'), verify = VERIFY_SSL)
+        r = send_request(session, 'GET', urljoin(CLOUD_URL, 'tokens/csrf'), verify = VERIFY_SSL)
     except Exception as e:
         if LOGGER:
             LOGGER.error('Get csrf HTTP request error: {}'.format(e))
         return None
 
     if r.status_code == requests.codes.ok:
-        r_json = r.json()
-        token = r_json['body']['token']
-        assert len(token) == 32, 'invalid CSRF token <{}> lentgh'.format(token)
-        return token
-    elif LOGGER:
+        return parse_csrf(r.json())
+    elif LOGGER and log_errors:
         LOGGER.error('CSRF token request error. Check your connection and credentials settings in {}. \
 HTTP code: {}, msg: {}'.format(CONFIG_FILE, r.status_code, r.text))
     return None
 
 
-def get_upload_domain(session, csrf=''):
-    """ return current cloud's upload domain url
+def get_dispatcher_url(csrf=''):
+    return urljoin(CLOUD_URL, 'dispatcher?token=' + get_fresh_csrf(csrf))
+
+
+def parse_upload_nodes(r_json):
+    """ returns urls of the upload nodes from the dispatcher response """
+    return [node['url'] for node in r_json['body']['upload']]
+
+
+def get_upload_nodes(session, csrf=''):
+    """ return urls of the current cloud's upload nodes, None on failure
     it seems that csrf isn't necessary in session,
     but forcing assert anyway to avoid possible future damage
     """
     assert csrf is not None, 'no CSRF' 
-    url = urljoin(CLOUD_URL, 'dispatcher?token=' + csrf)
+    url = get_dispatcher_url(csrf)
 
     try:
-        r = session.get(url, verify = VERIFY_SSL)
+        r = send_request(session, 'GET', url, verify = VERIFY_SSL)
     except Exception as e:
         if LOGGER:
             LOGGER.error('Get upload domain HTTP request error: {}'.format(e))
         return None
 
     if r.status_code == requests.codes.ok:
-        r_json = r.json()
-        return r_json['body']['upload'][0]['url']
+        return parse_upload_nodes(r.json()) or None
     elif LOGGER:
         LOGGER.error('Upload domain request error. Check your connection. \
 HTTP code: {}, msg: {}'.format(r.status_code, r.text))
     return None
 
 
-def get_cloud_csrf(session):
-    if cloud_auth(session):
+def get_upload_domain(session, csrf=''):
+    """ return current cloud's upload domain url, the first of the upload nodes """
+    nodes = get_upload_nodes(session, csrf=csrf)
+    return nodes[0] if nodes else None
+
+
+def get_cloud_csrf(session, login=LOGIN, password=PASSWORD):
+    if cloud_auth(session, login=login, password=password):
         return get_csrf(session)
     return None
 
 
-def get_cloud_space(session, csrf='', login=LOGIN):
-    """ returns available free space in bytes """
-    assert csrf is not None, 'no CSRF'
+def dump_cookies(session):
+    """ returns cookies of requests or aiohttp session as a list of dicts """
+    if isinstance(session, requests.Session):
+        return [{'name': c.name, 'value': c.value, 'domain': c.domain, 'path': c.path} for c in session.cookies]
+    return [{'name': m.key, 'value': m.value, 'domain': m['domain'], 'path': m['path']} for m in session.cookie_jar]
+
+
+def load_cookies(session, cookies):
+    """ sets cookies dumped by dump_cookies to requests or aiohttp session """
+    for cookie in cookies:
+        if isinstance(session, requests.Session):
+            session.cookies.set(cookie['name'], cookie['value'], domain=cookie['domain'], path=cookie['path'])
+        else:
+            morsels = SimpleCookie()
+            morsels[cookie['name']] = cookie['value']
+            morsels[cookie['name']]['domain'] = cookie['domain']
+            morsels[cookie['name']]['path'] = cookie['path']
+            session.cookie_jar.update_cookies(morsels, response_url=yarl.URL('http://' + cookie['domain'].lstrip('.')))
+
+
+def get_session_file(login=LOGIN):
+    """ returns session cache file of the account, the main account's one is SESSION_FILE """
+    return SESSION_FILE if login == LOGIN else '{}.{}'.format(SESSION_FILE, login)
+
+
+def read_session_cache(login=LOGIN):
+    """ returns cached session of the login if it is not expired, None otherwise """
+    try:
+        with open(get_session_file(login)) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if cache.get('login') == login and cache.get('expires', 0) > time.time():
+        return cache
+    return None
+
+
+def write_session_cache(session, csrf='', domain='', login=LOGIN, nodes=None):
+    """ caches session cookies, CSRF token, upload domain and nodes for SESSION_LIFETIME hours
+    the file is readable by the owner only, cookies grant access to the cloud
+    """
+    if SESSION_LIFETIME <= 0:
+        return
+    cache = {'login': login, 'expires': time.time() + SESSION_LIFETIME * 3600, 'csrf': get_fresh_csrf(csrf),
+             'domain': domain, 'nodes': nodes.get_urls() if nodes else [domain], 'cookies': dump_cookies(session)}
+    session_file = get_session_file(login)
+    try:
+        with open(os.open(session_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), mode='w') as f:
+            # the mode is not applied to existing files and is masked by umask
+            os.chmod(session_file, 0o600)
+            json.dump(cache, f)
+    except OSError as e:
+        if LOGGER:
+            LOGGER.warning('Cannot cache cloud session: {}'.format(e))
+
+
+def set_upload_nodes(urls, nodes=None):
+    """ sets the upload nodes of the account to spread posts over, returns the upload domain (the first node) """
+    if nodes and urls:
+        nodes.update(urls)
+    return urls[0] if urls else None
+
+
+@timed('handshake')
+def get_handshake(session, login=LOGIN, password=PASSWORD, nodes=None):
+    """ returns (csrf, upload domain) of the cached session of the account, logs in if there is none
+    expired cached session is detected by rejected requests and refreshed by refresh_csrf
+    param: nodes - UploadNodes of the account to set up
+    """
+    cache = read_session_cache(login)
+    if cache:
+        load_cookies(session, cache['cookies'])
+        set_csrf_account(cache['csrf'], login, password)
+        if LOGGER:
+            LOGGER.info('Cached cloud session of {} reused'.format(login))
+        return (cache['csrf'], set_upload_nodes(cache.get('nodes') or [cache['domain']], nodes))
+    csrf = get_cloud_csrf(session, login=login, password=password)
+    set_csrf_account(csrf, login, password)
+    domain = set_upload_nodes(get_upload_nodes(session, csrf=csrf) if csrf else None, nodes)
+    if domain:
+        write_session_cache(session, csrf=csrf, domain=domain, login=login, nodes=nodes)
+    return (csrf, domain)
 
+
+def get_space_url(csrf='', login=LOGIN):
     timestamp = str(int(time.mktime(datetime.datetime.now().timetuple())* 1000))
     quoted_login = quote_plus(login)
     command = ('user/space?api=' + str(API_VER) + '&email=' + quoted_login +
-               '&x-email=' + quoted_login + '&token=' + csrf + '&_=' + timestamp)
-    url = urljoin(CLOUD_URL, command)
+               '&x-email=' + quoted_login + '&token=' + get_fresh_csrf(csrf) + '&_=' + timestamp)
+    return urljoin(CLOUD_URL, command)
+
+
+def parse_space(r_json):
+    """ returns free space in bytes from the user/space response """
+    total_bytes = r_json['body']['total'] * 1024 * 1024
+    used_bytes = r_json['body']['used'] * 1024 * 1024
+    return total_bytes - used_bytes
+
+
+@timed('space')
+def get_cloud_space(session, csrf='', login=LOGIN):
+    """ returns available free space in bytes """
+    assert csrf is not None, 'no CSRF'
 
     try:
-        r = session.get(url, verify = VERIFY_SSL)
+        for attempt in range(2):
+            r = send_request(session, 'GET', get_space_url(csrf, login), verify = VERIFY_SSL)
+            if r.status_code not in AUTH_ERROR_CODES or attempt or not refresh_csrf(session, csrf):
+                break
     except Exception as e:
         if LOGGER:
             LOGGER.error('Get cloud space HTTP request error: {}'.format(e))
         return 0
 
     if r.status_code == requests.codes.ok:
-        r_json = r.json()
-        total_bytes = r_json['body']['total'] * 1024 * 1024
-        used_bytes = r_json['body']['used'] * 1024 * 1024
-        return total_bytes - used_bytes
+        return parse_space(r.json())
     elif LOGGER:
         LOGGER.error('Cloud free space request error. Check your connection. \
 HTTP code: {}, msg: {}'.format(r.status_code, r.text))
     return 0
 
-def post_file(session, domain='', file='', login=LOGIN):
-    """ posts file to the cloud's upload server
-    param: file - string filename with path
+
+def get_listing_url(folder='', csrf='', offset=0, limit=LISTING_LIMIT):
+    command = ('folder?api=' + str(API_VER) + '&home=' + quote_plus(folder) + '&offset=' + str(offset) +
+               '&limit=' + str(limit) + '&token=' + get_fresh_csrf(csrf))
+    return urljoin(CLOUD_URL, command)
+
+
+def parse_listing(r_json):
+    """ returns (total number of entries, entries of the page) from the folder response """
+    body = r_json['body']
+    return (sum(body['count'].values()), body['list'])
+
+
+def check_listing_response(folder, status_code, text):
+    """ returns True if the folder listing succeeded, logs failure otherwise
+    missing folder is not an error, it has nothing to list
     """
-    assert domain is not None, 'no domain'
-    assert file is not None, 'no file'
+    if status_code == requests.codes.ok:
+        return True
+    elif status_code != requests.codes.not_found and LOGGER:
+        LOGGER.error('Cloud folder {} listing error. HTTP code: {}, msg: {}'.format(folder, status_code, text))
+    return None
+
+
+def get_folder_page(session, folder='', csrf='', offset=0):
+    """ returns (total number of entries, entries) of the cloud folder listing page, (0, []) on failure """
+    try:
+        r = send_request(session, 'GET', get_listing_url(folder, csrf, offset), verify = VERIFY_SSL)
+    except Exception as e:
+        if LOGGER:
+            LOGGER.error('Cloud folder listing HTTP request error: {}'.format(e))
+        return (0, [])
+
+    if check_listing_response(folder, r.status_code, r.text):
+        return parse_listing(r.json())
+    return (0, [])
 
+
+@timed('listing')
+def get_remote_index(session, folders=None, csrf='', executor=None, index=None):
+    """ returns RemoteIndex of the cloud folders, the given index is filled if any
+    first pages of all the folders are requested concurrently, then the rest of the pages
+    """
+    index = index or RemoteIndex()
+    pages = []
+    first_pages = executor.map(lambda folder: get_folder_page(session, folder=folder, csrf=csrf), folders)
+    for folder, (total, items) in zip(folders, first_pages):
+        index.add(folder, items)
+        pages.extend((folder, offset) for offset in range(LISTING_LIMIT, total, LISTING_LIMIT))
+    rest_pages = executor.map(lambda page: get_folder_page(session, folder=page[0], csrf=csrf, offset=page[1]), pages)
+    for (folder, __), (__, items) in zip(pages, rest_pages):
+        index.add(folder, items)
+    return index
+
+
+def get_filetype(file):
+    """ returns file mime type, default one if unknown """
     filetype = guess_type(file)[0]
     if not filetype:
         filetype = DEFAULT_FILETYPE
         if LOGGER:
             LOGGER.warning('File {} type is unknown, using default: {}'.format(file, DEFAULT_FILETYPE))
+    return filetype
 
-    filename = os.path.basename(file)
+
+def get_post_url(domain='', login=LOGIN):
     quoted_login = quote_plus(login)
     timestamp = str(int(time.mktime(datetime.datetime.now().timetuple()))) + TIME_AMEND
-    url = urljoin(domain, '?cloud_domain=' + str(CLOUD_DOMAIN_ORD) + '&x-email=' + quoted_login + '&fileapi' + timestamp)
-    m = MultipartEncoder(fields={'file': (quote_plus(filename), open(file, 'rb'), filetype)})
+    return urljoin(domain, '?cloud_domain=' + str(CLOUD_DOMAIN_ORD) + '&x-email=' + quoted_login + '&fileapi' + timestamp)
 
-    try:
-        r = session.post(url, data=m, headers={'Content-Type': m.content_type}, verify = VERIFY_SSL)
-    except Exception as e:
-        if LOGGER:
-            LOGGER.error('Post file HTTP request error: {}'.format(e))
-        return (None, None)
 
-    if r.status_code == requests.codes.ok:
-        if len(r.content):
-            hash = r.content[:40].decode()
-            size = int(r.content[41:-2])
+class NodePost():
+    """ send_request prepare callable posting each attempt to the best of the nodes at the moment
+    an attempt is accounted as failed once the next one is prepared or if it is not finished on exit
+    param: prepare - callable returning request keyword arguments of the attempt
+    param: size - posted bytes, to compare nodes by time per megabyte
+    param: nodes - UploadNodes of the account, the domain is posted to if not given
+    """
+    def __init__(self, domain='', login=LOGIN, prepare=None, size=0, nodes=None):
+        self.domain = domain
+        self.login = login
+        self.prepare = prepare
+        self.size = size
+        self.nodes = nodes
+        self.url = get_post_url(domain, login)
+        self.node = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.finish(failed=True)
+
+    def __call__(self):
+        previous = self.node
+        self.finish(failed=True)
+        self.node = self.nodes.pick(self.domain, previous=previous) if self.nodes else self.domain
+        self.start = time.monotonic()
+        request = self.prepare() if self.prepare else {}
+        request['url'] = get_post_url(self.node, self.login)
+        return request
+
+    def finish(self, failed=False):
+        """ accounts the last attempt, if not yet """
+        if self.nodes and self.node is not None:
+            self.nodes.record(self.node, seconds=time.monotonic() - self.start, size=self.size, failed=failed)
+        self.node = None
+
+
+def parse_post_response(file, status_code, content):
+    """ returns (hash, size) of the posted file, (None, None) on failure """
+    if status_code == requests.codes.ok:
+        if len(content):
+            hash = content[:40].decode()
+            size = int(content[41:-2])
             return (hash, size)
         elif LOGGER:
             LOGGER.error('File {} post error, no hash and size received'.format(file))
     elif LOGGER:
-        LOGGER.error('File {} post error, http code: {}, msg: {}'.format(file, r.status_code, r.text))
+        LOGGER.error('File {} post error, http code: {}, msg: {}'.format(file, status_code, content.decode(errors='replace')))
     return (None, None)
 
 
-def make_post(session, obj='', csrf='', command='', params = None):
-    """ invokes standart cloud post operation
-    tested operations: ('file/add', 'folder/add', 'file/remove')
-    does not replace existent objects, but logs them
+@timed('post', measure=get_result_size)
+def post_file(session, domain='', file='', login=LOGIN, nodes=None):
+    """ posts file to the cloud's upload server
+    file is reread from the start on retries
+    param: file - string filename with path
     """
-    assert obj is not None, 'no object'
-    assert csrf is not None, 'no CSRF'
-    assert command is not None, 'no command'
+    assert domain is not None, 'no domain'
+    assert file is not None, 'no file'
 
-    url = urljoin(CLOUD_URL, command)
-    # api (implemented), email, x-email, x-page-id, build - optional parameters
-    postdata = {'home': obj, 'conflict': CLOUD_CONFLICT, 'token': csrf, 'api': API_VER}
-    if params:
-        assert isinstance(params, dict), 'additional parameters not in dictionary'
-        postdata.update(params)
+    filetype = get_filetype(file)
+    filename = os.path.basename(file)
 
     try:
-        r = session.post(url, data=postdata, headers={'Content-Type': 'application/x-www-form-urlencoded'}, verify=VERIFY_SSL)
+        with UploadBody(file, name=filename, filetype=filetype, limiter=LIMITER) as body, \
+             NodePost(domain, login, prepare=body.get_request, size=len(body), nodes=nodes) as post:
+            r = send_request(session, 'POST', post.url, prepare=post, verify = VERIFY_SSL)
+            post.finish(failed=r.status_code != requests.codes.ok)
     except Exception as e:
         if LOGGER:
-            LOGGER.error('Make post ({}) HTTP request error: {}'.format(command, e))
-        return None
+            LOGGER.error('Post file HTTP request error: {}'.format(e))
+        return (None, None)
 
-    if r.status_code == requests.codes.ok:
-        return True
-    elif r.status_code == requests.codes.bad:
-        try:
-            r_error = r.json()['body']['home']['error']
-        except KeyError:
-            r_error = None
-        if r_error == 'exists':
-            if LOGGER:
-                LOGGER.warning('Command {} failed. Object {} already exists'.format(command, obj))
-            return True
-    if LOGGER:
-        LOGGER.error('Command {} on object {} failed. HTTP code: {}, msg: {}'.format(command, obj, r.status_code, r.text))
-    return None
+    return parse_post_response(file, r.status_code, r.content)
 
 
-def add_file(session, file='', hash='', size=0, csrf=''):
-    """ 'file' should be filename with absolute cloud path """
-    assert len(hash) == 40, 'invalid hash: {}'.format(hash)
-    assert size >= 0, 'invalid size: {}'.format(size)
+@timed('post', measure=get_result_size)
+def post_volume(session, domain='', file='', name='', offset=0, size=0, login=LOGIN, nodes=None):
+    """ posts file part to the cloud's upload server as a separate file
+    param: file - string filename with path
+    param: name - cloud filename of the part
+    param: offset, size - part position in the file
+    """
+    assert domain is not None, 'no domain'
+    assert file is not None, 'no file'
 
-    return make_post(session, obj=file, csrf=csrf, command='file/add', params = {'hash': hash, 'size': size})
+    try:
+        with UploadBody(file, name=name, offset=offset, size=size, limiter=LIMITER) as body, \
+             NodePost(domain, login, prepare=body.get_request, size=len(body), nodes=nodes) as post:
+            r = send_request(session, 'POST', post.url, prepare=post, verify = VERIFY_SSL)
+            post.finish(failed=r.status_code != requests.codes.ok)
+    except Exception as e:
+        if LOGGER:
+            LOGGER.error('Post volume HTTP request error: {}'.format(e))
+        return (None, None)
 
+    return parse_post_response(name, r.status_code, r.content)
 
-def create_folder(session, folder='', csrf=''):
-    """ Takes 'folder' as new folder name with full cloud path (without 'home'),
-    returns True even if target folder already existed
-    Path should start with forward slash,
-    no final slash should be present after the target folder name
+
+@timed('post', measure=get_result_size)
+def post_archive(session, domain='', file='', login=LOGIN, nodes=None):
+    """ posts file zipped on the fly to the cloud's upload server
+    body is sent with chunked transfer encoding, no archive is written to disk
+    returns (hash, size), where size is the number of streamed archive bytes
+    param: file - string filename with path
     """
-    return make_post(session, obj=folder, csrf=csrf, command='folder/add')
+    assert domain is not None, 'no domain'
+    assert file is not None, 'no file'
+
+    stream = ArchiveStream(file)
+    try:
+        with NodePost(domain, login, size=os.path.getsize(file), nodes=nodes,
+                      prepare=lambda: {'data': LIMITER.iter(stream) if LIMITER else iter(stream)}) as post:
+            r = send_request(session, 'POST', post.url, prepare=post, headers={'Content-Type': stream.content_type},
+                             verify = VERIFY_SSL)
+            post.finish(failed=r.status_code != requests.codes.ok)
+    except Exception as e:
+        if LOGGER:
+            LOGGER.error('Post archive HTTP request error: {}'.format(e))
+        return (None, None)
+
+    return check_streamed_archive(file, stream, *parse_post_response(file, r.status_code, r.content))
+
+
+def check_streamed_archive(file, stream, hash, size):
+    """ returns (hash, size) of the posted streamed archive, (None, None) on failure """
+    if hash:
+        if size != stream.size and LOGGER:
+            LOGGER.warning('File {} archive size mismatch. Streamed: {} (B). Received: {} (B).'.format(file, stream.size, size))
+        if METRICS:
+            METRICS.add_compression(os.path.getsize(file), stream.size)
+        if LOGGER:
+            LOGGER.info('{} archived on the fly as {}'.format(file, stream.filename))
+        return (hash, stream.size)
+    return (None, None)
+
+
+def get_post_data(obj='', csrf='', params=None):
+    """ returns standart cloud post operation form data """
+    # api (implemented), email, x-email, x-page-id, build - optional parameters
+    postdata = {'home': obj, 'conflict': CLOUD_CONFLICT, 'token': get_fresh_csrf(csrf), 'api': API_VER}
+    if params:
+        assert isinstance(params, dict), 'additional parameters not in dictionary'
+        postdata.update(params)
+    return postdata
+
+
+def check_post_response(obj, command, status_code, text, log_errors=True):
+    """ returns True if standart cloud post operation succeeded or object already exists """
+    if status_code == requests.codes.ok:
+        return True
+    elif status_code == requests.codes.bad:
+        try:
+            r_error = json.loads(text)['body']['home']['error']
+        except (KeyError, TypeError, ValueError):
+            r_error = None
+        if r_error == 'exists':
+            if LOGGER:
+                LOGGER.warning('Command {} failed. Object {} already exists'.format(command, obj))
+            return True
+    if LOGGER and log_errors:
+        LOGGER.error('Command {} on object {} failed. HTTP code: {}, msg: {}'.format(command, obj, status_code, text))
+    return None
+
+
+def make_post(session, obj='', csrf='', command='', params = None, log_errors=True):
+    """ invokes standart cloud post operation
+    tested operations: ('file/add', 'folder/add', 'file/remove')
+    does not replace existent objects, but logs them
+    failed operation is not logged if log_errors is False (request errors are logged anyway)
+    rejected CSRF token is refreshed and the operation is repeated once
+    """
+    assert obj is not None, 'no object'
+    assert csrf is not None, 'no CSRF'
+    assert command is not None, 'no command'
+
+    url = urljoin(CLOUD_URL, command)
+
+    try:
+        for attempt in range(2):
+            r = send_request(session, 'POST', url, retries=RETRIES_NON_IDEMPOTENT, data=get_post_data(obj, csrf, params),
+                             headers={'Content-Type': 'application/x-www-form-urlencoded'}, verify=VERIFY_SSL)
+            if r.status_code not in AUTH_ERROR_CODES or attempt or not refresh_csrf(session, csrf):
+                break
+    except Exception as e:
+        if LOGGER:
+            LOGGER.error('Make post ({}) HTTP request error: {}'.format(command, e))
+        return None
+
+    return check_post_response(obj, command, r.status_code, r.text, log_errors=log_errors)
+
+
+@timed('add', measure=get_success)
+def add_file(session, file='', hash='', size=0, csrf='', log_errors=True):
+    """ 'file' should be filename with absolute cloud path """
+    assert len(hash) == 40, 'invalid hash: {}'.format(hash)
+    assert size >= 0, 'invalid size: {}'.format(size)
+
+    return make_post(session, obj=file, csrf=csrf, command='file/add', params = {'hash': hash, 'size': size},
+                     log_errors=log_errors)
+
+
+def create_folder(session, folder='', csrf=''):
+    """ Takes 'folder' as new folder name with full cloud path (without 'home'),
+    returns True even if target folder already existed
+    Path should start with forward slash,
+    no final slash should be present after the target folder name
+    """
+    return make_post(session, obj=folder, csrf=csrf, command='folder/add')
 
 
 def remove_object(session, obj='', csrf=''):
@@ -323,6 +2165,519 @@ def remove_object(session, obj='', csrf=''):
     return make_post(session, obj=obj, csrf=csrf, command='file/remove')
 
 
+def get_ssl_context():
+    """ returns ssl verification setting for aiohttp requests """
+    if not VERIFY_SSL:
+        return False
+    return ssl.create_default_context(cafile=os.environ.get('REQUESTS_CA_BUNDLE'))
+
+
+def get_async_session(limit=ASYNC_LIMIT):
+    """ returns aiohttp session with connection pool limited to the number of simultaneous requests """
+    assert aiohttp is not None, 'aiohttp should be installed to use asyncio engine'
+    connector = aiohttp.TCPConnector(limit=limit, ssl=get_ssl_context())
+    # unsafe cookie jar accepts cookies from IP addresses as well
+    return aiohttp.ClientSession(connector=connector, cookie_jar=aiohttp.CookieJar(unsafe=True))
+
+
+async def async_send_request(session, method, url, retries=RETRIES, prepare=None, **kwargs):
+    """ asyncio version of send_request, returns (status, content) of the last response """
+    delays = get_delays(retries)
+    while True:
+        if prepare:
+            kwargs.update(prepare())
+            url = kwargs.pop('url', url)
+        if CONTROLLER:
+            await CONTROLLER.async_acquire()
+        start = time.monotonic()
+        try:
+            async with session.request(method, url, **kwargs) as r:
+                content = await r.read()
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            record_request(url, start, 'error')
+            if CONTROLLER:
+                await CONTROLLER.async_release(congested=True)
+            delay = next(delays, None)
+            if delay is None:
+                raise
+            reason = e
+        except:
+            record_request(url, start, 'error')
+            if CONTROLLER:
+                await CONTROLLER.async_release()
+            raise
+        else:
+            record_request(url, start, r.status)
+            if CONTROLLER:
+                await CONTROLLER.async_release(latency=None if prepare else time.monotonic() - start,
+                                               congested=r.status in RETRY_CODES)
+            if r.status not in RETRY_CODES:
+                return (r.status, content)
+            delay = next(delays, None)
+            if delay is None:
+                return (r.status, content)
+            reason = 'HTTP code: {}'.format(r.status)
+        if LOGGER:
+            LOGGER.warning('{} request to {} failed ({}), retrying in {:.1f} s'.format(method, url, reason, delay))
+        await asyncio.sleep(delay)
+
+
+async def async_refresh_csrf(session, csrf=''):
+    """ asyncio version of refresh_csrf """
+    fresh_csrf = get_fresh_csrf(csrf)
+    if fresh_csrf != csrf:
+        return fresh_csrf
+    loop = asyncio.get_running_loop()
+    if loop not in ASYNC_CSRF_LOCKS:
+        ASYNC_CSRF_LOCKS.clear()
+        ASYNC_CSRF_LOCKS[loop] = asyncio.Lock()
+    async with ASYNC_CSRF_LOCKS[loop]:
+        # the token could be refreshed by another task while waiting for the lock
+        fresh_csrf = get_fresh_csrf(csrf)
+        if fresh_csrf != csrf:
+            return fresh_csrf
+        login, password = CSRF_ACCOUNTS.get(csrf, (LOGIN, PASSWORD))
+        fresh_csrf = await async_get_csrf(session, log_errors=False)
+        if not fresh_csrf and await async_cloud_auth(session, login=login, password=password):
+            if LOGGER:
+                LOGGER.info('Cloud session of {} expired, logged in again'.format(login))
+            fresh_csrf = await async_get_csrf(session)
+        if fresh_csrf and fresh_csrf != csrf:
+            CSRF_TOKENS[csrf] = fresh_csrf
+            set_csrf_account(fresh_csrf, login, password)
+            if LOGGER:
+                LOGGER.info('CSRF token refreshed')
+        return fresh_csrf
+
+
+async def async_cloud_auth(session, login=LOGIN, password=PASSWORD):
+    try:
+        status, content = await async_send_request(session, 'POST', AUTH_URL, retries=RETRIES_NON_IDEMPOTENT,
+                                                   data=get_auth_data(login, password))
+    except Exception as e:
+        if LOGGER:
+            LOGGER.error('Cloud auth HTTP request error: {}'.format(e))
+        return None
+
+    return check_auth_response(status, content.decode(errors='replace'))
+
+
+async def async_get_csrf(session, log_errors=True):
+    try:
+        status, content = await async_send_request(session, 'GET', urljoin(CLOUD_URL, 'tokens/csrf'))
+    except Exception as e:
+        if LOGGER:
+            LOGGER.error('Get csrf HTTP request error: {}'.format(e))
+        return None
+
+    if status == requests.codes.ok:
+        return parse_csrf(json.loads(content.decode()))
+    elif LOGGER and log_errors:
+        LOGGER.error('CSRF token request error. Check your connection and credentials settings in {}. \
+HTTP code: {}, msg: {}'.format(CONFIG_FILE, status, content.decode(errors='replace')))
+    return None
+
+
+async def async_get_upload_nodes(session, csrf=''):
+    """ asyncio version of get_upload_nodes """
+    assert csrf is not None, 'no CSRF'
+
+    try:
+        status, content = await async_send_request(session, 'GET', get_dispatcher_url(csrf))
+    except Exception as e:
+        if LOGGER:
+            LOGGER.error('Get upload domain HTTP request error: {}'.format(e))
+        return None
+
+    if status == requests.codes.ok:
+        return parse_upload_nodes(json.loads(content.decode())) or None
+    elif LOGGER:
+        LOGGER.error('Upload domain request error. Check your connection. \
+HTTP code: {}, msg: {}'.format(status, content.decode(errors='replace')))
+    return None
+
+
+async def async_get_upload_domain(session, csrf=''):
+    """ asyncio version of get_upload_domain """
+    nodes = await async_get_upload_nodes(session, csrf=csrf)
+    return nodes[0] if nodes else None
+
+
+async def async_get_cloud_csrf(session, login=LOGIN, password=PASSWORD):
+    if await async_cloud_auth(session, login=login, password=password):
+        return await async_get_csrf(session)
+    return None
+
+
+@timed('handshake')
+async def async_get_handshake(session, login=LOGIN, password=PASSWORD, nodes=None):
+    """ asyncio version of get_handshake """
+    cache = read_session_cache(login)
+    if cache:
+        load_cookies(session, cache['cookies'])
+        set_csrf_account(cache['csrf'], login, password)
+        if LOGGER:
+            LOGGER.info('Cached cloud session of {} reused'.format(login))
+        return (cache['csrf'], set_upload_nodes(cache.get('nodes') or [cache['domain']], nodes))
+    csrf = await async_get_cloud_csrf(session, login=login, password=password)
+    set_csrf_account(csrf, login, password)
+    domain = set_upload_nodes(await async_get_upload_nodes(session, csrf=csrf) if csrf else None, nodes)
+    if domain:
+        write_session_cache(session, csrf=csrf, domain=domain, login=login, nodes=nodes)
+    return (csrf, domain)
+
+
+@timed('space')
+async def async_get_cloud_space(session, csrf='', login=LOGIN):
+    """ returns available free space in bytes """
+    assert csrf is not None, 'no CSRF'
+
+    try:
+        for attempt in range(2):
+            status, content = await async_send_request(session, 'GET', get_space_url(csrf, login))
+            if status not in AUTH_ERROR_CODES or attempt or not await async_refresh_csrf(session, csrf):
+                break
+    except Exception as e:
+        if LOGGER:
+            LOGGER.error('Get cloud space HTTP request error: {}'.format(e))
+        return 0
+
+    if status == requests.codes.ok:
+        return parse_space(json.loads(content.decode()))
+    elif LOGGER:
+        LOGGER.error('Cloud free space request error. Check your connection. \
+HTTP code: {}, msg: {}'.format(status, content.decode(errors='replace')))
+    return 0
+
+
+async def async_get_folder_page(session, folder='', csrf='', offset=0):
+    """ asyncio version of get_folder_page """
+    try:
+        status, content = await async_send_request(session, 'GET', get_listing_url(folder, csrf, offset))
+    except Exception as e:
+        if LOGGER:
+            LOGGER.error('Cloud folder listing HTTP request error: {}'.format(e))
+        return (0, [])
+
+    if check_listing_response(folder, status, content.decode(errors='replace')):
+        return parse_listing(json.loads(content.decode()))
+    return (0, [])
+
+
+@timed('listing')
+async def async_get_remote_index(session, folders=None, csrf='', limit=ASYNC_LIMIT, index=None):
+    """ asyncio version of get_remote_index """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def get_page(folder, offset=0):
+        async with semaphore:
+            return await async_get_folder_page(session, folder=folder, csrf=csrf, offset=offset)
+    index = index or RemoteIndex()
+    pages = []
+    first_pages = await asyncio.gather(*(get_page(folder) for folder in folders))
+    for folder, (total, items) in zip(folders, first_pages):
+        index.add(folder, items)
+        pages.extend((folder, offset) for offset in range(LISTING_LIMIT, total, LISTING_LIMIT))
+    rest_pages = await asyncio.gather(*(get_page(folder, offset) for folder, offset in pages))
+    for (folder, __), (__, items) in zip(pages, rest_pages):
+        index.add(folder, items)
+    return index
+
+
+async def iter_executor(chunks):
+    """ yields chunks of the blocking iterator, which is advanced in the default executor """
+    loop = asyncio.get_running_loop()
+    chunks = iter(chunks)
+    while True:
+        chunk = await loop.run_in_executor(None, next, chunks, None)
+        if chunk is None:
+            break
+        yield chunk
+
+
+def get_async_body(chunks):
+    """ returns asynchronous iterator of the blocking chunks iterator, throttled by the LIMITER if any """
+    body = iter_executor(chunks)
+    return LIMITER.async_iter(body) if LIMITER else body
+
+
+@timed('post', measure=get_result_size)
+async def async_post_file(session, domain='', file='', login=LOGIN, nodes=None):
+    """ posts file to the cloud's upload server
+    file is read in the default executor and rewound by each retry
+    param: file - string filename with path
+    """
+    assert domain is not None, 'no domain'
+    assert file is not None, 'no file'
+
+    filetype = get_filetype(file)
+    filename = os.path.basename(file)
+
+    try:
+        with UploadBody(file, name=filename, filetype=filetype, limiter=LIMITER) as body, \
+             NodePost(domain, login, prepare=body.get_async_request, size=len(body), nodes=nodes) as post:
+            status, content = await async_send_request(session, 'POST', post.url, prepare=post)
+            post.finish(failed=status != requests.codes.ok)
+    except Exception as e:
+        if LOGGER:
+            LOGGER.error('Post file HTTP request error: {}'.format(e))
+        return (None, None)
+
+    return parse_post_response(file, status, content)
+
+
+@timed('post', measure=get_result_size)
+async def async_post_archive(session, domain='', file='', login=LOGIN, nodes=None):
+    """ asyncio version of post_archive, archiving runs in the default executor """
+    assert domain is not None, 'no domain'
+    assert file is not None, 'no file'
+
+    stream = ArchiveStream(file)
+    try:
+        with NodePost(domain, login, prepare=lambda: {'data': get_async_body(stream)},
+                      size=os.path.getsize(file), nodes=nodes) as post:
+            status, content = await async_send_request(session, 'POST', post.url, prepare=post,
+                                                       headers={'Content-Type': stream.content_type})
+            post.finish(failed=status != requests.codes.ok)
+    except Exception as e:
+        if LOGGER:
+            LOGGER.error('Post archive HTTP request error: {}'.format(e))
+        return (None, None)
+
+    return check_streamed_archive(file, stream, *parse_post_response(file, status, content))
+
+
+@timed('post', measure=get_result_size)
+async def async_post_volume(session, domain='', file='', name='', offset=0, size=0, login=LOGIN, nodes=None):
+    """ asyncio version of post_volume, file is read in the default executor """
+    assert domain is not None, 'no domain'
+    assert file is not None, 'no file'
+
+    try:
+        with UploadBody(file, name=name, offset=offset, size=size, limiter=LIMITER) as body, \
+             NodePost(domain, login, prepare=body.get_async_request, size=len(body), nodes=nodes) as post:
+            status, content = await async_send_request(session, 'POST', post.url, prepare=post)
+            post.finish(failed=status != requests.codes.ok)
+    except Exception as e:
+        if LOGGER:
+            LOGGER.error('Post volume HTTP request error: {}'.format(e))
+        return (None, None)
+
+    return parse_post_response(name, status, content)
+
+
+async def async_make_post(session, obj='', csrf='', command='', params=None, log_errors=True):
+    """ invokes standart cloud post operation, see make_post """
+    assert obj is not None, 'no object'
+    assert csrf is not None, 'no CSRF'
+    assert command is not None, 'no command'
+
+    try:
+        for attempt in range(2):
+            status, content = await async_send_request(session, 'POST', urljoin(CLOUD_URL, command),
+                                                       retries=RETRIES_NON_IDEMPOTENT,
+                                                       data=get_post_data(obj, csrf, params))
+            if status not in AUTH_ERROR_CODES or attempt or not await async_refresh_csrf(session, csrf):
+                break
+    except Exception as e:
+        if LOGGER:
+            LOGGER.error('Make post ({}) HTTP request error: {}'.format(command, e))
+        return None
+
+    return check_post_response(obj, command, status, content.decode(errors='replace'), log_errors=log_errors)
+
+
+@timed('add', measure=get_success)
+async def async_add_file(session, file='', hash='', size=0, csrf='', log_errors=True):
+    """ 'file' should be filename with absolute cloud path """
+    assert len(hash) == 40, 'invalid hash: {}'.format(hash)
+    assert size >= 0, 'invalid size: {}'.format(size)
+
+    return await async_make_post(session, obj=file, csrf=csrf, command='file/add', params = {'hash': hash, 'size': size},
+                                 log_errors=log_errors)
+
+
+async def async_create_folder(session, folder='', csrf=''):
+    """ see create_folder """
+    return await async_make_post(session, obj=folder, csrf=csrf, command='folder/add')
+
+
+@timed('hash', measure=get_result_size)
+def get_cloud_hash(file, chunk_size=HASH_CHUNK_SIZE, offset=0, size=None):
+    """ returns (hash, size) of the file computed the same way as the cloud does
+    small files are hashed by their zero padded contents,
+    others by sha1 of the salt, contents and decimal size
+    param: file - filename with path (string)
+    param: offset, size - file part to hash, whole file by default
+    """
+    if size is None:
+        size = os.path.getsize(file) - offset
+    with FileSlice(file, offset, size) as f:
+        if size < HASH_MIN_SIZE:
+            return (f.read().ljust(HASH_MIN_SIZE - 1, b'\0').hex().upper(), size)
+        sha1 = hashlib.sha1(HASH_SALT)
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    sha1.update(str(size).encode())
+    return (sha1.hexdigest().upper(), size)
+
+
+def is_archivable(file, size=None, mtime=None):
+    """ returns True if the file should be zipped before upload
+    param: size - file size if known, requested otherwise
+    param: mtime - file modification time if known, requested otherwise
+    """
+    return (ARCHIVE_FILES and not is_compressed(file) and not is_split(file, size)
+            and is_compressible(file, os.path.getsize(file) if size is None else size, mtime))
+
+
+def is_compressed(file):
+    """ returns True if the file type is known to be compressed already """
+    filetype, encoding = guess_type(file)
+    return filetype in FILES_TO_PRESERVE or encoding is not None
+
+
+def get_codec():
+    """ returns (zipfile compression type, compression level) of archives """
+    return (COMPRESSION_CODECS[COMPRESSION], COMPRESS_LEVEL if COMPRESS_LEVEL >= 0 else None)
+
+
+def compress_sample(data):
+    """ returns data compressed the same way as archives are """
+    level = get_codec()[1]
+    if COMPRESSION == 'bz2':
+        return bz2.compress(data, 9 if level is None else max(1, level))
+    if COMPRESSION == 'lzma':
+        return lzma.compress(data)
+    return zlib.compress(data, -1 if level is None else level)
+
+
+def is_compressible(file, size, mtime=None):
+    """ returns True if the estimated archive is smaller than COMPRESS_THRESHOLD of the file """
+    if COMPRESS_SAMPLE <= 0:
+        return True
+    ratio = get_archive_ratio(file, size, os.path.getmtime(file) if mtime is None else mtime)
+    if ratio > COMPRESS_THRESHOLD:
+        if LOGGER:
+            LOGGER.info('File {} estimated compression ratio {:.2f} is above threshold, not archiving'.format(file, ratio))
+        return False
+    return True
+
+
+@lru_cache(maxsize=SCAN_BATCH_FILES)
+@timed('sample')
+def get_archive_ratio(file, size, mtime=None):
+    """ returns the estimated archive to file size ratio
+    the ratio of compressed COMPRESS_SAMPLE kilobytes file prefix is extended to the whole file,
+    archive headers are counted too, so small files are not archived for nothing
+    estimations are cached by file, size and modification time, the cache is cleared by each run
+    """
+    if not size:
+        return float('inf')
+    with open(file, 'rb') as f:
+        sample = f.read(COMPRESS_SAMPLE * 1024)
+    sample_ratio = len(compress_sample(sample)) / len(sample) if sample else 1
+    overhead = ZIP_OVERHEAD + 2 * len(os.path.basename(file).encode())
+    return (sample_ratio * size + overhead) / size
+
+
+def is_split(file, size=None):
+    """ returns True if the file should be uploaded by volumes """
+    return SPLIT_LARGE and (os.path.getsize(file) if size is None else size) >= MAX_FILE_SIZE
+
+
+def get_cloud_name(file, size=None, mtime=None):
+    """ returns the file name in the cloud: archive, split file manifest or the file name itself """
+    name = os.path.basename(file)
+    if is_split(file, size):
+        return name + '.parts.json'
+    if is_archivable(file, size, mtime):
+        return name + '.zip'
+    return name
+
+
+def is_streamed_archive(file):
+    """ returns True if the file should be zipped on the fly while posting """
+    return STREAM_ARCHIVES and is_archivable(file)
+
+
+def get_zip_info(file, arcname, compress_type=zipfile.ZIP_DEFLATED, level=None):
+    """ returns ZipInfo of the file archive entry, with fixed timestamp and attributes if REPRODUCIBLE_ARCHIVES is set,
+    with the file's ones otherwise
+    """
+    if REPRODUCIBLE_ARCHIVES:
+        info = zipfile.ZipInfo(arcname, date_time=ARCHIVE_DATE_TIME)
+        # unix, regular file
+        info.create_system = 3
+        info.external_attr = (0o100000 | ARCHIVE_FILE_MODE) << 16
+        # zip64 extensions are chosen by the expected size
+        info.file_size = os.path.getsize(file)
+    else:
+        info = zipfile.ZipInfo.from_file(file, arcname=arcname)
+    info.compress_type = compress_type
+    if level is not None:
+        # ZipInfo level is public since python 3.13, archives written sequentially take it from ZipFile instead
+        if hasattr(info, 'compress_level'):
+            info.compress_level = level
+        else:
+            info._compresslevel = level
+    return info
+
+
+def write_zip_entry(zf, file, arcname, compress_type=None, chunk_size=STREAM_CHUNK_SIZE):
+    """ writes the file to the zip archive compressed by the archive's codec and level unless compress_type is given,
+    with fixed timestamp and attributes if REPRODUCIBLE_ARCHIVES is set, with the file's ones otherwise
+    """
+    if not REPRODUCIBLE_ARCHIVES:
+        zf.write(file, arcname=arcname, compress_type=compress_type)
+        return
+    # entries opened by name are compressed by the archive's codec and level, ARCHIVE_DATE_TIME is their timestamp
+    entry_name = arcname if compress_type is None else get_zip_info(file, arcname, compress_type)
+    with open(file, 'rb') as f, zf.open(entry_name, mode='w',
+                                        force_zip64=os.path.getsize(file) * 1.05 > zipfile.ZIP64_LIMIT) as entry:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            entry.write(chunk)
+    # attributes are written with the central directory
+    info = zf.infolist()[-1]
+    info.create_system = 3
+    info.external_attr = (0o100000 | ARCHIVE_FILE_MODE) << 16
+
+
+def make_zip(file):
+    """ creates compressed zip file with same name and 'zip' extension, removes original file
+    the archive is written sequentially (entry sizes follow the data), its cloud hash is computed meanwhile
+    raises exception on failure, replaces existing archives
+    returns (archive filename with path, (cloud hash, size) of the archive)
+    """
+    file_path, file_name = os.path.split(file)
+    zip_name = os.path.join(file_path, file_name + '.zip')
+    codec, level = get_codec()
+    with open(zip_name, 'wb') as f:
+        writer = CloudHashWriter(f)
+        with zipfile.ZipFile(writer, mode='w', compression=codec, compresslevel=level) as zf:
+            write_zip_entry(zf, file, file_name)
+    os.unlink(file)
+    return (zip_name, writer.get_hash())
+
+
+def log_archiving(file, archive, error=None, size=None):
+    """ logs archiving result, records compression ratio if the original file size is known """
+    ratio = ''
+    if not error and size is not None:
+        archive_size = os.path.getsize(archive)
+        if METRICS:
+            METRICS.add_compression(size, archive_size)
+        ratio = ', compression ratio: {:.2f}'.format(archive_size / size if size else 1)
+    if not LOGGER:
+        return
+    if error:
+        LOGGER.error('Failed to archive {}, error: {}'.format(file, error))
+    else:
+        LOGGER.info('{} archived as {}{}'.format(file, archive, ratio))
+        LOGGER.info('file {} deleted after archiving'.format(file))
+
+
+@timed('archive')
 def zip_file(file):
     """ creates compressed zip files with same name and 'zip' extension
     on success removes original file
@@ -330,48 +2685,482 @@ def zip_file(file):
     replaces existing archives
     param: file - filename with path (string)
     """
-    file_path, file_name = os.path.split(file)
-    zip_name = file_name + '.zip'
-    compression = zipfile.ZIP_DEFLATED
     try:
-        zf = zipfile.ZipFile(os.path.join(file_path, zip_name), mode='w')
-        zf.debug = 0
-        # convert unicode file names to byte strings if any
-        zf.write(file, arcname=file_name, compress_type=compression)
+        size = os.path.getsize(file)
+        archive, hash = make_zip(file)
     except Exception as e:
-        zip_name = file_name
-        if LOGGER:
-            LOGGER.error('Failed to archive {}, error: {}'.format(file, e))
+        log_archiving(file, None, e)
+        return file
+    ARCHIVE_HASHES[archive] = hash
+    log_archiving(file, archive, size=size)
+    return archive
+
+
+def compress_file(file):
+    """ Compressor process task, returns (file, archive, hash, error, size)
+    archive is the original file on failure, logging is left to the parent process
+    hash is (cloud hash, size) of the archive, size is the original file size
+    """
+    try:
+        size = os.path.getsize(file)
+        return (file, *make_zip(file), None, size)
+    except Exception as e:
+        return (file, file, None, str(e), None)
+
+
+def upload_file(session, file='', cloud_path='', domain='', csrf='', manifest=None, journal=None, login=LOGIN,
+                nodes=None):
+    """ posts the file and adds it to the cloud folder, returns the file on success
+    could be invoked from multiple threads sharing the same session
+    param: file - string filename with path
+    param: cloud_path - cloud folder to add the file to
+    param: manifest - UploadManifest to record uploaded file in
+    param: journal - UploadJournal of posted files
+    param: login - account of the session
+    param: nodes - UploadNodes of the account
+    """
+    streamed = is_streamed_archive(file)
+    cloud_file = cloud_path + '/' + os.path.basename(file) + ('.zip' if streamed else '')
+    # archives made by the run are hashed while written
+    archive_hash = ARCHIVE_HASHES.pop(file, None)
+    hash, size = journal.get_posted(file, login=login) if journal else (None, None)
+    if hash:
+        if add_file(session, file=cloud_file, hash=hash, size=size, csrf=csrf, log_errors=False):
+            LOGGER.info('File {} has already been posted, successfully added'.format(file))
+            journal.forget(file, login=login)
+            return uploaded(file, hash, manifest, login)
+        # posted contents are not kept by the cloud for long unless added
+        LOGGER.warning('File {} has already been posted, but its hash is rejected, posting again'.format(file))
+        journal.forget(file, login=login)
+    # archive hash is unknown until it is streamed
+    elif HASH_FIRST and not streamed:
+        hash, size = archive_hash or get_cloud_hash(file)
+        # the cloud rejects unknown hashes, contents should be posted then
+        if add_file(session, file=cloud_file, hash=hash, size=size, csrf=csrf, log_errors=False):
+            LOGGER.info('File {} successfully added by hash, contents not posted'.format(file))
+            return uploaded(file, hash, manifest, login)
+    if streamed:
+        hash, size = post_archive(session, domain=domain, file=file, login=login, nodes=nodes)
     else:
-        os.unlink(file)
-        if LOGGER:
-            LOGGER.info('{} archived as {}'.format(file, os.path.join(file_path, zip_name)))
-            LOGGER.info('file {} deleted after archiving'.format(file))
+        hash, size = post_file(session, domain=domain, file=file, login=login, nodes=nodes)
+    if hash and size>=0:
+        LOGGER.info('File {} successfully posted'.format(file))
+        if journal:
+            journal.add_posted(file, hash, size, login=login)
+        if add_file(session, file=cloud_file, hash=hash, size=size, csrf=csrf):
+            LOGGER.info('File {} successfully added'.format(file))
+            if journal:
+                journal.forget(file, login=login)
+            return uploaded(file, hash, manifest, login)
+    return None
+
+
+def uploaded(file, hash, manifest=None, login=LOGIN):
+    """ records the uploaded file and its account in the manifest if any, returns the file """
+    if manifest:
+        manifest.add(file, hash, account=login)
+    return file
+
+
+async def async_upload_file(session, file='', cloud_path='', domain='', csrf='', manifest=None, journal=None,
+                            login=LOGIN, nodes=None):
+    """ asyncio version of upload_file """
+    streamed = is_streamed_archive(file)
+    cloud_file = cloud_path + '/' + os.path.basename(file) + ('.zip' if streamed else '')
+    archive_hash = ARCHIVE_HASHES.pop(file, None)
+    hash, size = journal.get_posted(file, login=login) if journal else (None, None)
+    if hash:
+        if await async_add_file(session, file=cloud_file, hash=hash, size=size, csrf=csrf, log_errors=False):
+            LOGGER.info('File {} has already been posted, successfully added'.format(file))
+            journal.forget(file, login=login)
+            return uploaded(file, hash, manifest, login)
+        LOGGER.warning('File {} has already been posted, but its hash is rejected, posting again'.format(file))
+        journal.forget(file, login=login)
+    elif HASH_FIRST and not streamed:
+        hash, size = archive_hash or await asyncio.get_running_loop().run_in_executor(None, get_cloud_hash, file)
+        if await async_add_file(session, file=cloud_file, hash=hash, size=size, csrf=csrf, log_errors=False):
+            LOGGER.info('File {} successfully added by hash, contents not posted'.format(file))
+            return uploaded(file, hash, manifest, login)
+    if streamed:
+        hash, size = await async_post_archive(session, domain=domain, file=file, login=login, nodes=nodes)
+    else:
+        hash, size = await async_post_file(session, domain=domain, file=file, login=login, nodes=nodes)
+    if hash and size>=0:
+        LOGGER.info('File {} successfully posted'.format(file))
+        if journal:
+            journal.add_posted(file, hash, size, login=login)
+        if await async_add_file(session, file=cloud_file, hash=hash, size=size, csrf=csrf):
+            LOGGER.info('File {} successfully added'.format(file))
+            if journal:
+                journal.forget(file, login=login)
+            return uploaded(file, hash, manifest, login)
+    return None
+
+
+def upload_volume(session, split=None, index=0, domain='', csrf='', journal=None, login=LOGIN, nodes=None):
+    """ posts the split file volume and adds it to the cloud folder, records it in the split on success
+    could be invoked from multiple threads sharing the same session
+    param: split - SplitUpload of the file
+    param: index - volume index
+    """
+    offset, volume_size = split.volumes[index]
+    name = split.get_volume_name(index)
+    cloud_file = split.cloud_path + '/' + name
+    hash, size = journal.get_posted(split.file, part=name, login=login) if journal else (None, None)
+    if hash:
+        if add_file(session, file=cloud_file, hash=hash, size=size, csrf=csrf, log_errors=False):
+            LOGGER.info('Volume {} of {} has already been posted, successfully added'.format(name, split.file))
+            journal.forget(split.file, part=name, login=login)
+            split.set_record(index, hash)
+            return None
+        LOGGER.warning('Volume {} of {} has already been posted, but its hash is rejected, posting again'.format(
+            name, split.file))
+        journal.forget(split.file, part=name, login=login)
+    elif HASH_FIRST:
+        hash, size = get_cloud_hash(split.file, offset=offset, size=volume_size)
+        if add_file(session, file=cloud_file, hash=hash, size=size, csrf=csrf, log_errors=False):
+            LOGGER.info('Volume {} of {} successfully added by hash, contents not posted'.format(name, split.file))
+            split.set_record(index, hash)
+            return None
+    hash, size = post_volume(session, domain=domain, file=split.file, name=name, offset=offset, size=volume_size,
+                             login=login, nodes=nodes)
+    if hash and size>=0:
+        LOGGER.info('Volume {} of {} successfully posted'.format(name, split.file))
+        if journal:
+            journal.add_posted(split.file, hash, size, part=name, login=login)
+        if add_file(session, file=cloud_file, hash=hash, size=size, csrf=csrf):
+            LOGGER.info('Volume {} of {} successfully added'.format(name, split.file))
+            if journal:
+                journal.forget(split.file, part=name, login=login)
+            split.set_record(index, hash)
+    return None
+
+
+def finish_split(session, split=None, domain='', csrf='', manifest=None, login=LOGIN, nodes=None):
+    """ uploads the split file manifest if all the volumes are uploaded, returns the file on success """
+    if not split.is_complete():
+        LOGGER.error('File {} is not uploaded, some of its volumes failed'.format(split.file))
+        return None
+    manifest_dir = tempfile.mkdtemp()
+    try:
+        manifest_file = os.path.join(manifest_dir, split.manifest_name)
+        with open(manifest_file, mode='w') as f:
+            json.dump(split.get_manifest(), f, indent=1)
+        file = upload_file(session, file=manifest_file, cloud_path=split.cloud_path, domain=domain, csrf=csrf,
+                           login=login, nodes=nodes)
     finally:
-        zf.close()
-    return os.path.join(file_path, zip_name)
+        rmtree(manifest_dir, ignore_errors=True)
+    if file:
+        LOGGER.info('File {} successfully uploaded by {} volume(s)'.format(split.file, len(split.volumes)))
+        return uploaded(split.file, None, manifest, login)
+    return None
 
 
-def get_dir_files(path=UPLOAD_PATH, space=0):
-    """ returns list of the cwd files, follows cloud restrictions """
-    assert space is not None, 'No cloud space left or space fetching error'
+def upload_bundle(session, bundle=None, cloud_path='', domain='', csrf='', manifest=None, login=LOGIN, nodes=None):
+    """ uploads the bundle archive, returns the list of its member files on success
+    the archive is removed anyway, bundles are not journaled as they are made anew by each run
+    """
+    try:
+        file = upload_file(session, file=bundle.archive, cloud_path=cloud_path, domain=domain, csrf=csrf, login=login,
+                           nodes=nodes)
+    finally:
+        bundle.close()
+    return get_bundle_result(bundle, file, manifest, login)
+
+
+def get_bundle_result(bundle, file, manifest=None, login=LOGIN):
+    """ records uploaded bundle members in the manifest if any, returns them, None if the bundle failed """
+    if not file:
+        return None
+    LOGGER.info('{} file(s) uploaded by bundle {}'.format(len(bundle.members), bundle.name))
+    return [uploaded(member, None, manifest, login) for member in bundle.members]
+
+
+def get_upload_jobs(session, file='', cloud_path='', domain='', csrf='', manifest=None, journal=None, splits=None,
+                    bundles=None, login=LOGIN, nodes=None):
+    """ returns upload callables of the file, one per volume for the split files
+    split files are appended to the splits list to be finished after all volumes are uploaded
+    param: bundles - dict of Bundle by bundle archive, filled by get_dir_files
+    param: login - account of the session
+    param: nodes - UploadNodes of the account
+    """
+    if bundles and file in bundles:
+        return [partial(upload_bundle, session, bundle=bundles.pop(file), cloud_path=cloud_path, domain=domain,
+                        csrf=csrf, manifest=manifest, login=login, nodes=nodes)]
+    if is_split(file):
+        split = SplitUpload(file, cloud_path, volume_size=VOLUME_SIZE*1024*1024)
+        splits.append(split)
+        return [partial(upload_volume, session, split=split, index=index, domain=domain, csrf=csrf,
+                        journal=journal, login=login, nodes=nodes) for index in range(len(split.volumes))]
+    return [partial(upload_file, session, file=file, cloud_path=cloud_path, domain=domain, csrf=csrf,
+                    manifest=manifest, journal=journal, login=login, nodes=nodes)]
+
+
+async def async_upload_volume(session, split=None, index=0, domain='', csrf='', journal=None, login=LOGIN, nodes=None):
+    """ asyncio version of upload_volume """
+    offset, volume_size = split.volumes[index]
+    name = split.get_volume_name(index)
+    cloud_file = split.cloud_path + '/' + name
+    hash, size = journal.get_posted(split.file, part=name, login=login) if journal else (None, None)
+    if hash:
+        if await async_add_file(session, file=cloud_file, hash=hash, size=size, csrf=csrf, log_errors=False):
+            LOGGER.info('Volume {} of {} has already been posted, successfully added'.format(name, split.file))
+            journal.forget(split.file, part=name, login=login)
+            split.set_record(index, hash)
+            return None
+        LOGGER.warning('Volume {} of {} has already been posted, but its hash is rejected, posting again'.format(
+            name, split.file))
+        journal.forget(split.file, part=name, login=login)
+    elif HASH_FIRST:
+        hash, size = await asyncio.get_running_loop().run_in_executor(
+            None, partial(get_cloud_hash, split.file, offset=offset, size=volume_size))
+        if await async_add_file(session, file=cloud_file, hash=hash, size=size, csrf=csrf, log_errors=False):
+            LOGGER.info('Volume {} of {} successfully added by hash, contents not posted'.format(name, split.file))
+            split.set_record(index, hash)
+            return None
+    hash, size = await async_post_volume(session, domain=domain, file=split.file, name=name, offset=offset,
+                                         size=volume_size, login=login, nodes=nodes)
+    if hash and size>=0:
+        LOGGER.info('Volume {} of {} successfully posted'.format(name, split.file))
+        if journal:
+            journal.add_posted(split.file, hash, size, part=name, login=login)
+        if await async_add_file(session, file=cloud_file, hash=hash, size=size, csrf=csrf):
+            LOGGER.info('Volume {} of {} successfully added'.format(name, split.file))
+            if journal:
+                journal.forget(split.file, part=name, login=login)
+            split.set_record(index, hash)
+    return None
+
+
+async def async_upload_bundle(session, bundle=None, cloud_path='', domain='', csrf='', manifest=None, login=LOGIN,
+                              nodes=None):
+    """ asyncio version of upload_bundle """
+    try:
+        file = await async_upload_file(session, file=bundle.archive, cloud_path=cloud_path, domain=domain, csrf=csrf,
+                                       login=login, nodes=nodes)
+    finally:
+        bundle.close()
+    return get_bundle_result(bundle, file, manifest, login)
+
+
+async def async_finish_split(session, split=None, domain='', csrf='', manifest=None, login=LOGIN, nodes=None):
+    """ asyncio version of finish_split """
+    if not split.is_complete():
+        LOGGER.error('File {} is not uploaded, some of its volumes failed'.format(split.file))
+        return None
+    manifest_dir = tempfile.mkdtemp()
+    try:
+        manifest_file = os.path.join(manifest_dir, split.manifest_name)
+        with open(manifest_file, mode='w') as f:
+            json.dump(split.get_manifest(), f, indent=1)
+        file = await async_upload_file(session, file=manifest_file, cloud_path=split.cloud_path, domain=domain,
+                                       csrf=csrf, login=login, nodes=nodes)
+    finally:
+        rmtree(manifest_dir, ignore_errors=True)
+    if file:
+        LOGGER.info('File {} successfully uploaded by {} volume(s)'.format(split.file, len(split.volumes)))
+        return uploaded(split.file, None, manifest, login)
+    return None
+
 
-    for filename in next(os.walk(path))[2]:
-        file = os.path.join(path, filename)
+def collect_uploaded(futures, uploaded_files):
+    """ adds files of the finished upload futures to the uploaded files set
+    reraises an upload worker exception if any
+    """
+    for future in futures:
+        try:
+            file = future.result()
+        except:
+            LOGGER.error('File upload error:', exc_info=True)
+            raise
+        # bundles return their members
+        if isinstance(file, list):
+            uploaded_files.update(file)
+        elif file:
+            uploaded_files.add(file)
+
+
+def scan_tree(path=UPLOAD_PATH):
+    """ yields (folder, file entries) of the tree breadth first, parents before children
+    each folder is listed by a single os.scandir call, entries are os.DirEntry caching their stat results
+    only the paths of the folders to scan are kept in memory
+    """
+    folders = deque([path])
+    while folders:
+        folder = folders.popleft()
+        files = []
+        try:
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        folders.append(entry.path)
+                    elif entry.is_file():
+                        files.append(entry)
+        except OSError as e:
+            if LOGGER:
+                LOGGER.error('Folder {} scan error: {}'.format(folder, e))
+            continue
+        yield (folder, files)
+
+
+def scan_batches(path=UPLOAD_PATH, max_folders=SCAN_BATCH, max_files=SCAN_BATCH_FILES):
+    """ yields lists of scan_tree items, limited by the number of folders and files """
+    batch = []
+    files_num = 0
+    for folder, files in scan_tree(path):
+        batch.append((folder, files))
+        files_num += len(files)
+        if len(batch) >= max_folders or files_num >= max_files:
+            yield batch
+            batch = []
+            files_num = 0
+    if batch:
+        yield batch
+
+
+def get_file_batches(files, max_folders=SCAN_BATCH):
+    """ yields scan_batches like lists of the given files grouped by folders, parents before children """
+    folders = {}
+    for file in files:
+        folders.setdefault(os.path.dirname(file), []).append(FileEntry(file))
+    batch = []
+    for folder in sorted(folders, key=lambda folder: (folder.count(os.sep), folder)):
+        batch.append((folder, folders[folder]))
+        if len(batch) >= max_folders:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def get_watcher(path=UPLOAD_PATH):
+    """ returns InotifyWatcher of the path on Linux, PollingWatcher otherwise or if inotify fails """
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(path)
+        except OSError as e:
+            if LOGGER:
+                LOGGER.warning('File system events are not available, polling {}: {}'.format(path, e))
+    return PollingWatcher(path, interval=WATCH_POLL)
+
+
+def get_dir_candidates(path=UPLOAD_PATH, entries=None, manifest=None, remote=None, cloud_path=''):
+    """ yields (file, stat) of the folder files to upload before archiving
+    param: entries - os.DirEntry of the folder files, the folder is scanned if None
+    files recorded in the manifest and not changed since are skipped
+    files already present in the cloud folder (by the remote index) are skipped and recorded in the manifest
+    """
+    if entries is None:
+        entries = next(scan_tree(path), (path, []))[1]
+    for entry in entries:
+        file = entry.path
         # in case we uploading current directory
-        if filename in FILES_TO_SKIP and path == '.':
+        if entry.name in FILES_TO_SKIP and path == '.':
             continue
-        # in case some files are already zipped
-        if ARCHIVE_FILES and guess_type(file)[0] not in FILES_TO_PRESERVE:
-            file = zip_file(file)
-        # api restriction
-        file_size = os.path.getsize(file)
-        if file_size < MAX_FILE_SIZE:
-            if file_size < space:
+        stat = entry.stat()
+        if manifest and manifest.is_unchanged(file, stat=stat):
+            if LOGGER:
+                LOGGER.info('File {} has not been changed since last upload, skipping'.format(file))
+            continue
+        if remote:
+            cloud_file = remote.get(cloud_path, get_cloud_name(file, stat.st_size, stat.st_mtime))
+            if cloud_file:
+                if LOGGER:
+                    LOGGER.info('File {} is already present in the cloud folder {}, skipping'.format(file, cloud_path))
+                if manifest:
+                    manifest.add(file, cloud_file[1])
+                continue
+        yield (file, stat)
+
+
+def pack_files(stats, space=0, policy=SPACE_POLICY):
+    """ returns files ordered by the space policy if they do not fit the free space all together
+    param: stats - dict of file stat results by file
+    """
+    files = list(stats)
+    if policy == 'none' or sum(stat.st_size for stat in stats.values()) < space:
+        return files
+    if policy == 'newest':
+        files.sort(key=lambda file: stats[file].st_mtime, reverse=True)
+    else:
+        files.sort(key=lambda file: stats[file].st_size)
+    return files
+
+
+def is_bundled(file, size):
+    """ returns True if the file is small enough to be bundled """
+    return BUNDLE_FILES and size < BUNDLE_THRESHOLD * 1024 and not is_split(file, size)
+
+
+def get_bundle_groups(files, stats):
+    """ returns lists of files to bundle together, no more than BUNDLE_SIZE megabytes each """
+    groups = [[]]
+    group_size = 0
+    for file in files:
+        size = stats[file].st_size
+        if groups[-1] and group_size + size > BUNDLE_SIZE * 1024 * 1024:
+            groups.append([])
+            group_size = 0
+        groups[-1].append(file)
+        group_size += size
+    return groups
+
+
+def iter_bundles(files, stats, bundles):
+    """ yields archives of the files bundled by groups, bundles are registered by archive """
+    for group in get_bundle_groups(files, stats):
+        bundle = Bundle(group, stats)
+        if not bundle.members:
+            bundle.close()
+            continue
+        if LOGGER:
+            LOGGER.info('{} file(s) bundled as {}'.format(len(bundle.members), bundle.name))
+        bundles[bundle.archive] = bundle
+        yield bundle.archive
+
+
+def get_dir_files(path=UPLOAD_PATH, entries=None, ledger=None, manifest=None, compressor=None, remote=None,
+                  cloud_path='', bundles=None):
+    """ returns list of the cwd files, follows cloud restrictions
+    files are archived by the compressor processes if any
+    files fitting the cloud free space are reserved in the ledger
+    small files are packed into bundles registered in the bundles dict (if given and BUNDLE_FILES is set),
+    their archives are returned after the other files
+    """
+    assert ledger is not None, 'No cloud space ledger'
+
+    stats = dict(get_dir_candidates(path, entries=entries, manifest=manifest, remote=remote, cloud_path=cloud_path))
+    files = pack_files(stats, space=ledger.space, policy=SPACE_POLICY)
+    bundled = []
+    if bundles is not None and BUNDLE_FILES:
+        bundled = [file for file in files if is_bundled(file, stats[file].st_size)]
+        # a single small file is not worth bundling
+        if len(bundled) > 1:
+            bundled_files = set(bundled)
+            files = [file for file in files if file not in bundled_files]
+        else:
+            bundled = []
+    # streamed archives are created while posting
+    if not STREAM_ARCHIVES:
+        if compressor:
+            files = compressor.map(files)
+        else:
+            # in case some files are already zipped
+            files = (zip_file(file) if is_archivable(file, stats[file].st_size, stats[file].st_mtime) else file
+                     for file in files)
+    if bundled:
+        files = chain(files, iter_bundles(bundled, stats, bundles))
+    for file in files:
+        # api restriction, large files could be split, archives are not scanned yet
+        file_size = stats[file].st_size if file in stats else os.path.getsize(file)
+        if file_size < MAX_FILE_SIZE or SPLIT_LARGE:
+            if ledger.reserve(file, file_size):
                 yield file
             else:
                 if LOGGER:
-                    LOGGER.warning('Not enough cloud space for <{}>. Left: {} (B). Required: {} (B).'.format(file, space, file_size))
+                    LOGGER.warning('Not enough cloud space for <{}>. Left: {} (B). Required: {} (B).'.format(file, ledger.space, file_size))
+                if bundles and file in bundles:
+                    bundles.pop(file).close()
                 continue
         else:
             if LOGGER:
@@ -379,6 +3168,509 @@ def get_dir_files(path=UPLOAD_PATH, space=0):
             continue
 
 
+def get_folder_levels(folders, cache=None):
+    """ returns lists of the cloud folders missing in the cache, grouped by depth from the root down """
+    levels = {}
+    for folder in folders:
+        if not (cache and folder in cache):
+            levels.setdefault(folder.count('/'), []).append(folder)
+    return [levels[depth] for depth in sorted(levels)]
+
+
+@timed('folders')
+def create_folders(session, folders=None, csrf='', executor=None, cache=None):
+    """ creates the missing cloud folders in parallel, one tree level at a time so parents exist before children
+    created folders are recorded in the cache
+    """
+    for level in get_folder_levels(folders, cache):
+        created = list(executor.map(lambda folder: create_folder(session, folder=folder, csrf=csrf), level))
+        if cache:
+            cache.add(folder for folder, ok in zip(level, created) if ok)
+
+
+@timed('folders')
+async def async_create_folders(session, folders=None, csrf='', limit=ASYNC_LIMIT, cache=None):
+    """ asyncio version of create_folders """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def create(folder):
+        async with semaphore:
+            return await async_create_folder(session, folder=folder, csrf=csrf)
+    for level in get_folder_levels(folders, cache):
+        created = await asyncio.gather(*(create(folder) for folder in level))
+        if cache:
+            cache.add(folder for folder, ok in zip(level, created) if ok)
+
+
+def get_folder_cache(login=LOGIN):
+    """ returns existing cloud folders index of the account if enabled, None otherwise """
+    if CACHE_FOLDERS:
+        return FolderCache(db_file=FOLDERS_FILE, login=login)
+    return None
+
+
+def get_accounts():
+    """ returns CloudAccount list to upload to: the main account, then the extra ones with valid emails """
+    accounts = [CloudAccount(LOGIN, PASSWORD, folders=get_folder_cache(LOGIN))]
+    for login, password in EXTRA_ACCOUNTS:
+        if not EMAIL_REGEXP.match(login):
+            LOGGER.warning('Bad email: {}, account skipped. Check credentials settings in {}'.format(login, CONFIG_FILE))
+        elif not password:
+            LOGGER.warning('No password of {}, account skipped. Check credentials settings in {}'.format(login, CONFIG_FILE))
+        elif login not in [account.login for account in accounts]:
+            accounts.append(CloudAccount(login, password, folders=get_folder_cache(login)))
+    return accounts
+
+
+def get_manifest():
+    """ returns uploaded files manifest if unchanged files should be skipped, None otherwise
+    uploaded files are not kept if moved or removed, so there is nothing to skip
+    """
+    if SKIP_UNCHANGED and not (MOVE_UPLOADED or REMOVE_UPLOADED):
+        return UploadManifest(db_file=MANIFEST_FILE, base=UPLOAD_PATH)
+    return None
+
+
+def refresh_upload_nodes(nodes, urls):
+    """ replaces degraded upload nodes of the account by the ones the dispatcher returned again """
+    if LOGGER:
+        LOGGER.warning('All upload nodes are degraded, dispatcher returned: {}'.format(urls))
+    nodes.update(urls or nodes.get_urls(), reset=True)
+
+
+def get_compressor():
+    """ returns Compressor if files should be archived by processes ahead of upload, None otherwise """
+    if COMPRESS_WORKERS > 0 and ARCHIVE_FILES and not STREAM_ARCHIVES:
+        return Compressor(workers=COMPRESS_WORKERS, queue_size=COMPRESS_QUEUE)
+    return None
+
+
+def sync_upload(manifest=None, compressor=None, journal=None, accounts=None, batches=None):
+    """ uploads UPLOAD_PATH tree with the thread pool engine, returns set of uploaded files
+    files are placed to the accounts by their free space and load, each account has its own session
+    param: accounts - CloudAccount list, the main account by default
+    param: batches - scan_batches like folder batches to upload instead of the whole tree
+    """
+    uploaded_files = set()
+    workers = max(1, UPLOAD_WORKERS)
+    accounts = accounts or [CloudAccount()]
+    with ExitStack() as stack:
+        for account in accounts:
+            account.session = stack.enter_context(get_session(workers))
+            if not account.restore_session():
+                account.csrf, account.domain = get_handshake(account.session, login=account.login,
+                                                             password=account.password, nodes=account.nodes)
+        # sessions are closed after the workers are done
+        executor = stack.enter_context(ThreadPoolExecutor(max_workers=workers))
+        ready = [account for account in accounts if account.csrf and account.domain]
+        if ready and os.path.isdir(UPLOAD_PATH):
+            pending = set()
+            splits = []
+            bundles = {}
+            for account in ready:
+                account.ledger = SpaceLedger(get_cloud_space(account.session, csrf=account.csrf, login=account.login),
+                                             resync_every=SPACE_RESYNC)
+            placement = Placement(ready)
+            # the tree is scanned by batches of folders, breadth first
+            for batch in timed_iter('scan', scan_batches(UPLOAD_PATH)) if batches is None else batches:
+                cloud_paths = [create_cloud_path(folder, cloud_base=CLOUD_PATH, local_base=UPLOAD_PATH)
+                               for folder, __ in batch]
+                # cloud dirs should exist in each account before uploading
+                remote = RemoteIndex() if SKIP_EXISTING else None
+                for account in ready:
+                    create_folders(account.session, folders=cloud_paths, csrf=account.csrf, executor=executor,
+                                   cache=account.folders)
+                    # files present in any account are skipped
+                    if remote:
+                        get_remote_index(account.session, folders=cloud_paths, csrf=account.csrf, executor=executor,
+                                         index=remote)
+                for (folder, entries), cloud_path in zip(batch, cloud_paths):
+                    for account in ready:
+                        if account.ledger.is_stale():
+                            account.ledger.sync(get_cloud_space(account.session, csrf=account.csrf,
+                                                                login=account.login))
+                        if account.nodes.is_stale():
+                            refresh_upload_nodes(account.nodes, get_upload_nodes(account.session, csrf=account.csrf))
+                    # uploading files, keeping a limited number of them queued
+                    try:
+                        for file in get_dir_files(path=folder, entries=entries, ledger=placement, manifest=manifest,
+                                                  compressor=compressor, remote=remote, cloud_path=cloud_path,
+                                                  bundles=bundles):
+                            # bundle archives are removed once uploaded
+                            split_file = is_split(file)
+                            account = placement.get_account(file)
+                            for job in get_upload_jobs(account.session, file=file, cloud_path=cloud_path,
+                                                       domain=account.domain, csrf=account.csrf, manifest=manifest,
+                                                       journal=journal, splits=splits, bundles=bundles,
+                                                       login=account.login, nodes=account.nodes):
+                                if len(pending) >= workers * 2:
+                                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                                    collect_uploaded(done, uploaded_files)
+                                future = executor.submit(job)
+                                # split files are settled when finished
+                                if not split_file:
+                                    future.add_done_callback(partial(placement.settle_future, file))
+                                if DISPOSER:
+                                    future.add_done_callback(DISPOSER.put_future)
+                                pending.add(future)
+                    except:
+                        LOGGER.error('File upload error:', exc_info=True)
+                        raise
+            collect_uploaded(wait(pending)[0], uploaded_files)
+            # split files manifests are uploaded after all the volumes, to the account of the volumes
+            for split in splits:
+                account = placement.get_account(split.file)
+                file = finish_split(account.session, split=split, domain=account.domain, csrf=account.csrf,
+                                    manifest=manifest, login=account.login, nodes=account.nodes)
+                placement.settle(split.file, uploaded=bool(file))
+                if file:
+                    uploaded_files.add(file)
+                    if DISPOSER:
+                        DISPOSER.put(file)
+            # tokens could be refreshed during the upload
+            for account in ready:
+                account.keep_session()
+                write_session_cache(account.session, csrf=account.csrf, domain=account.domain, login=account.login,
+                                    nodes=account.nodes)
+    return uploaded_files
+
+
+async def async_upload(manifest=None, compressor=None, journal=None, accounts=None, batches=None):
+    """ uploads UPLOAD_PATH tree with the asyncio engine, returns set of uploaded files
+    archiving runs in the default executor to keep the event loop responsive
+    param: accounts - CloudAccount list, the main account by default
+    param: batches - scan_batches like folder batches to upload instead of the whole tree
+    """
+    uploaded_files = set()
+    limit = max(1, ASYNC_LIMIT)
+    loop = asyncio.get_running_loop()
+    accounts = accounts or [CloudAccount()]
+    async with AsyncExitStack() as stack:
+        for account in accounts:
+            account.session = await stack.enter_async_context(get_async_session(limit))
+            if not account.restore_session():
+                account.csrf, account.domain = await async_get_handshake(account.session, login=account.login,
+                                                                         password=account.password,
+                                                                         nodes=account.nodes)
+        ready = [account for account in accounts if account.csrf and account.domain]
+        if ready and os.path.isdir(UPLOAD_PATH):
+            pending = set()
+            splits = []
+            bundles = {}
+            for account in ready:
+                account.ledger = SpaceLedger(await async_get_cloud_space(account.session, csrf=account.csrf,
+                                                                         login=account.login),
+                                             resync_every=SPACE_RESYNC)
+            placement = Placement(ready)
+            # the tree is scanned by batches of folders in the default executor
+            batches = timed_iter('scan', scan_batches(UPLOAD_PATH)) if batches is None else iter(batches)
+            while True:
+                batch = await loop.run_in_executor(None, next, batches, None)
+                if batch is None:
+                    break
+                cloud_paths = [create_cloud_path(folder, cloud_base=CLOUD_PATH, local_base=UPLOAD_PATH)
+                               for folder, __ in batch]
+                # cloud dirs should exist in each account before uploading
+                remote = RemoteIndex() if SKIP_EXISTING else None
+                for account in ready:
+                    await async_create_folders(account.session, folders=cloud_paths, csrf=account.csrf, limit=limit,
+                                               cache=account.folders)
+                    if remote:
+                        await async_get_remote_index(account.session, folders=cloud_paths, csrf=account.csrf,
+                                                     limit=limit, index=remote)
+                for (folder, entries), cloud_path in zip(batch, cloud_paths):
+                    for account in ready:
+                        if account.ledger.is_stale():
+                            account.ledger.sync(await async_get_cloud_space(account.session, csrf=account.csrf,
+                                                                            login=account.login))
+                        if account.nodes.is_stale():
+                            refresh_upload_nodes(account.nodes, await async_get_upload_nodes(account.session,
+                                                                                             csrf=account.csrf))
+                    files = get_dir_files(path=folder, entries=entries, ledger=placement, manifest=manifest,
+                                          compressor=compressor, remote=remote, cloud_path=cloud_path,
+                                          bundles=bundles)
+                    try:
+                        while True:
+                            file = await loop.run_in_executor(None, next, files, None)
+                            if file is None:
+                                break
+                            # the file could be disposed as soon as it is uploaded
+                            split_file = is_split(file)
+                            account = placement.get_account(file)
+                            s = account.session
+                            if file in bundles:
+                                coroutines = [async_upload_bundle(s, bundle=bundles.pop(file), cloud_path=cloud_path,
+                                                                  domain=account.domain, csrf=account.csrf,
+                                                                  manifest=manifest, login=account.login,
+                                                                  nodes=account.nodes)]
+                            elif split_file:
+                                split = SplitUpload(file, cloud_path, volume_size=VOLUME_SIZE*1024*1024)
+                                splits.append(split)
+                                coroutines = [async_upload_volume(s, split=split, index=index, domain=account.domain,
+                                                                  csrf=account.csrf, journal=journal,
+                                                                  login=account.login, nodes=account.nodes)
+                                              for index in range(len(split.volumes))]
+                            else:
+                                coroutines = [async_upload_file(s, file=file, cloud_path=cloud_path,
+                                                                domain=account.domain, csrf=account.csrf,
+                                                                manifest=manifest, journal=journal,
+                                                                login=account.login, nodes=account.nodes)]
+                            for coroutine in coroutines:
+                                if len(pending) >= limit:
+                                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                                    collect_uploaded(done, uploaded_files)
+                                future = asyncio.ensure_future(coroutine)
+                                if not split_file:
+                                    future.add_done_callback(partial(placement.settle_future, file))
+                                if DISPOSER:
+                                    future.add_done_callback(DISPOSER.put_future)
+                                pending.add(future)
+                    except:
+                        LOGGER.error('File upload error:', exc_info=True)
+                        raise
+            if pending:
+                collect_uploaded((await asyncio.wait(pending))[0], uploaded_files)
+            for split in splits:
+                account = placement.get_account(split.file)
+                file = await async_finish_split(account.session, split=split, domain=account.domain,
+                                                csrf=account.csrf, manifest=manifest, login=account.login,
+                                                nodes=account.nodes)
+                placement.settle(split.file, uploaded=bool(file))
+                if file:
+                    uploaded_files.add(file)
+                    if DISPOSER:
+                        DISPOSER.put(file)
+            # tokens could be refreshed during the upload
+            for account in ready:
+                account.keep_session()
+                write_session_cache(account.session, csrf=account.csrf, domain=account.domain, login=account.login,
+                                    nodes=account.nodes)
+    return uploaded_files
+
+
+def remove_empty_folders(path=UPLOAD_PATH):
+    """ removes empty subfolders of the path bottom up, each folder is listed once
+    the tree is walked by a stack, not recursively, so its depth is not limited by the recursion limit
+    returns True if the path itself is empty after that
+    """
+    kept = set() # folders not empty after their subfolders are removed
+    # (folder, its parent, True if the folder is listed and its subfolders are processed already)
+    stack = [(path, None, False)]
+    while stack:
+        folder, parent, listed = stack.pop()
+        if not listed:
+            stack.append((folder, parent, True))
+            has_files = False
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append((entry.path, folder, False))
+                    else:
+                        has_files = True
+            if has_files:
+                kept.add(folder)
+        elif folder in kept:
+            if parent is not None:
+                kept.discard(folder)
+                kept.add(parent)
+        elif parent is not None:
+            os.rmdir(folder)
+            if LOGGER:
+                LOGGER.info('Empty directory {} deleted'.format(folder))
+    return path not in kept
+
+
+def find_uploads(batches, manifest=None):
+    """ returns the batches if any of their files is to be uploaded, None otherwise
+    batches scanned to find it are kept without the files skipped as unchanged, the rest are not scanned yet
+    """
+    batches = iter(batches)
+    scanned = []
+    for batch in batches:
+        found = False
+        kept = []
+        for folder, entries in batch:
+            files = set(file for file, __ in get_dir_candidates(folder, entries=entries, manifest=manifest))
+            found = found or bool(files)
+            kept.append((folder, [entry for entry in entries if entry.path in files]))
+        scanned.append(kept)
+        if found:
+            return chain(scanned, batches)
+    return None
+
+
+def set_ca_bundle():
+    """ points requests to the CA certificate, the bundled one for the frozen executable """
+    if IS_FROZEN:
+        # cacert file should be in module's directory
+        # for cx_Freeze
+        #cacert = os.path.join(os.path.dirname(sys.executable), CACERT_FILE)
+        # for PyInstaller
+        cacert = resource_path(CACERT_FILE)
+    else:
+        # provide CA cert (not necessary)
+        cacert = requests.certs.where()
+    assert os.path.isfile(cacert), 'Fatal Error. CA certificate not found.'
+    os.environ["REQUESTS_CA_BUNDLE"] = cacert
+
+
+def run_upload(engine=ENGINE, batches=None, manifest=None, compressor=None, journal=None, accounts=None):
+    """ uploads the tree (or the batches) with the engine, returns set of uploaded files
+    the tree is scanned before logging in, nothing is imported or requested if there is nothing to upload
+    """
+    if os.path.isdir(UPLOAD_PATH):
+        batches = find_uploads(timed_iter('scan', scan_batches(UPLOAD_PATH)) if batches is None else batches,
+                               manifest=manifest)
+    else:
+        batches = None
+    if batches is None:
+        if LOGGER:
+            LOGGER.info('Nothing to upload in {}'.format(UPLOAD_PATH))
+        return set()
+    set_ca_bundle()
+    if engine == 'async':
+        return asyncio.run(async_upload(manifest=manifest, compressor=compressor, journal=journal, accounts=accounts,
+                                        batches=batches))
+    return sync_upload(manifest=manifest, compressor=compressor, journal=journal, accounts=accounts, batches=batches)
+
+
+@timed('dispose')
+def dispose_file(file):
+    """ moves or removes the uploaded file according to the settings """
+    if MOVE_UPLOADED:
+        upload_dir = os.path.abspath(UPLOAD_PATH)
+        uploaded_dir = os.path.abspath(UPLOADED_PATH)
+        file_dir, file_name  = os.path.split(os.path.abspath(file))
+        # pretty unreliable way to create path
+        file_new_dir = file_dir.replace(upload_dir, uploaded_dir, 1)
+        os.makedirs(file_new_dir, exist_ok=True)
+        move(file, os.path.join(file_new_dir, file_name))
+        LOGGER.info('file {} moved to {}'.format(file, file_new_dir))
+    elif REMOVE_UPLOADED:
+        os.unlink(file)
+        LOGGER.info('file {} removed'.format(file))
+
+
+def prune_folders(folder, path=UPLOAD_PATH):
+    """ removes the folder and its parents up to the path (excluded) while they are empty """
+    base = os.path.abspath(path)
+    folder = os.path.abspath(folder)
+    while folder != base and folder.startswith(base + os.sep):
+        try:
+            os.rmdir(folder)
+        except OSError:
+            # not empty
+            return
+        if LOGGER:
+            LOGGER.info('Empty directory {} deleted'.format(folder))
+        folder = os.path.dirname(folder)
+
+
+def get_disposer(remove_folders=REMOVE_FOLDERS):
+    """ returns Disposer if uploaded files should be moved or removed, None otherwise """
+    if MOVE_UPLOADED or REMOVE_UPLOADED:
+        return Disposer(remove_folders=remove_folders)
+    return None
+
+
+def dispose_uploaded(uploaded_files, remove_folders=REMOVE_FOLDERS):
+    """ waits for the uploaded files to be moved or removed by the disposer, returns the number of them
+    folders left empty are removed if remove_folders is set
+    """
+    uploaded_num = len(uploaded_files)
+    LOGGER.info('{} file(s) successfully uploaded'.format(uploaded_num))
+    if DISPOSER:
+        DISPOSER.join()
+    if uploaded_num and remove_folders and (MOVE_UPLOADED or REMOVE_UPLOADED):
+        dispose_start = time.perf_counter()
+        remove_empty_folders(UPLOAD_PATH)
+        METRICS.add_phase('dispose', time.perf_counter() - dispose_start)
+    return uploaded_num
+
+
+def export_metrics():
+    """ writes the metrics files, errors are logged """
+    try:
+        METRICS.set_value('errors', LOGGER.error.calls)
+        METRICS.set_value('warnings', LOGGER.warning.calls)
+        METRICS.export(json_file=METRICS_FILE, prometheus_file=PROMETHEUS_FILE)
+    except Exception as e:
+        LOGGER.error('Metrics export error: {}'.format(e))
+
+
+def raise_interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def watch_upload(engine=ENGINE, **state):
+    """ uploads the tree, then keeps uploading files as they land in it until interrupted (Ctrl+C or SIGTERM)
+    a file is uploaded once it has not changed for WATCH_DEBOUNCE seconds,
+    the tree is fully rescanned every WATCH_RESCAN minutes and if file system events were lost,
+    files found by the rescan are settled by their modification time the same way
+    the cloud sessions of the accounts are reused between the uploads
+    param: state - manifest, compressor, journal and accounts kept between the uploads
+    returns the total number of uploaded files
+    """
+    # files landing during the initial upload are not missed
+    watcher = get_watcher(UPLOAD_PATH)
+    previous_handler = signal.signal(signal.SIGTERM, raise_interrupt)
+    uploaded_num = 0
+    # file: time of the last change
+    changed = {}
+    try:
+        uploaded_files = run_upload(engine, **state)
+        uploaded_num = dispose_uploaded(uploaded_files)
+        METRICS.set_value('uploaded_files', uploaded_num)
+        export_metrics()
+        for file in watcher.read(0):
+            if file not in uploaded_files:
+                changed[file] = time.monotonic()
+        if LOGGER:
+            LOGGER.info('Watching {} for new files'.format(UPLOAD_PATH))
+        rescan_at = time.monotonic() + WATCH_RESCAN * 60 if WATCH_RESCAN > 0 else math.inf
+        while True:
+            now = time.monotonic()
+            if watcher.overflowed or now >= rescan_at:
+                watcher.overflowed = False
+                wall_now = time.time()
+                for folder, entries in scan_tree(UPLOAD_PATH):
+                    for entry in entries:
+                        try:
+                            changed_at = now - max(0, wall_now - entry.stat().st_mtime)
+                        except OSError:
+                            continue
+                        changed[entry.path] = max(changed.get(entry.path, changed_at), changed_at)
+                rescan_at = time.monotonic() + WATCH_RESCAN * 60 if WATCH_RESCAN > 0 else math.inf
+                continue
+            ready = [file for file, changed_at in changed.items() if now - changed_at >= WATCH_DEBOUNCE]
+            for file in ready:
+                del changed[file]
+            # a file could be gone (e.g. renamed) while settling
+            ready = [file for file in ready if os.path.isfile(file)]
+            if not ready:
+                deadline = min([changed_at + WATCH_DEBOUNCE for changed_at in changed.values()] + [rescan_at])
+                timeout = None if deadline == math.inf else max(0, deadline - now)
+                for file in watcher.read(timeout):
+                    changed[file] = time.monotonic()
+                continue
+            uploaded_files = run_upload(engine, batches=get_file_batches(ready), **state)
+            # folders could be in use by the files being written
+            uploaded_num += dispose_uploaded(uploaded_files, remove_folders=False)
+            METRICS.set_value('uploaded_files', uploaded_num)
+            export_metrics()
+            # archives written by the uploader itself are not uploaded again
+            for file in watcher.read(0):
+                if file not in uploaded_files:
+                    changed[file] = time.monotonic()
+    except KeyboardInterrupt:
+        if LOGGER:
+            LOGGER.info('Watching {} stopped'.format(UPLOAD_PATH))
+    finally:
+        signal.signal(signal.SIGTERM, previous_handler)
+        watcher.close()
+    return uploaded_num
+
+
 def get_yes_no(value):
     """ coercing boolean value to 'yes' or 'no' """
     return 'yes' if value else 'no'
@@ -412,24 +3704,36 @@ def close_logger(logger):
         logger.removeHandler(handler)
 
 
-def main():
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='uploads specified directory contents to mail.ru cloud')
+    parser.add_argument('--engine', choices=ENGINES, default=None,
+                        help='upload engine, overrides Engine option of the configuration file')
+    parser.add_argument('--watch', action='store_true', default=None,
+                        help='keep uploading files as they land, overrides Watch option of the configuration file')
+    return parser.parse_args(args)
+
+
+def main(engine=None, watch=None):
     # setting up global logger
-    global LOGGER
+    global LOGGER, LIMITER, CONTROLLER, METRICS, DISPOSER
     LOGGER = get_logger(__name__, log_file=LOG_FILE)
+    METRICS = Metrics()
+    engine = engine or ENGINE
+    watch = WATCH if watch is None else watch
     # global (almost) Exception handler
     try:
+        assert engine in ENGINES, 'unknown upload engine: {}'.format(engine)
+        assert SPACE_POLICY in SPACE_POLICIES, 'unknown space policy: {}'.format(SPACE_POLICY)
+        assert COMPRESSION in COMPRESSION_CODECS, 'unknown compression codec: {}'.format(COMPRESSION)
+        # files could have been changed since the previous run in the same process
+        get_archive_ratio.cache_clear()
+        ARCHIVE_HASHES.clear()
+        LIMITER = get_limiter()
+        CONTROLLER = get_controller(max(1, UPLOAD_WORKERS if engine == 'sync' else ASYNC_LIMIT))
         if IS_FROZEN:
             # do not upload self, skip exe file with dependencies
             FILES_TO_SKIP.add(os.path.basename(sys.executable))
-            # supplying ca certificate for https
-            # cacert file should be in module's directory
-            # for cx_Freeze
-            #cacert = os.path.join(os.path.dirname(sys.executable), CACERT_FILE)
-            # for PyInstaller
-            cacert = resource_path(CACERT_FILE)
         else:
-            # provide CA cert (not necessary)
-            cacert = requests.certs.where()
             # do not upload self, skip module's file
             try:
                 self_file = os.path.basename(os.path.abspath(sys.modules['__main__'].__file__))
@@ -437,59 +3741,38 @@ def main():
                 LOGGER.warning('Cannot get self file name.')
             else:
                 FILES_TO_SKIP.add(self_file)
-        assert os.path.isfile(cacert), 'Fatal Error. CA certificate not found.'
-        os.environ["REQUESTS_CA_BUNDLE"] = cacert
+        # session caches of all the accounts
+        FILES_TO_SKIP.update(os.path.basename(get_session_file(login))
+                             for login in [LOGIN] + [login for login, __ in EXTRA_ACCOUNTS])
         # some day this conditional mess should be replaced with class
         # cloud credentials should be in the configuration file
         if IS_CONFIG_PRESENT:
             # email (login) check
             if EMAIL_REGEXP.match(LOGIN):
-                # preparing to upload
-                uploaded_files = set()
-                with requests.Session() as s:
-                    cloud_csrf = get_cloud_csrf(s)
-                    if cloud_csrf:
-                        upload_domain = get_upload_domain(s, csrf=cloud_csrf)
-                        if upload_domain and os.path.isdir(UPLOAD_PATH):
-                            for folder, __, __ in list(os.walk(UPLOAD_PATH)):
-                                # cloud dir should exist before uploading
-                                cloud_path = create_cloud_path(folder)
-                                create_folder(s, folder=cloud_path, csrf=cloud_csrf)
-                                # uploading files
-                                try:
-                                    for file in get_dir_files(path=folder, space=get_cloud_space(s, csrf=cloud_csrf)):
-                                        hash, size = post_file(s, domain=upload_domain, file=file)
-                                        if size>=0 and hash:
-                                            LOGGER.info('File {} successfully posted'.format(file))
-                                            cloud_file = cloud_path + '/' + os.path.basename(file)
-                                            if add_file(s, file=cloud_file, hash=hash, size=size, csrf=cloud_csrf):
-                                                LOGGER.info('File {} successfully added'.format(file))
-                                                uploaded_files.add(file)
-                                except:
-                                    LOGGER.error('File upload error:', exc_info=True)
-                                    raise
-                uploaded_num = len(uploaded_files)
-                LOGGER.info('{} file(s) successfully uploaded'.format(uploaded_num))
-                if uploaded_num:
-                    if MOVE_UPLOADED:
-                        upload_dir = os.path.abspath(UPLOAD_PATH)
-                        uploaded_dir = os.path.abspath(UPLOADED_PATH)
-                        for file in uploaded_files:
-                            file_dir, file_name  = os.path.split(os.path.abspath(file))
-                            # pretty unreliable way to create path
-                            file_new_dir = file_dir.replace(upload_dir, uploaded_dir, 1)
-                            os.makedirs(file_new_dir, exist_ok=True)
-                            move(file, os.path.join(file_new_dir, file_name))
-                            LOGGER.info('file {} moved to {}'.format(file, file_new_dir))
-                    elif REMOVE_UPLOADED:
-                        for file in uploaded_files:
-                            os.unlink(file)
-                            LOGGER.info('file {} removed'.format(file))
-                    if REMOVE_FOLDERS and (MOVE_UPLOADED or REMOVE_UPLOADED):
-                        for folder, __, __ in list(os.walk(UPLOAD_PATH, topdown=False)):
-                            if folder != UPLOAD_PATH and not os.listdir(folder):
-                                os.rmdir(folder)
-                                LOGGER.info('Empty directory {} deleted'.format(folder))
+                # uploading with the selected engine
+                manifest = get_manifest()
+                compressor = get_compressor()
+                journal = UploadJournal(journal_file=JOURNAL_FILE)
+                accounts = get_accounts()
+                # folders could be in use by the files being written while watching
+                DISPOSER = get_disposer(remove_folders=REMOVE_FOLDERS and not watch)
+                try:
+                    state = {'manifest': manifest, 'compressor': compressor, 'journal': journal, 'accounts': accounts}
+                    if watch:
+                        uploaded_num = watch_upload(engine, **state)
+                    else:
+                        uploaded_num = dispose_uploaded(run_upload(engine, **state))
+                finally:
+                    if DISPOSER:
+                        DISPOSER.close()
+                    journal.close()
+                    for account in accounts:
+                        account.close()
+                    if manifest:
+                        manifest.close()
+                    if compressor:
+                        compressor.close()
+                METRICS.set_value('uploaded_files', uploaded_num)
                 print('{} file(s) uploaded. Errors: {}. Warnings: {}. See {} for details.'.format(uploaded_num, LOGGER.error.calls,
                                                                                                   LOGGER.warning.calls, LOG_FILE))
             else:
@@ -497,20 +3780,60 @@ def main():
         else:
             # creating a default config if local configuration does not exists
             config['Credentials'] = {'Email': LOGIN, 'Password': PASSWORD}
-            config['Locations'] = {'CloudPath': CLOUD_PATH, 'UploadPath': UPLOAD_PATH, 'UploadedPath': UPLOADED_PATH}
+            config['Locations'] = {'CloudPath': CLOUD_PATH, 'UploadPath': UPLOAD_PATH, 'UploadedPath': UPLOADED_PATH,
+                                   'MetricsFile': METRICS_FILE, 'PrometheusFile': PROMETHEUS_FILE}
             config['Behaviour'] = {'ArchiveFiles': get_yes_no(ARCHIVE_FILES),
                                    'MoveUploaded': get_yes_no(MOVE_UPLOADED),
                                    'RemoveUploaded': get_yes_no(REMOVE_UPLOADED),
-                                   'RemoveFolders': get_yes_no(REMOVE_FOLDERS)}
+                                   'RemoveFolders': get_yes_no(REMOVE_FOLDERS),
+                                   'SkipUnchanged': get_yes_no(SKIP_UNCHANGED),
+                                   'SplitLarge': get_yes_no(SPLIT_LARGE),
+                                   'SpacePolicy': SPACE_POLICY,
+                                   'CacheFolders': get_yes_no(CACHE_FOLDERS),
+                                   'SkipExisting': get_yes_no(SKIP_EXISTING),
+                                   'BundleFiles': get_yes_no(BUNDLE_FILES),
+                                   'ReproducibleArchives': get_yes_no(REPRODUCIBLE_ARCHIVES),
+                                   'Watch': get_yes_no(WATCH)}
+            config['Performance'] = {'UploadWorkers': str(UPLOAD_WORKERS),
+                                     'Engine': ENGINE,
+                                     'AsyncLimit': str(ASYNC_LIMIT),
+                                     'HashFirst': get_yes_no(HASH_FIRST),
+                                     'StreamArchives': get_yes_no(STREAM_ARCHIVES),
+                                     'CompressWorkers': str(COMPRESS_WORKERS),
+                                     'CompressQueue': str(COMPRESS_QUEUE),
+                                     'Compression': COMPRESSION,
+                                     'CompressLevel': str(COMPRESS_LEVEL),
+                                     'CompressSample': str(COMPRESS_SAMPLE),
+                                     'CompressThreshold': str(COMPRESS_THRESHOLD),
+                                     'BundleThreshold': str(BUNDLE_THRESHOLD),
+                                     'BundleSize': str(BUNDLE_SIZE),
+                                     'WatchDebounce': str(WATCH_DEBOUNCE),
+                                     'WatchRescan': str(WATCH_RESCAN),
+                                     'WatchPoll': str(WATCH_POLL),
+                                     'VolumeSize': str(VOLUME_SIZE),
+                                     'Retries': str(RETRIES),
+                                     'RetriesNonIdempotent': str(RETRIES_NON_IDEMPOTENT),
+                                     'BackoffBase': str(BACKOFF_BASE),
+                                     'BackoffMax': str(BACKOFF_MAX),
+                                     'SessionLifetime': str(SESSION_LIFETIME),
+                                     'SpaceResync': str(SPACE_RESYNC),
+                                     'BandwidthLimit': str(BANDWIDTH_LIMIT),
+                                     'BandwidthSchedule': BANDWIDTH_SCHEDULE,
+                                     'AdaptiveConcurrency': get_yes_no(ADAPTIVE_CONCURRENCY),
+                                     'ConcurrencySchedule': CONCURRENCY_SCHEDULE}
             with open(CONFIG_FILE, mode='w') as f:
                 config.write(f)
             LOGGER.warning('First run. Creating settings file: <{}>. Fill it out and run module again.'.format(CONFIG_FILE))
             print('Please, check your settings in <{}>. Then run me again'.format(CONFIG_FILE))
     except:
         LOGGER.error('Uncaught exception:', exc_info=True)
+    if IS_CONFIG_PRESENT:
+        export_metrics()
     LOGGER.info('###----------SESSION ENDED----------###')
     close_logger(LOGGER)
 
 
 if __name__ == '__main__':
-    main()
+    # process pool support for frozen executables
+    multiprocessing.freeze_support()
+    main(**vars(parse_args()))